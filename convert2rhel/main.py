@@ -75,6 +75,8 @@ def main():
         # begin conversion process
         process_phase = ConversionPhase.PRE_PONR_CHANGES
         pre_ponr_conversion()
+        # In case none of the pre-PONR steps has changed the system and waited for the verification
+        systeminfo.system_info.wait_for_rpm_va()
 
         loggerinst.warning("********************************************************")
         loggerinst.warning("The tool allows rollback of any action until this point.")
@@ -177,6 +179,9 @@ def pre_ponr_conversion():
         loggerinst.task("Convert: Subscription Manager - Enable RHEL repositories")
         subscription.enable_repos(rhel_repoids)
 
+    loggerinst.task("Convert: Download repository metadata")
+    pkghandler.warm_up_repo_metadata()
+
     # remove non-RHEL packages containing repofiles or affecting variables in the repofiles
     loggerinst.task("Convert: Remove packages containing repofiles")
     pkghandler.remove_repofile_pkgs()
@@ -185,6 +190,10 @@ def pre_ponr_conversion():
     loggerinst.task("Convert: Patch yum configuration file")
     redhatrelease.YumConf().patch()
 
+    # download the packages installed after the point of no return while the conversion can still be rolled back
+    loggerinst.task("Convert: Download RHEL packages")
+    pkghandler.stage_rhel_pkgs()
+
 
 def post_ponr_conversion():
     """Perform main steps for system conversion."""
@@ -196,6 +205,7 @@ def post_ponr_conversion():
     pkghandler.preserve_only_rhel_kernel()
     loggerinst.task("Convert: Replace packages")
     pkghandler.replace_non_red_hat_packages()
+    pkghandler.clean_staged_pkgs()
     loggerinst.task("Convert: List remaining non-Red Hat packages")
     pkghandler.list_non_red_hat_pkgs_left()
     return
@@ -216,6 +226,8 @@ def rollback_changes():
     loggerinst = logging.getLogger(__name__)
 
     loggerinst.warn("Abnormal exit! Performing rollback ...")
+    # Clean the staged packages while the RHEL repositories are still enabled
+    pkghandler.clean_staged_pkgs()
     subscription.rollback()
     utils.changed_pkgs_control.restore_pkgs()
     redhatrelease.system_release_file.restore()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Offline backup of the installed packages.
+
+The packages removed during the conversion are normally backed up by downloading their rpms from the original vendor
+repositories, see utils.RestorablePackage. That is impossible on hosts without access to the repositories and slow
+with slow mirrors. This module backs up an installed package from the system itself instead: its rpm header from the
+rpm db and its installed files, stored in a content-addressed archive. Each file is stored under the digest of its
+content, so a file shared by multiple packages is stored just once.
+
+Restoring a package writes its files back, verifies their content against the digests they have been archived under
+and registers the package in the rpm db again with 'rpm -i --justdb', using a package file holding just the archived
+header. For the files not modified since the installation of the package, the archived digests are the digests from
+the rpm header. Modified files, typically configuration files, are restored as they were on the disk and reported as
+not matching the rpm header digests. The files hardlinked to each other in the package are restored as hardlinks. The
+file capabilities and the SELinux contexts are restored once the package is registered, using 'rpm --restore' or,
+with rpm older than 4.11, setcap and restorecon.
+"""
+
+import errno
+import grp
+import hashlib
+import logging
+import os
+import pwd
+import shutil
+import stat
+import struct
+import tempfile
+
+from collections import namedtuple
+
+import rpm
+
+from convert2rhel import utils
+
+ARCHIVE_DIR = os.path.join(utils.BACKUP_DIR, "archive")
+
+# The hash algorithms of the file digests, as stored in RPMTAG_FILEDIGESTALGO. Packages without the tag use MD5.
+_DIGEST_ALGOS = {1: "md5", 2: "sha1", 8: "sha256", 9: "sha384", 10: "sha512", 11: "sha224"}
+_DEFAULT_DIGEST_ALGO = 1
+
+# The parts of the rpm package file format needed to write a package file with just a header
+_RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+_RPMSIGTYPE_HEADERSIG = 5
+_HEADER_MAGIC = b"\x8e\xad\xe8\x01\x00\x00\x00\x00"
+_RPMTAG_HEADERSIGNATURES = 62
+_RPM_BIN_TYPE = 7
+
+_REGISTER_CMD = ("rpm -i --justdb --nodeps --noscripts --notriggers --nosignature --nodigest --replacepkgs"
+                 " --replacefiles")
+
+_COPY_BLOCK_SIZE = 1024 * 1024
+
+# The oldest rpm version providing the --restore option
+_RPM_RESTORE_VERSION = (4, 11)
+# The number of paths passed to a single setcap or restorecon call
+_PATHS_PER_CMD = 100
+
+# A file of an archived package. The digest is the one the content of a regular file is archived under, None for the
+# other types of files, the hdr_digest is the digest of the file in the rpm header. The caps are the file capabilities
+# in the setcap text format, empty when the file has none. A regular file hardlinked to another file of the package is
+# restored as a hardlink to the path in hardlink_to.
+ArchivedFile = namedtuple("ArchivedFile", ["path", "mode", "user", "group", "mtime", "digest", "hdr_digest",
+                                           "link_to", "caps", "hardlink_to"])
+
+
+class ArchivedPackage(object):
+    """An installed package backed up into the archive: the path of its rpm header and its files."""
+
+    def __init__(self, nvra, hdr_path, digest_algo, files, archive_dir=ARCHIVE_DIR):
+        self.nvra = nvra
+        self.hdr_path = hdr_path
+        self.digest_algo = digest_algo
+        self.files = files
+        self.archive_dir = archive_dir
+
+    def restore(self):
+        """Write the files of the package back, verify them and register the package in the rpm db.
+
+        Return True when the package has been restored. A package with any of the files not matching its archived
+        digest is not registered in the rpm db. The files restored with a content other than the one in the rpm header,
+        i.e. modified before they were backed up, are reported.
+        """
+        loggerinst = logging.getLogger(__name__)
+        loggerinst.info("Restoring %s from the archive" % self.nvra)
+        failed = []
+        # Sorted by the path, directories come before their content
+        for archived_file in sorted(self.files):
+            try:
+                if not self._restore_file(archived_file):
+                    failed.append(archived_file.path)
+            except (IOError, OSError) as err:
+                loggerinst.warning("Couldn't restore %s: %s" % (archived_file.path, str(err)))
+                failed.append(archived_file.path)
+        if failed:
+            loggerinst.warning("Couldn't restore %s, the following files failed to be restored:\n%s"
+                               % (self.nvra, "\n".join(failed)))
+            return False
+        if not self._register():
+            return False
+        self._restore_metadata()
+        modified = [archived_file.path for archived_file in self.files if archived_file.digest
+                    and archived_file.hdr_digest and not archived_file.hardlink_to
+                    and archived_file.digest != archived_file.hdr_digest]
+        if modified:
+            loggerinst.warning("The following files of %s don't match the digests in the rpm header. They had been"
+                               " modified before %s was backed up and they are restored as modified:\n%s"
+                               % (self.nvra, self.nvra, "\n".join(modified)))
+        loggerinst.info("Package %s restored" % self.nvra)
+        return True
+
+    def _restore_file(self, archived_file):
+        loggerinst = logging.getLogger(__name__)
+        path = archived_file.path
+        if stat.S_ISDIR(archived_file.mode):
+            utils.mkdir_p(path)
+        elif archived_file.hardlink_to:
+            # The file linked to comes first in the order of the paths, so it has been restored and verified already
+            if os.path.lexists(path):
+                os.remove(path)
+            utils.mkdir_p(os.path.dirname(path))
+            os.link(archived_file.hardlink_to, path)
+            return True
+        elif stat.S_ISLNK(archived_file.mode):
+            if os.path.lexists(path):
+                os.remove(path)
+            utils.mkdir_p(os.path.dirname(path))
+            os.symlink(archived_file.link_to, path)
+        else:
+            utils.mkdir_p(os.path.dirname(path))
+            digest = hashlib.new(self.digest_algo)
+            # Written under a temporary name first to not leave a file with unverified content behind
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    with open(get_object_path(archived_file.digest, self.archive_dir), "rb") as object_file:
+                        _copy(object_file, tmp_file, digest)
+                if digest.hexdigest() != archived_file.digest:
+                    loggerinst.warning("The content of %s doesn't match its digest %s."
+                                       % (path, archived_file.digest))
+                    os.remove(tmp_path)
+                    return False
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        _set_attributes(archived_file)
+        return True
+
+    def _register(self):
+        loggerinst = logging.getLogger(__name__)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(self.hdr_path, "rb") as hdr_file:
+                hdr_blob = hdr_file.read()
+            rpm_path = os.path.join(tmp_dir, "%s.rpm" % self.nvra)
+            write_header_only_rpm(hdr_blob, self.nvra, rpm_path)
+            output, ret_code = utils.run_subprocess("%s %s" % (_REGISTER_CMD, rpm_path), print_output=False)
+        finally:
+            shutil.rmtree(tmp_dir)
+        if ret_code != 0:
+            loggerinst.warning("Couldn't register %s in the rpm db:\n%s" % (self.nvra, output))
+            return False
+        return True
+
+    def _restore_metadata(self):
+        """Restore the file capabilities and the SELinux contexts of the files of the registered package."""
+        loggerinst = logging.getLogger(__name__)
+        if getattr(rpm, "__version_info__", (0,)) >= _RPM_RESTORE_VERSION:
+            output, ret_code = utils.run_subprocess("rpm --restore %s" % self.nvra, print_output=False)
+            if ret_code != 0:
+                loggerinst.warning("Couldn't restore the file attributes of %s:\n%s" % (self.nvra, output))
+            return
+        for archived_file in self.files:
+            if archived_file.caps:
+                output, ret_code = utils.run_subprocess('setcap "%s" "%s"' % (archived_file.caps, archived_file.path),
+                                                        print_output=False)
+                if ret_code != 0:
+                    loggerinst.warning("Couldn't restore the capabilities of %s:\n%s" % (archived_file.path, output))
+        if not _is_selinux_enabled():
+            return
+        paths = [archived_file.path for archived_file in self.files]
+        for i in range(0, len(paths), _PATHS_PER_CMD):
+            output, ret_code = utils.run_subprocess(
+                "restorecon %s" % " ".join(['"%s"' % path for path in paths[i:i + _PATHS_PER_CMD]]),
+                print_output=False)
+            if ret_code != 0:
+                loggerinst.warning("Couldn't restore the SELinux contexts of the files of %s:\n%s"
+                                   % (self.nvra, output))
+
+
+def archive_pkgs(pkgs, archive_dir=ARCHIVE_DIR):
+    """Back up the installed packages into the archive.
+
+    The package specs are matched the same way as in utils.get_rpm_paths_by_pkg(). Return a dictionary with the
+    ArchivedPackage objects keyed by the package specs, None for the packages that are not installed or have failed to
+    be backed up.
+    """
+    loggerinst = logging.getLogger(__name__)
+    archived = dict([(pkg, None) for pkg in pkgs])
+    try:
+        # Iterated one header at a time, without loading the headers of all the installed packages at once
+        for hdr in rpm.TransactionSet().dbMatch():
+            nevra = _get_hdr_nevra(hdr)
+            specs = [label for label in utils.get_pkg_labels(*nevra) if archived.get(label, False) is None]
+            if specs:
+                archived_pkg = archive_pkg(hdr, archive_dir)
+                for spec in specs:
+                    archived[spec] = archived_pkg
+    except rpm.error as err:
+        loggerinst.warning("Unable to read the installed packages: %s" % err)
+    return archived
+
+
+def archive_pkg(hdr, archive_dir=ARCHIVE_DIR):
+    """Back up the installed package with the rpm header into the archive. Return an ArchivedPackage object or None
+    when the package could not be backed up.
+    """
+    loggerinst = logging.getLogger(__name__)
+    name, _, version, release, arch = _get_hdr_nevra(hdr)
+    nvra = "%s-%s-%s.%s" % (name, version, release, arch)
+    loggerinst.info("Backing up %s from the installed files" % nvra)
+
+    digest_algo = _DIGEST_ALGOS[hdr[rpm.RPMTAG_FILEDIGESTALGO] or _DEFAULT_DIGEST_ALGO]
+    files_count = len(hdr[rpm.RPMTAG_FILENAMES])
+    # Empty in the headers of the packages built without the tags
+    caps = hdr[rpm.RPMTAG_FILECAPS] or [""] * files_count
+    inodes = hdr[rpm.RPMTAG_FILEINODES] or [None] * files_count
+    file_attributes = zip(hdr[rpm.RPMTAG_FILENAMES], hdr[rpm.RPMTAG_FILEMODES], hdr[rpm.RPMTAG_FILEFLAGS],
+                          hdr[rpm.RPMTAG_FILEDIGESTS], hdr[rpm.RPMTAG_FILELINKTOS], hdr[rpm.RPMTAG_FILEUSERNAME],
+                          hdr[rpm.RPMTAG_FILEGROUPNAME], hdr[rpm.RPMTAG_FILEMTIMES], caps, inodes)
+    files = []
+    # The regular files of the package sharing an inode in the header are hardlinks to each other
+    paths_by_inode = {}
+    try:
+        for path, mode, flags, hdr_digest, link_to, user, group, mtime, file_caps, inode in file_attributes:
+            path = _to_str(path)
+            mode = mode & 0xffff
+            if flags & rpm.RPMFILE_GHOST:
+                continue
+            digest = None
+            if stat.S_ISREG(mode):
+                try:
+                    digest = store_file(path, digest_algo, archive_dir)
+                except (IOError, OSError) as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    # E.g. documentation not installed due to the nodocs transaction flag
+                    loggerinst.debug("%s of %s is not installed, skipping it." % (path, nvra))
+                    continue
+                if digest != _to_str(hdr_digest):
+                    loggerinst.debug("%s has been modified since the installation of %s, backing up the modified file."
+                                     % (path, nvra))
+            elif not stat.S_ISDIR(mode) and not stat.S_ISLNK(mode):
+                loggerinst.debug("Skipping the special file %s of %s." % (path, nvra))
+                continue
+            if stat.S_ISREG(mode) and inode is not None:
+                paths_by_inode.setdefault(inode, []).append(path)
+            files.append(ArchivedFile(path, mode, _to_str(user), _to_str(group), mtime, digest, _to_str(hdr_digest),
+                                      _to_str(link_to), _to_str(file_caps) or "", None))
+        files = _set_hardlinks(files, paths_by_inode.values())
+
+        hdr_path = os.path.join(archive_dir, "headers", "%s.hdr" % nvra)
+        utils.mkdir_p(os.path.dirname(hdr_path))
+        with open(hdr_path, "wb") as hdr_file:
+            hdr_file.write(hdr.unload())
+    except (IOError, OSError) as err:
+        loggerinst.warning("Couldn't back up %s from the installed files: %s" % (nvra, str(err)))
+        return None
+    return ArchivedPackage(nvra, hdr_path, digest_algo, files, archive_dir)
+
+
+def store_file(path, digest_algo, archive_dir=ARCHIVE_DIR):
+    """Store the content of the file in the archive unless it's there already. Return the digest of the content."""
+    objects_dir = os.path.join(archive_dir, "objects")
+    utils.mkdir_p(objects_dir)
+    digest = hashlib.new(digest_algo)
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            with open(path, "rb") as src_file:
+                _copy(src_file, tmp_file, digest)
+        object_path = get_object_path(digest.hexdigest(), archive_dir)
+        if os.path.exists(object_path):
+            os.remove(tmp_path)
+        else:
+            utils.mkdir_p(os.path.dirname(object_path))
+            os.rename(tmp_path, object_path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest.hexdigest()
+
+
+def get_object_path(digest, archive_dir=ARCHIVE_DIR):
+    return os.path.join(archive_dir, "objects", digest[:2], digest)
+
+
+def write_header_only_rpm(hdr_blob, nvra, path):
+    """Write an rpm package file with the rpm header, an empty signature header and no payload.
+
+    Such a package can't be installed, but it's enough for registering the package in the rpm db using
+    'rpm -i --justdb' with the signature and digest checks disabled.
+    """
+    lead = struct.pack(">4sBBhh66shh16s", _RPM_LEAD_MAGIC, 3, 0, 0, 1, nvra.encode("utf-8")[:65], 1,
+                       _RPMSIGTYPE_HEADERSIG, b"")
+    # The signature header consists of just the region tag. Its size is a multiple of 8 so no padding is needed.
+    region_trailer = struct.pack(">iiii", _RPMTAG_HEADERSIGNATURES, _RPM_BIN_TYPE, -16, 16)
+    sig_header = (_HEADER_MAGIC + struct.pack(">ii", 1, len(region_trailer))
+                  + struct.pack(">iiii", _RPMTAG_HEADERSIGNATURES, _RPM_BIN_TYPE, 0, 16) + region_trailer)
+    if not hdr_blob.startswith(_HEADER_MAGIC[:4]):
+        hdr_blob = _HEADER_MAGIC + hdr_blob
+    with open(path, "wb") as rpm_file:
+        rpm_file.write(lead + sig_header + hdr_blob)
+
+
+def _copy(src_file, dst_file, digest):
+    while True:
+        block = src_file.read(_COPY_BLOCK_SIZE)
+        if not block:
+            break
+        digest.update(block)
+        dst_file.write(block)
+
+
+def _set_hardlinks(files, hardlinked_paths):
+    """Mark the files hardlinked to each other to be restored as hardlinks to the first of them by the path."""
+    hardlink_to = {}
+    for paths in hardlinked_paths:
+        for path in sorted(paths)[1:]:
+            hardlink_to[path] = min(paths)
+    return [archived_file._replace(hardlink_to=hardlink_to.get(archived_file.path)) for archived_file in files]
+
+
+def _is_selinux_enabled():
+    try:
+        _, ret_code = utils.run_subprocess("selinuxenabled", print_cmd=False, print_output=False)
+    except EnvironmentError:
+        # The command is not installed
+        return False
+    return ret_code == 0
+
+
+def _set_attributes(archived_file):
+    try:
+        uid = pwd.getpwnam(archived_file.user).pw_uid
+    except KeyError:
+        uid = 0
+    try:
+        gid = grp.getgrnam(archived_file.group).gr_gid
+    except KeyError:
+        gid = 0
+    if stat.S_ISLNK(archived_file.mode):
+        os.lchown(archived_file.path, uid, gid)
+        return
+    os.chown(archived_file.path, uid, gid)
+    os.chmod(archived_file.path, stat.S_IMODE(archived_file.mode))
+    os.utime(archived_file.path, (archived_file.mtime, archived_file.mtime))
+
+
+def _get_hdr_nevra(hdr):
+    return tuple([_to_str(hdr[tag]) for tag in (rpm.RPMTAG_NAME, rpm.RPMTAG_EPOCH, rpm.RPMTAG_VERSION,
+                                                rpm.RPMTAG_RELEASE, rpm.RPMTAG_ARCH)])
+
+
+def _to_str(value):
+    # Some versions of the rpm Python 3 bindings return bytes instead of strings
+    if value is None:
+        return None
+    return value.decode() if isinstance(value, bytes) and not isinstance(value, str) else str(value)
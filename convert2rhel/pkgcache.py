@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent caches of the installed package inventory and of the verification of the installed packages.
+
+Decoding the signatures of all the installed packages is one of the slowest parts of the conversion preparation and
+conversions are frequently re-run, e.g. after a failure before the point of no return. The fingerprints of the keys the
+installed packages have been signed with are therefore stored in an SQLite database and reused on the next run in case
+the rpm db has not changed in the meantime.
+
+The same applies to the 'rpm -Va' output. Its lines are stored per package together with the digest of the package
+header and the digest of the state of the package files on the disk, see rpmverify.get_files_state_digests(), so that
+only the packages which may have changed since are verified again.
+
+The content of the cache can be inspected by running:
+  python -m convert2rhel.pkgcache [--list]
+"""
+
+import logging
+import optparse
+import os
+import sqlite3
+import sys
+
+from convert2rhel import utils
+
+PKG_INVENTORY_CACHE_PATH = os.path.join(utils.TMP_DIR, "pkg_inventory.sqlite")
+RPM_VA_CACHE_PATH = os.path.join(utils.TMP_DIR, "rpm_va.sqlite")
+
+
+def get_pkg_key(pkg_obj):
+    """Return a key identifying a specific installation of a package.
+
+    Apart from the NEVRA, the key contains the installation time of the package so that a package reinstalled with the
+    same NEVRA (but possibly signed by a different key) is not mistaken for the original one. Packages without the
+    installation time available get no key and are never cached.
+    """
+    installtime = getattr(pkg_obj, "installtime", None)
+    if not installtime:
+        return None
+    return (pkg_obj.name, str(pkg_obj.epoch), pkg_obj.version, pkg_obj.release, pkg_obj.arch, int(installtime))
+
+
+class SQLiteCache(object):
+    """Base of the caches stored in an SQLite database with a single pkgs table and a meta table of key-value pairs.
+    """
+
+    # Increase when changing the structure of the database. A cache with a different schema version is discarded.
+    schema_version = None
+    # The columns of the pkgs table
+    pkgs_table_columns = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if not row or row[0] != self.schema_version:
+            conn.execute("DROP TABLE IF EXISTS pkgs")
+            conn.execute("DELETE FROM meta")
+            conn.execute("INSERT INTO meta VALUES ('schema_version', ?)", (self.schema_version,))
+        conn.execute("CREATE TABLE IF NOT EXISTS pkgs (%s)" % self.pkgs_table_columns)
+        conn.commit()
+        return conn
+
+    def _can_save(self):
+        """The cache is not saved in case the directory for it does not exist, e.g. when convert2rhel is not installed
+        as a package.
+        """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            loggerinst = logging.getLogger(__name__)
+            loggerinst.debug("Not saving the cache %s, %s does not exist." % (self.path, os.path.dirname(self.path)))
+            return False
+        return True
+
+
+class PkgInventoryCache(SQLiteCache):
+    """SQLite database holding the fingerprints of the installed packages together with the state of the rpm db they
+    were read from.
+    """
+
+    schema_version = "1"
+    pkgs_table_columns = ("name TEXT, epoch TEXT, version TEXT, release TEXT, arch TEXT, installtime INTEGER,"
+                          " fingerprint TEXT,"
+                          " PRIMARY KEY (name, epoch, version, release, arch, installtime)")
+
+    def __init__(self, path=PKG_INVENTORY_CACHE_PATH):
+        super(PkgInventoryCache, self).__init__(path)
+
+    def load(self, rpmdb_state=None):
+        """Return a dictionary with the cached fingerprints keyed by get_pkg_key().
+
+        Return an empty dictionary when the cache does not exist, is not readable or, with rpmdb_state passed, when the
+        fingerprints were read from an rpm db in a different state. A package can be changed without changing its key,
+        e.g. by reinstalling it from a build signed by a different key, so any change to the rpm db invalidates the
+        whole cache.
+        """
+        loggerinst = logging.getLogger(__name__)
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            conn = self._connect()
+            try:
+                if rpmdb_state is not None:
+                    row = conn.execute("SELECT value FROM meta WHERE key = 'rpmdb_state'").fetchone()
+                    if not row or row[0] != repr(rpmdb_state):
+                        loggerinst.debug("The rpm db has changed since the package inventory cache %s was saved."
+                                         % self.path)
+                        return {}
+                rows = conn.execute("SELECT name, epoch, version, release, arch, installtime, fingerprint"
+                                    " FROM pkgs").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            loggerinst.debug("Unable to read the package inventory cache %s: %s" % (self.path, err))
+            return {}
+        return dict((tuple(row[:6]), row[6]) for row in rows)
+
+    def save(self, rpmdb_state, fingerprints):
+        """Replace the content of the cache with the passed fingerprints keyed by get_pkg_key().
+
+        The cache is not saved in case the directory for it does not exist, e.g. when convert2rhel is not installed
+        as a package.
+        """
+        loggerinst = logging.getLogger(__name__)
+        if not self._can_save():
+            return
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("DELETE FROM pkgs")
+                conn.executemany("INSERT OR REPLACE INTO pkgs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [key + (fingerprint,) for key, fingerprint in fingerprints.items()])
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('rpmdb_state', ?)", (repr(rpmdb_state),))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            loggerinst.debug("Unable to save the package inventory cache %s: %s" % (self.path, err))
+
+    def get_rpmdb_state(self):
+        """Return the state of the rpm db the cached fingerprints were read from, as a string."""
+        if not os.path.isfile(self.path):
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'rpmdb_state'").fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+
+class VerificationCache(SQLiteCache):
+    """SQLite database holding the 'rpm -Va' output lines of the installed packages together with the digests of the
+    package headers and of the state of the package files they were verified with.
+    """
+
+    schema_version = "2"
+    pkgs_table_columns = "nvra TEXT PRIMARY KEY, header_digest TEXT, files_digest TEXT, lines TEXT"
+
+    def __init__(self, path=RPM_VA_CACHE_PATH):
+        super(VerificationCache, self).__init__(path)
+
+    def load(self, profile):
+        """Return a dictionary with (header digest, files digest, list of the output lines) tuples keyed by the NVRA.
+
+        Return an empty dictionary when the cache does not exist, is not readable or holds the results of a
+        verification with a profile other than the passed rpmverify.VerificationProfile.
+        """
+        loggerinst = logging.getLogger(__name__)
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'profile'").fetchone()
+                if not row or row[0] != str(profile):
+                    return {}
+                rows = conn.execute("SELECT nvra, header_digest, files_digest, lines FROM pkgs").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            loggerinst.debug("Unable to read the verification cache %s: %s" % (self.path, err))
+            return {}
+        return dict((row[0], (row[1], row[2], row[3].splitlines(True))) for row in rows)
+
+    def save(self, profile, entries):
+        """Replace the content of the cache with the passed entries in the format returned by load(), verified with the
+        passed rpmverify.VerificationProfile.
+        """
+        loggerinst = logging.getLogger(__name__)
+        if not self._can_save():
+            return
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("DELETE FROM pkgs")
+                conn.executemany("INSERT OR REPLACE INTO pkgs VALUES (?, ?, ?, ?)",
+                                 [(nvra, header_digest, files_digest, "".join(lines))
+                                  for nvra, (header_digest, files_digest, lines) in entries.items()])
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('profile', ?)", (str(profile),))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            loggerinst.debug("Unable to save the verification cache %s: %s" % (self.path, err))
+
+
+def main():
+    """Print a summary of the package inventory cache."""
+    parser = optparse.OptionParser(usage="python -m convert2rhel.pkgcache [--list]")
+    parser.add_option("--list", action="store_true", help="List all the cached packages and their fingerprints.")
+    opts, _ = parser.parse_args()
+
+    if not os.path.isfile(pkg_inventory_cache.path):
+        print("The package inventory cache %s does not exist." % pkg_inventory_cache.path)
+        return 1
+
+    # Importing here instead of on top of the file to avoid cyclic dependency
+    from convert2rhel import pkghandler
+    fingerprints = pkg_inventory_cache.load()
+    is_current = pkg_inventory_cache.get_rpmdb_state() == repr(pkghandler.get_rpmdb_state())
+
+    print("Cache file:          %s" % pkg_inventory_cache.path)
+    print("Cached packages:     %d" % len(fingerprints))
+    print("Matches the rpm db:  %s" % ("yes" if is_current else "no, all packages will be re-read"))
+
+    pkgs_per_fingerprint = utils.DictWListValues()
+    for key, fingerprint in fingerprints.items():
+        pkgs_per_fingerprint[fingerprint].append(key)
+    print("\nPackages per key fingerprint:")
+    for fingerprint in sorted(pkgs_per_fingerprint):
+        print("  %-20s %d" % (fingerprint, len(pkgs_per_fingerprint[fingerprint])))
+
+    if opts.list:
+        print("\nCached packages:")
+        for key in sorted(fingerprints):
+            name, epoch, version, release, arch, _ = key
+            print("  %-60s %s" % ("%s-%s:%s-%s.%s" % (name, epoch, version, release, arch), fingerprints[key]))
+    return 0
+
+
+# Code to be executed upon module import
+pkg_inventory_cache = PkgInventoryCache()  # pylint: disable=C0103
+rpm_va_cache = VerificationCache()  # pylint: disable=C0103
+
+if __name__ == "__main__":
+    sys.exit(main())
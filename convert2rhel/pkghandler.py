@@ -15,20 +15,60 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import fnmatch
 import glob
 import logging
+import multiprocessing
 import os
 import re
 import rpm
 
+from collections import namedtuple
+
 from convert2rhel.systeminfo import system_info
 from convert2rhel import utils
+from convert2rhel import pkgcache
 from convert2rhel import pkgmanager
+from convert2rhel import pkgstore
 from convert2rhel.toolopts import tool_opts
 
 # Limit the number of loops over yum command calls for the case there was
 # an error.
 MAX_YUM_CMD_CALLS = 2
+# Limit of the yum calls spent on resolving the dependency errors of one yum command
+MAX_DEP_RESOLUTION_YUM_CALLS = 10
+# Only the tail of this size (in characters) of the yum output is kept in memory, together with the error lines
+# further analyzed by get_problematic_pkgs(). The whole output is in the log file.
+YUM_OUTPUT_TAIL_SIZE = 1024 * 1024
+# Yum/dnf commands that do not change the installed packages
+_READ_ONLY_YUM_COMMANDS = ("list", "makecache", "clean")
+# Makes yum/dnf use the cached repository metadata regardless of its age. Unlike the -C option, it still allows
+# downloading the packages that are not in the cache.
+_CACHED_METADATA_OPT = "--setopt=*.metadata_expire=never"
+# Errors of yum/dnf caused by outdated repository metadata, e.g. a package that has been removed from the repository
+_STALE_METADATA_ERROR_RE = re.compile("No more mirrors to try|Error downloading packages|Cannot download|"
+                                      "Failed to download metadata|Cannot retrieve repository metadata")
+# Makes yum/dnf keep the downloaded packages in the cache after a successful transaction. By default dnf wipes them,
+# including the packages downloaded in advance by stage_rhel_pkgs(), after the first transaction.
+_KEEP_CACHE_OPT = "--setopt=keepcache=1"
+# Yum on RHEL 6 provides the --downloadonly option only with the yum-plugin-downloadonly package installed
+_DOWNLOADONLY_UNSUPPORTED_RE = re.compile("no such option: --downloadonly")
+
+# The yum shell script with the transaction replacing the non-Red Hat packages
+_REPLACEMENT_TRANSACTION_PATH = os.path.join(utils.TMP_DIR, "replacement_transaction.txt")
+
+# The actions of a replacement plan, in the order of preference: a package is updated when a newer version is available,
+# reinstalled when the same version is available and downgraded otherwise
+PLAN_UPDATE = "update"
+PLAN_REINSTALL = "reinstall"
+PLAN_DOWNGRADE = "downgrade"
+
+# The result of downloading a package: the package spec, the path of the downloaded rpm or None and the error message
+# when the package has not been downloaded
+DownloadResult = namedtuple("DownloadResult", ["pkg", "path", "error"])
+
+# A planned replacement of an installed package (a PkgRecord) by a package from the enabled repositories (a PkgRecord)
+PlannedAction = namedtuple("PlannedAction", ["action", "installed", "target"])
 
 _VERSIONLOCK_FILE_PATH = '/etc/yum/pluginconf.d/versionlock.list'  # This file is used by the dnf plugin as well
 versionlock_file = utils.RestorableFile(_VERSIONLOCK_FILE_PATH)  # pylint: disable=C0103
@@ -37,11 +77,72 @@ versionlock_file = utils.RestorableFile(_VERSIONLOCK_FILE_PATH)  # pylint: disab
 class PkgWFingerprint(object):
     """Tuple-like storage for a package object and a fingerprint with which the package was signed."""
 
+    __slots__ = ["pkg_obj", "fingerprint"]
+
     def __init__(self, pkg_obj, fingerprint):
         self.pkg_obj = pkg_obj
         self.fingerprint = fingerprint
 
 
+class PkgRecord(object):
+    """Immutable record with the information about an installed package that the conversion needs.
+
+    The yum package objects hold the whole rpm header of the package and the dnf ones keep the whole dnf sack alive.
+    Keeping thousands of them in memory for the whole conversion is wasteful, so only the needed attributes are copied
+    to this record. It can be used in place of the yum/dnf package object with get_pkg_nvra(), get_pkg_nevra(),
+    get_vendor(), get_packager() and print_pkg_info().
+    """
+
+    __slots__ = ["name", "epoch", "version", "release", "arch", "vendor", "packager", "from_repo", "fingerprint"]
+
+    def __init__(self, name, epoch, version, release, arch, vendor=None, packager=None, from_repo="N/A",
+                 fingerprint=None):
+        for attr, value in zip(self.__slots__,
+                               [name, epoch, version, release, arch, vendor, packager, from_repo, fingerprint]):
+            object.__setattr__(self, attr, value)
+
+    @classmethod
+    def from_pkg_obj(cls, pkg_obj, fingerprint=None):
+        """Create the record from a yum.rpmsack.RPMInstalledPackage or a hawkey.Package object.
+
+        The vendor is None in case the package manager does not provide it (dnf on RHEL 8.0-8.3 derived systems).
+        """
+        return cls(pkg_obj.name, pkg_obj.epoch, pkg_obj.version, pkg_obj.release, pkg_obj.arch,
+                   vendor=getattr(pkg_obj, "vendor", None), packager=pkg_obj.packager,
+                   from_repo=get_pkg_from_repo(pkg_obj), fingerprint=fingerprint)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PkgRecord is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("PkgRecord is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, PkgRecord):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return "PkgRecord(%s)" % get_pkg_nevra(self)
+
+    def _values(self):
+        return tuple([getattr(self, attr) for attr in self.__slots__])
+
+    def __getstate__(self):
+        return self._values()
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            object.__setattr__(self, attr, value)
+
+
 def call_yum_cmd_w_downgrades(cmd, fingerprints):
     """Calling yum command is prone to end up with an error due to unresolved
     dependencies, especially when it tries to downgrade pkgs. This function
@@ -49,27 +150,29 @@ def call_yum_cmd_w_downgrades(cmd, fingerprints):
     """
 
     loggerinst = logging.getLogger(__name__)
+    resolver = DepErrorResolver()
     for _ in range(MAX_YUM_CMD_CALLS):
-        output, ret_code = call_yum_cmd(cmd, "%s" % (" ".join(
-            get_installed_pkgs_by_fingerprint(fingerprints))))
+        error_parser = YumErrorParser()
+        _, ret_code = call_yum_cmd(cmd, "%s" % (" ".join(
+            get_installed_pkgs_by_fingerprint(fingerprints))), error_parser=error_parser)
         loggerinst.info("Received return code: %s\n" % str(ret_code))
         # handle success condition #1
         if ret_code == 0:
             break
         # handle success condition #2
         # false positive: yum returns non-zero code when there is nothing to do
-        nothing_to_do_error_exists = output.endswith("Error: Nothing to do\n")
-        if ret_code == 1 and nothing_to_do_error_exists:
+        if ret_code == 1 and error_parser.nothing_to_do:
             break
         # handle error condition
         loggerinst.info("Resolving dependency errors ... ")
-        resolve_dep_errors(output, [])
+        resolver.resolve(error_parser.problems)
     else:
         loggerinst.critical("Could not resolve yum errors.")
     return
 
 
-def call_yum_cmd(command, args="", print_output=True, enable_repos=None, disable_repos=None, set_releasever=True):
+def call_yum_cmd(command, args="", print_output=True, enable_repos=None, disable_repos=None, set_releasever=True,
+                 error_parser=None):
     """Call yum command and optionally print its output.
 
     The enable_repos and disable_repos function parameters accept lists and they override the default use of repos,
@@ -82,18 +185,23 @@ def call_yum_cmd(command, args="", print_output=True, enable_repos=None, disable
     release packages (centos-release, oraclelinux-release, etc.) and before the redhat-release package is installed.
     By default, for the above reason, we provide the --releasever option to each yum call. However before we remove the
     release package, we need YUM/DNF to expand the variable by itself (for that, use set_releasever=False).
+
+    Once the repository metadata has been downloaded by warm_up_repo_metadata(), yum/dnf uses just the cached metadata.
+    When it fails on outdated metadata, the metadata is expired and the command is run once more with the metadata
+    refreshed. Once the packages have been downloaded in advance by stage_rhel_pkgs(), yum/dnf keeps them in the cache.
+
+    The yum/dnf output is fed line by line to the error_parser, a YumErrorParser, as it streams. Pass one to get the
+    problems yum/dnf reported.
     """
     loggerinst = logging.getLogger(__name__)
 
-    cmd = "yum %s -y" % command
+    cmd = "%s -y" % command
+    repo_opts_start = len(cmd)
+
+    repos_to_disable, repos_to_enable = _get_yum_cmd_repos(enable_repos, disable_repos)
 
     # The --disablerepo yum option must be added before --enablerepo,
     #   otherwise the enabled repo gets disabled if --disablerepo="*" is used
-    repos_to_disable = []
-    if isinstance(disable_repos, list):
-        repos_to_disable = disable_repos
-    else:
-        repos_to_disable = tool_opts.disablerepo
 
     for repo in repos_to_disable:
         cmd += " --disablerepo=%s" % repo
@@ -105,78 +213,316 @@ def call_yum_cmd(command, args="", print_output=True, enable_repos=None, disable
     if system_info.version.major == 8:
         cmd += " --setopt=module_platform_id=platform:el8"
 
-    repos_to_enable = []
-    if isinstance(enable_repos, list):
-        repos_to_enable = enable_repos
-    else:
-        # When using subscription-manager for the conversion, use those repos for the yum call that have been enabled
-        # through subscription-manager
-        repos_to_enable = system_info.submgr_enabled_repos if not tool_opts.disable_submgr else tool_opts.enablerepo
-
     for repo in repos_to_enable:
         cmd += " --enablerepo=%s" % repo
+    repo_opts = cmd[repo_opts_start:]
 
     if args:
         cmd += " " + args
 
-    stdout, returncode = utils.run_subprocess(cmd, print_output=print_output)
+    if pkg_cache.keep and command not in _READ_ONLY_YUM_COMMANDS:
+        cmd = "%s %s" % (_KEEP_CACHE_OPT, cmd)
+
+    if command not in _READ_ONLY_YUM_COMMANDS:
+        # The verification of the packages running in the background must not see the changes
+        system_info.wait_for_rpm_va()
+    if error_parser is None:
+        error_parser = YumErrorParser()
+    cached_metadata = repo_metadata.warm
+    stdout, returncode = _run_yum_cmd(_CACHED_METADATA_OPT + " " + cmd if cached_metadata else cmd, print_output,
+                                      error_parser)
+    if cached_metadata and returncode != 0 and _STALE_METADATA_ERROR_RE.search(stdout):
+        loggerinst.info("The cached repository metadata may be outdated. Refreshing it and retrying.")
+        utils.run_subprocess("yum clean expire-cache%s" % repo_opts, print_output=False)
+        stdout, returncode = _run_yum_cmd(cmd, print_output, error_parser)
+    if command not in _READ_ONLY_YUM_COMMANDS:
+        installed_pkgs_snapshot.invalidate()
     # handle when yum returns non-zero code when there is nothing to do
-    nothing_to_do_error_exists = stdout.endswith("Error: Nothing to do\n")
-    if returncode == 1 and nothing_to_do_error_exists:
+    if returncode == 1 and error_parser.nothing_to_do:
         loggerinst.debug("Yum has nothing to do. Ignoring.")
         returncode = 0
     return stdout, returncode
 
 
-def get_problematic_pkgs(output, known_problematic_pkgs):
-    new_problematic_pkgs = []
-    package_nevr_re = "[0-9]*:?([a-z-][a-z0-9-]*?)-[0-9]"
+def _get_yum_cmd_repos(enable_repos=None, disable_repos=None):
+    """Return the lists of the repos to disable and to enable in a yum call, see call_yum_cmd()."""
+    if isinstance(disable_repos, list):
+        repos_to_disable = disable_repos
+    else:
+        repos_to_disable = tool_opts.disablerepo
+
+    if isinstance(enable_repos, list):
+        repos_to_enable = enable_repos
+    else:
+        # When using subscription-manager for the conversion, use those repos for the yum call that have been enabled
+        # through subscription-manager
+        repos_to_enable = system_info.submgr_enabled_repos if not tool_opts.disable_submgr else tool_opts.enablerepo
+    return repos_to_disable, repos_to_enable
+
+
+def _run_yum_cmd(cmd, print_output, error_parser):
+    error_parser.reset()
+    stdout, returncode = utils.run_subprocess("yum " + cmd, print_output=print_output, line_callback=error_parser,
+                                              max_output_size=YUM_OUTPUT_TAIL_SIZE)
+    return error_parser.prepend_dropped(stdout), returncode
+
+
+class RepoMetadata(object):
+    """State of the repository metadata in the yum/dnf cache.
+
+    Yum/dnf revalidates the metadata of every enabled repository whenever it considers the metadata expired. The
+    conversion calls yum many times in a row, so the metadata is downloaded once, right after the RHEL repositories are
+    enabled, and all the subsequent yum calls use just the cached metadata.
+    """
+
+    def __init__(self):
+        self.warm = False
+
+
+def warm_up_repo_metadata():
+    """Download the metadata of the enabled repositories to the yum/dnf cache.
+
+    Failing to download the metadata is not fatal, the yum calls then keep revalidating the metadata themselves.
+    """
+    loggerinst = logging.getLogger(__name__)
+    loggerinst.info("Downloading the repository metadata ...")
+    repo_metadata.warm = False
+    output, ret_code = call_yum_cmd("makecache", print_output=False)
+    if ret_code != 0:
+        loggerinst.warning("Unable to download the repository metadata:\n%s" % output)
+        return
+    repo_metadata.warm = True
+    loggerinst.info("Repository metadata downloaded. The yum calls will use the cached metadata.")
+
+
+class PkgCache(object):
+    """State of the packages in the yum/dnf cache.
+
+    The packages downloaded in advance by stage_rhel_pkgs() need to stay in the cache until all the yum calls after the
+    point of no return have installed them.
+    """
+
+    def __init__(self):
+        self.keep = False
+
+
+# Kinds of the problems found in the yum/dnf output by YumErrorParser
+YUM_PROBLEM_PROTECTED = "protected"
+YUM_PROBLEM_DEPENDENCY = "dependency"
+YUM_PROBLEM_MULTILIB = "multilib"
+YUM_PROBLEM_REQUIRES = "requires"
+YUM_PROBLEM_NOTHING_TO_DO = "nothing to do"
+
+# A problem found on a line of the yum/dnf output. The pkg_name is the name of the problematic package, None when the
+# problem is not related to a package or when the package name is not known (e.g. a library soname is required).
+YumProblem = namedtuple("YumProblem", ["kind", "pkg_name", "line"])
+
 
+class YumErrorParser(object):
+    """Line callback for utils.run_subprocess() classifying the problems reported by yum/dnf while the output streams.
+
+    Each line is matched just once, when yum/dnf prints it, so a failed transaction is diagnosed without scanning its
+    possibly huge output again. The problems are collected as YumProblem records in the order they were printed.
+
+    With a long yum output, utils.run_subprocess() returns just its tail. The error lines that did not fit into the
+    tail are put in front of it by prepend_dropped() so that the output still shows all the errors.
+    """
+
+    # yum: Error: Nothing to do, dnf: Nothing to do. Yum has nothing to do only when this is the last line of its
+    # output, not when the line is followed by other errors.
+    NOTHING_TO_DO_LINE_RE = re.compile(r"^(Error: )?Nothing to do")
+    # Evaluated in this order, the first matching pattern classifies the line
+    PATTERNS = [
+        # yum: Error: Trying to remove "systemd", which is protected
+        (YUM_PROBLEM_PROTECTED, re.compile(r'Error.*?"(?P<names>[^"]+)".*?protected')),
+        # dnf: The operation would result in removing the following protected packages: systemd, yum
+        (YUM_PROBLEM_PROTECTED, re.compile(r"removing the following protected packages: (?P<names>.+)")),
+        # yum: Error: Protected multilib versions: 2:p11-kit-0.18.7-1.fc19.i686 != p11-kit-0.18.3-1.fc19.x86_64
+        (YUM_PROBLEM_MULTILIB, re.compile(r"multilib versions: (?P<nevra>\S+)")),
+        # yum: Error: Package: libreport-anaconda-2.1.11-30.el7.x86_64 (rhel-7-server-rpms)
+        (YUM_PROBLEM_DEPENDENCY, re.compile(r"Error: Package: (?P<nevra>\S+)")),
+        # dnf:  Problem: package abrt-cli-2.1.11-34.el7.x86_64 requires libreport-plugin-rhtsupport >= 2.1.11-28, ...
+        (YUM_PROBLEM_DEPENDENCY, re.compile(r"[Pp]roblem.*?: package (?P<nevra>\S+) requires (?P<requires>[^\s,]+)")),
+        # yum:            Requires: libreport-plugin-rhtsupport = 2.1.11-30.el7
+        (YUM_PROBLEM_REQUIRES, re.compile(r"^\s*Requires: (?P<requires>[^\s,]+)")),
+        (YUM_PROBLEM_NOTHING_TO_DO, NOTHING_TO_DO_LINE_RE),
+    ]
+    # Lines kept by prepend_dropped() even when no problem is found on them
+    ERROR_LINE_RE = re.compile("Error")
+
+    def __init__(self):
+        self.problems = []
+        self._error_lines = []
+        self._line_count = 0
+        self._last_line = ""
+
+    def __call__(self, line):
+        self.feed(line)
+
+    def reset(self):
+        """Forget everything fed so far, e.g. before the yum command is run again."""
+        self.__init__()
+
+    def feed(self, line):
+        """Classify one line of the yum/dnf output."""
+        problems = self._parse_line(line)
+        if problems or self.ERROR_LINE_RE.search(line):
+            self._error_lines.append((self._line_count, line))
+        self.problems.extend(problems)
+        self._line_count += 1
+        if line.strip():
+            self._last_line = line
+
+    def _parse_line(self, line):
+        for kind, regex in self.PATTERNS:
+            match = regex.search(line)
+            if not match:
+                continue
+            groups = match.groupdict()
+            stripped_line = line.rstrip("\n")
+            if groups.get("names"):
+                return [YumProblem(kind, name.strip(), stripped_line) for name in groups["names"].split(",")]
+            problems = []
+            if groups.get("nevra"):
+                problems.append(YumProblem(kind, get_name_from_nevra(groups["nevra"]), stripped_line))
+            if groups.get("requires"):
+                problems.append(YumProblem(YUM_PROBLEM_REQUIRES, _get_required_pkg_name(groups["requires"]),
+                                           stripped_line))
+            return problems or [YumProblem(kind, None, stripped_line)]
+        return []
+
+    @property
+    def nothing_to_do(self):
+        """Whether the last non-empty line of the output says that yum/dnf had nothing to do."""
+        return bool(self.NOTHING_TO_DO_LINE_RE.match(self._last_line))
+
+    def prepend_dropped(self, output_tail):
+        tail_line_count = output_tail.count("\n")
+        if output_tail and not output_tail.endswith("\n"):
+            tail_line_count += 1
+        first_line_in_tail = self._line_count - tail_line_count
+        dropped = [line for index, line in self._error_lines if index < first_line_in_tail]
+        return "".join(dropped) + output_tail
+
+
+def parse_yum_errors(output):
+    """Return the YumProblems found in an already captured yum/dnf output."""
+    parser = YumErrorParser()
+    for line in output.splitlines(True):
+        parser.feed(line)
+    return parser.problems
+
+
+def get_name_from_nevra(nevra):
+    """Get the package name from a NEVRA as printed by yum or dnf, e.g. "2:p11-kit-0.18.7-1.fc19.i686" (yum) or
+    "p11-kit-2:0.18.7-1.fc19.i686" (dnf).
+    """
+    # The epoch is before the name in the yum format
+    nevra = nevra.split(":", 1)[1] if re.match(r"^\d+:", nevra) else nevra
+    # The name is everything before the version-release, and the name itself may contain dashes
+    return nevra.rsplit("-", 2)[0]
+
+
+_ARCH_QUALIFIED_RE = re.compile(r"^(?P<name>[^()]+)\((x86|aarch|ppc|s390)-(32|64)\)$")
+
+
+def _get_required_pkg_name(requires):
+    """Return the required capability if it can be a package name, None for files, sonames and other capabilities.
+
+    An arch-qualified package name, e.g. "libdnf(x86-64)", is returned without the arch.
+    """
+    arch_qualified = _ARCH_QUALIFIED_RE.match(requires)
+    if arch_qualified:
+        return arch_qualified.group("name")
+    if requires.startswith("/") or "(" in requires:
+        return None
+    return requires
+
+
+def get_problematic_pkgs(problems, known_problematic_pkgs):
+    """Return the known problematic packages extended by the packages causing the passed YumProblems."""
     loggerinst = logging.getLogger(__name__)
     loggerinst.info("\n\n")
-    protected = re.findall("Error.*?\"(.*?)\".*?protected",
-                           output, re.MULTILINE)
-    loggerinst.info("Found protected packages: %s" % protected)
-    deps = re.findall("Error: Package: %s" % package_nevr_re,
-                      output, re.MULTILINE)
-    loggerinst.info("Found deps packages: %s" % deps)
-    multilib = re.findall("multilib versions: %s" % package_nevr_re,
-                          output, re.MULTILINE)
-    loggerinst.info("Found multilib packages: %s" % multilib)
-    req = re.findall("Requires: ([a-z-]*)", output, re.MULTILINE)
-    loggerinst.info("Found req packages: %s" % req)
-
-    if protected + deps + multilib + req:
-        newpkg = list(set(protected + deps + multilib + req) -
-                      set(known_problematic_pkgs))
-        loggerinst.info("Adding packages to yum command: %s" % newpkg)
-        new_problematic_pkgs.extend(list(set(protected + deps + multilib + req)
-                                         - set(known_problematic_pkgs)))
+    new_problematic_pkgs = []
+    for kind in (YUM_PROBLEM_PROTECTED, YUM_PROBLEM_DEPENDENCY, YUM_PROBLEM_MULTILIB, YUM_PROBLEM_REQUIRES):
+        names = [problem.pkg_name for problem in problems if problem.kind == kind and problem.pkg_name]
+        loggerinst.info("Found %s packages: %s" % (kind, names))
+        for name in names:
+            if name not in known_problematic_pkgs and name not in new_problematic_pkgs:
+                new_problematic_pkgs.append(name)
+
+    if new_problematic_pkgs:
+        loggerinst.info("Adding packages to yum command: %s" % new_problematic_pkgs)
     return known_problematic_pkgs + new_problematic_pkgs
 
 
-def resolve_dep_errors(output, pkgs):
-    """Recursive function. If there are dependency errors in the yum output,
-    try to resolve them by yum downgrades.
+class DepErrorResolver(object):
+    """Resolver of the dependency problems reported by yum, trying to fix them by yum distro-sync of the problematic
+    packages.
+
+    The set of the problematic packages grows with each yum call as new problems are reported. Every set that has been
+    tried is remembered, so the resolution stops as soon as a yum call brings no new information, also across repeated
+    resolve() calls. Each set is first tried in a dry run (--assumeno) which only resolves the dependencies, and the
+    distro-sync is run for real only when the dry run reports no problem. The total number of the yum calls is capped.
     """
-    loggerinst = logging.getLogger(__name__)
 
-    prev_pkgs = pkgs
-    pkgs = get_problematic_pkgs(output, pkgs)
-    if set(prev_pkgs) == set(pkgs):
-        # No package has been added to the list of packages to be downgraded.
-        # There's no point in calling the yum downgrade command again.
-        loggerinst.info("No other package to try to downgrade in order to"
-                        " resolve yum dependency errors.")
-        return
+    def __init__(self, max_yum_calls=MAX_DEP_RESOLUTION_YUM_CALLS):
+        self.max_yum_calls = max_yum_calls
+        self.yum_calls = 0
+        self._attempted = set()
 
-    cmd = "distro-sync"
-    loggerinst.info("\n\nTrying to resolve the following packages: %s"
-                    % ", ".join(pkgs))
-    output, ret_code = call_yum_cmd(command=cmd, args=" %s" % " ".join(pkgs))
-    if ret_code != 0:
-        resolve_dep_errors(output, pkgs)
-    return
+    def resolve(self, problems, pkgs=None):
+        """Try to resolve the problems found in a yum output. Return True when a distro-sync succeeded."""
+        loggerinst = logging.getLogger(__name__)
+        pkgs = list(pkgs or [])
+        resolved = False
+        while True:
+            pkgs = get_problematic_pkgs(problems, pkgs)
+            if not pkgs or frozenset(pkgs) in self._attempted:
+                loggerinst.info("No other package to try to downgrade in order to"
+                                " resolve yum dependency errors.")
+                break
+            if self.yum_calls >= self.max_yum_calls:
+                loggerinst.warning("Reached the limit of %d yum calls for resolving the dependency errors."
+                                   % self.max_yum_calls)
+                break
+            self._attempted.add(frozenset(pkgs))
+
+            loggerinst.info("\n\nTrying to resolve the following packages: %s" % ", ".join(pkgs))
+            problems, nothing_to_do = self._distro_sync(pkgs, dry_run=True)
+            if nothing_to_do:
+                loggerinst.info("Yum has nothing to do with the packages.")
+                break
+            if problems:
+                # Resolving the dependencies failed, try again with the packages causing the new problems added
+                continue
+            problems, nothing_to_do = self._distro_sync(pkgs)
+            if not problems or nothing_to_do:
+                resolved = True
+                break
+
+        loggerinst.info("Resolving the dependency errors has taken %d yum call(s) so far." % self.yum_calls)
+        return resolved
+
+    def _distro_sync(self, pkgs, dry_run=False):
+        """Return the problems reported by the yum distro-sync and whether yum had nothing to do."""
+        self.yum_calls += 1
+        error_parser = YumErrorParser()
+        args = " ".join(pkgs)
+        if dry_run:
+            # Answering no ends yum right after resolving the dependencies, with a non-zero return code
+            args = "--assumeno " + args
+        _, ret_code = call_yum_cmd(command="distro-sync", args=args, error_parser=error_parser)
+        problems = [problem for problem in error_parser.problems if problem.kind != YUM_PROBLEM_NOTHING_TO_DO]
+        if not dry_run and ret_code != 0 and not problems:
+            # A failure not recognized by the parser, e.g. a file conflict found in the transaction check
+            problems = [YumProblem(None, None, "Return code %d" % ret_code)]
+        return problems, error_parser.nothing_to_do
+
+
+def resolve_dep_errors(problems, pkgs):
+    """If there are dependency problems found in the yum output, try to resolve them by yum downgrades."""
+    return DepErrorResolver().resolve(problems, pkgs)
 
 
 def get_installed_pkgs_by_fingerprint(fingerprints, name=""):
@@ -191,26 +537,521 @@ def get_installed_pkgs_by_fingerprint(fingerprints, name=""):
 
 
 def get_installed_pkgs_w_fingerprints(name=""):
-    """Return a list of objects, each holding one of the installed packages (yum.rpmsack.RPMInstalledPackage in case
-    of yum and hawkey.Package in case of dnf) and GPG key fingerprints used to sign it. The packages can be
-    optionally filtered by name.
+    """Return a list of objects, each holding one of the installed packages (as a PkgRecord) and GPG key fingerprints
+    used to sign it. The packages can be optionally filtered by name.
+
+    The packages are served from the in-memory snapshot of the installed packages which is read again only when the
+    rpm db changes.
+    """
+    return installed_pkgs_snapshot.get(name)
+
+
+def _read_installed_pkgs_w_fingerprints():
+    """Read all the installed packages and the fingerprints of the GPG keys used to sign them.
+
+    The fingerprints are taken from the persistent package inventory cache when the rpm db has not changed since it
+    was saved. Otherwise the signatures of all the packages are decoded.
     """
-    package_objects = get_installed_pkg_objects(name)
+    loggerinst = logging.getLogger(__name__)
+    rpmdb_state = get_rpmdb_state()
+    package_objects = get_installed_pkg_objects()
+    cached_fingerprints = pkgcache.pkg_inventory_cache.load(rpmdb_state)
+    # The index of the rpm db fingerprints is built upon the first package missing in the cache
+    rpmdb_fingerprints.clear()
+
+    keys = [pkgcache.get_pkg_key(pkg_obj) for pkg_obj in package_objects]
+    uncached_pkg_objects = [pkg_obj for pkg_obj, key in zip(package_objects, keys)
+                            if cached_fingerprints.get(key) is None]
+    decoded_fingerprints = iter(get_pkgs_fingerprints(uncached_pkg_objects))
+
     pkgs_w_fingerprints = []
-    for pkg_obj in package_objects:
-        fingerprint = get_pkg_fingerprint(pkg_obj)
-        pkgs_w_fingerprints.append(PkgWFingerprint(pkg_obj, fingerprint))
+    fingerprints_to_cache = {}
+    for pkg_obj, key in zip(package_objects, keys):
+        fingerprint = cached_fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = next(decoded_fingerprints)
+        if key:
+            fingerprints_to_cache[key] = fingerprint
+        pkgs_w_fingerprints.append(PkgWFingerprint(PkgRecord.from_pkg_obj(pkg_obj, fingerprint), fingerprint))
+
+    loggerinst.debug("Fingerprints of %d out of %d installed packages taken from the package inventory cache."
+                     % (len(pkgs_w_fingerprints) - len(uncached_pkg_objects), len(pkgs_w_fingerprints)))
+    pkgcache.pkg_inventory_cache.save(rpmdb_state, fingerprints_to_cache)
 
     return pkgs_w_fingerprints
 
 
+class InstalledPkgsSnapshot(object):
+    """In-memory snapshot of the installed packages together with the fingerprints they were signed with.
+
+    Getting the installed packages means setting up yum/dnf, reading the whole rpm db and decoding the signatures of
+    all the packages. The conversion asks for the installed packages many times, mostly with no change to the rpm db in
+    between, so we keep the packages in memory and read them again only when the rpm db has changed. That is detected
+    either through the state of the rpm db files or through an explicit invalidation after we install or remove
+    packages ourselves.
+    """
+
+    def __init__(self):
+        self._pkgs_w_fingerprints = None
+        self._rpmdb_state = None
+
+    def get(self, name=""):
+        """Return the installed packages, optionally filtered by a name glob (e.g. "kernel*")."""
+        rpmdb_state = get_rpmdb_state()
+        if self._pkgs_w_fingerprints is None or rpmdb_state != self._rpmdb_state:
+            loggerinst = logging.getLogger(__name__)
+            loggerinst.debug("Reading the installed packages from the rpm database.")
+            self._pkgs_w_fingerprints = _read_installed_pkgs_w_fingerprints()
+            self._rpmdb_state = rpmdb_state
+
+        if not name:
+            return list(self._pkgs_w_fingerprints)
+        # Same as the name__glob dnf query filter, a shell-style wildcard match on the package name
+        return [pkg for pkg in self._pkgs_w_fingerprints if fnmatch.fnmatchcase(pkg.pkg_obj.name, name)]
+
+    def invalidate(self):
+        """Drop the snapshot so that the installed packages are read again upon the next query."""
+        self._pkgs_w_fingerprints = None
+        self._rpmdb_state = None
+
+
+class PkgQuery(object):
+    """Read-only package queries answered in-process through the yum/dnf API.
+
+    Calling 'yum list' for a query means starting a new yum process which loads the repository metadata again, and
+    parsing its text output. Instead, the metadata of the repositories used by call_yum_cmd() is loaded into a single
+    package sack which is kept for the rest of the run. The sack is loaded again only when the set of repositories
+    changes. The installed packages are served from installed_pkgs_snapshot.
+
+    The results are lists of PkgRecords sorted by the name and from the oldest to the newest version, as compared by
+    rpm.
+    """
+
+    def __init__(self):
+        self._base = None
+        self._repos = None
+
+    def available(self, *names):
+        """Return all the versions of the packages available in the enabled repositories matching the name globs.
+
+        Return None when the repository metadata cannot be loaded.
+        """
+        base = self._get_base()
+        if base is None:
+            return None
+        if pkgmanager.TYPE == 'yum':
+            pkg_objs = base.pkgSack.returnPackages(patterns=list(names))
+        else:
+            pkg_objs = base.sack.query().available().filter(name__glob=list(names))
+        return self._to_records(pkg_objs)
+
+    def whatprovides(self, capability):
+        """Return the available packages providing the capability, e.g. a package name, a soname or a file path.
+
+        Return None when the repository metadata cannot be loaded.
+        """
+        base = self._get_base()
+        if base is None:
+            return None
+        if pkgmanager.TYPE == 'yum':
+            pkg_objs = base.pkgSack.searchProvides(capability)
+        else:
+            pkg_objs = base.sack.query().available().filter(provides=capability)
+        return self._to_records(pkg_objs)
+
+    @staticmethod
+    def installed(name=""):
+        """Return the installed packages, optionally filtered by a name glob."""
+        return sort_pkgs([pkg.pkg_obj for pkg in installed_pkgs_snapshot.get(name)])
+
+    def _get_base(self):
+        repos = _get_yum_cmd_repos()
+        repos = (tuple(repos[0]), tuple(repos[1]), system_info.releasever)
+        if self._base is None or repos != self._repos:
+            loggerinst = logging.getLogger(__name__)
+            loggerinst.debug("Loading the metadata of the enabled repositories.")
+            if self._base is not None:
+                _close_base(self._base)
+                self._base = None
+            try:
+                self._base = _load_repos(repos[0], repos[1])
+            except Exception as err:  # pylint: disable=broad-except
+                # yum and dnf raise their own exception types
+                loggerinst.warning("Unable to load the repository metadata: %s" % str(err))
+                self._base = None
+                return None
+            self._repos = repos
+        return self._base
+
+    @staticmethod
+    def _to_records(pkg_objs):
+        return sort_pkgs([PkgRecord(pkg_obj.name, str(pkg_obj.epoch), pkg_obj.version, pkg_obj.release, pkg_obj.arch,
+                                    vendor=getattr(pkg_obj, "vendor", None), packager=pkg_obj.packager,
+                                    from_repo=pkg_obj.repoid)
+                          for pkg_obj in pkg_objs])
+
+
+def _load_repos(repos_to_disable, repos_to_enable, reposdir=None, set_releasever=True):
+    """Return a yum/dnf base object with the metadata of the repos enabled the same way as by call_yum_cmd().
+
+    The repos are read from the reposdir directory instead of the system one when it is passed.
+    """
+    cached_metadata = repo_metadata.warm
+    releasever = system_info.releasever if set_releasever else None
+    if pkgmanager.TYPE == 'yum':
+        yum_base = pkgmanager.YumBase()
+        # Disable plugins (when kept enabled yum outputs useless text every call)
+        yum_base.preconf.init_plugins = False
+        if releasever:
+            yum_base.preconf.releasever = releasever
+        if reposdir:
+            yum_base.conf.reposdir = [reposdir]
+        for repo in repos_to_disable:
+            yum_base.repos.disableRepo(repo)
+        for repo in repos_to_enable:
+            yum_base.repos.enableRepo(repo)
+        if cached_metadata:
+            for repo in yum_base.repos.listEnabled():
+                repo.metadata_expire = -1
+        # Loads the metadata
+        yum_base.pkgSack  # pylint: disable=pointless-statement
+        return yum_base
+
+    dnf_base = pkgmanager.Base()
+    # The configuration from /etc/dnf/dnf.conf, e.g. the proxy or the excluded packages, is not read by default
+    dnf_base.conf.read()
+    dnf_base.conf.module_platform_id = "platform:el8"
+    if releasever:
+        dnf_base.conf.substitutions["releasever"] = releasever
+    if reposdir:
+        dnf_base.conf.reposdir = [reposdir]
+    dnf_base.read_all_repos()
+    for repo_glob in repos_to_disable:
+        for repo in dnf_base.repos.get_matching(repo_glob):
+            repo.disable()
+    for repo_glob in repos_to_enable:
+        for repo in dnf_base.repos.get_matching(repo_glob):
+            repo.enable()
+    if cached_metadata:
+        for repo in dnf_base.repos.iter_enabled():
+            repo.metadata_expire = -1
+    dnf_base.fill_sack(load_system_repo=False, load_available_repos=True)
+    return dnf_base
+
+
+def download_pkgs_in_process(pkgs, dest, reposdir=None, enable_repos=None, disable_repos=None, set_releasever=True):
+    """Download the newest available versions of the packages through the yum/dnf API.
+
+    Unlike calling yumdownloader, the packages are downloaded by the package manager of this process, all of them in
+    one go over reused connections (and in parallel with dnf), with their checksums verified against the repository
+    metadata. The package specs are matched the same way as in utils.get_rpm_paths_by_pkg(). The arguments have the
+    same meaning as for utils.download_pkg().
+
+    The yum plugins are not loaded, so the packages from the repositories provided by plugins (e.g. ULN or Spacewalk)
+    are not found in-process. The package specs not found are passed to yumdownloader instead.
+
+    Return a dictionary with a DownloadResult for each of the package specs, or None when the repository metadata
+    cannot be loaded.
+    """
+    loggerinst = logging.getLogger(__name__)
+    loggerinst.debug("Downloading the %s package(s)." % ", ".join(pkgs))
+    try:
+        base = _load_repos(disable_repos or [], enable_repos or [], reposdir, set_releasever)
+    except Exception as err:  # pylint: disable=broad-except
+        # yum and dnf raise their own exception types
+        loggerinst.warning("Unable to load the repository metadata: %s" % str(err))
+        return None
+    try:
+        results = _download_pkgs_w_base(base, pkgs, dest)
+    finally:
+        _close_base(base)
+
+    unavailable = [pkg for pkg in pkgs if results[pkg] is None]
+    fallback_paths = {}
+    if unavailable:
+        loggerinst.debug("The %s package(s) not found in-process, trying yumdownloader." % ", ".join(unavailable))
+        fallback_paths = utils.download_pkgs_w_yumdownloader(unavailable, dest, reposdir, enable_repos, disable_repos,
+                                                             set_releasever)
+    for pkg in unavailable:
+        # The packages failing to be downloaded have been reported by the yumdownloader call already
+        results[pkg] = DownloadResult(pkg, fallback_paths[pkg], None if fallback_paths[pkg]
+                                      else "No package %s available." % pkg)
+    return results
+
+
+def _download_pkgs_w_base(base, pkgs, dest):
+    """Download the packages using the yum/dnf base object, see download_pkgs_in_process().
+
+    Return a dictionary with a DownloadResult for each of the package specs, None for the specs matching no available
+    package.
+    """
+    loggerinst = logging.getLogger(__name__)
+    pkg_objs = _find_pkgs_to_download(base, pkgs)
+    utils.mkdir_p(dest)
+    # The packages already in the package store are hardlinked from there instead of being downloaded
+    paths = {}
+    to_download = []
+    for pkg in pkgs:
+        pkg_obj = pkg_objs[pkg]
+        if pkg_obj is None or pkg_obj in paths or pkg_obj in to_download:
+            continue
+        stored_path = pkgstore.pkg_store.get(_get_pkg_key(pkg_obj), _get_pkg_filename(pkg_obj),
+                                             tool_opts.pkg_store_seed)
+        if stored_path:
+            loggerinst.debug("Using %s from the package store." % _get_pkg_filename(pkg_obj))
+            try:
+                paths[pkg_obj] = pkgstore.link(stored_path, dest, _get_pkg_filename(pkg_obj))
+                continue
+            except (IOError, OSError) as err:
+                loggerinst.debug("Unable to link %s from the package store, downloading it: %s"
+                                 % (_get_pkg_filename(pkg_obj), str(err)))
+        to_download.append(pkg_obj)
+
+    errors = {}
+    downloaded = {}
+    if pkgmanager.TYPE == 'yum':
+        for pkg_obj in to_download:
+            pkg_obj.localpath = os.path.join(dest, _get_pkg_filename(pkg_obj))
+        # Verifies the checksums and returns the errors keyed by the package objects
+        errors = base.downloadPkgs(to_download) if to_download else {}
+        downloaded = dict([(pkg_obj, pkg_obj.localpath) for pkg_obj in to_download if pkg_obj not in errors])
+    elif to_download:
+        try:
+            base.download_packages(to_download)
+        except Exception as err:  # pylint: disable=broad-except
+            # dnf.exceptions.DownloadError, with the errors of all the packages failing to be downloaded
+            errors = getattr(err, "errmap", {})
+            loggerinst.debug("Error downloading the packages: %s" % str(err))
+        # The packages are downloaded into the dnf cache, with verified checksums
+        downloaded = dict([(pkg_obj, pkg_obj.localPkg()) for pkg_obj in to_download
+                           if os.path.exists(pkg_obj.localPkg()) and pkg_obj.verifyLocalPkg()])
+    for pkg_obj, path in downloaded.items():
+        stored_path = pkgstore.pkg_store.add(path, _get_pkg_key(pkg_obj))
+        try:
+            paths[pkg_obj] = pkgstore.link(stored_path or path, dest, _get_pkg_filename(pkg_obj))
+        except (IOError, OSError) as err:
+            loggerinst.debug("Unable to link %s into %s, using the downloaded file: %s"
+                             % (_get_pkg_filename(pkg_obj), dest, str(err)))
+            paths[pkg_obj] = path
+    if downloaded:
+        pkgstore.pkg_store.evict()
+
+    results = {}
+    for pkg in pkgs:
+        pkg_obj = pkg_objs[pkg]
+        if pkg_obj is None:
+            results[pkg] = None
+        elif pkg_obj in paths:
+            results[pkg] = DownloadResult(pkg, paths[pkg_obj], None)
+            loggerinst.info("Successfully downloaded the %s package." % pkg)
+            loggerinst.debug("Path of the downloaded package: %s" % paths[pkg_obj])
+        else:
+            error = errors.get(pkg_obj) or "Download failed."
+            results[pkg] = DownloadResult(pkg, None, error if isinstance(error, str) else "\n".join(error))
+            loggerinst.warning("Couldn't download the %s package: %s" % (pkg, results[pkg].error))
+    return results
+
+
+def _close_base(base):
+    """Release the resources held by the yum/dnf base object, e.g. the open rpmdb and the repository metadata."""
+    loggerinst = logging.getLogger(__name__)
+    try:
+        base.close()
+    except Exception as err:  # pylint: disable=broad-except
+        loggerinst.debug("Unable to close the %s base: %s" % (pkgmanager.TYPE, str(err)))
+
+
+def _get_pkg_key(pkg_obj):
+    checksum_type, checksum = pkg_obj.returnIdSum()
+    nevra = "%s-%s:%s-%s.%s" % (pkg_obj.name, pkg_obj.epoch or 0, pkg_obj.version, pkg_obj.release, pkg_obj.arch)
+    return pkgstore.PkgKey(nevra, checksum_type, checksum)
+
+
+def _get_pkg_filename(pkg_obj):
+    return os.path.basename(pkg_obj.remote_path if pkgmanager.TYPE == 'yum' else pkg_obj.location)
+
+
+def _find_pkgs_to_download(base, pkgs):
+    """Return the best available package object for each of the package specs, None for the unavailable ones.
+
+    Out of the packages matching a spec, the newest one of the system architecture (or noarch) is preferred.
+    """
+    names = set()
+    for pkg in pkgs:
+        # Possible package names in the "name", "name-version", "name-version-release[.arch]", "name.arch" and
+        # "[epoch:]name-[epoch:]version-release.arch" specs
+        parts = re.sub(r"^\d+:", "", pkg).split("-")
+        for i in range(1, len(parts) + 1):
+            names.add("-".join(parts[:i]))
+            names.add("-".join(parts[:i]).rsplit(".", 1)[0])
+    if pkgmanager.TYPE == 'yum':
+        available = base.pkgSack.returnPackages(patterns=sorted(names))
+    else:
+        available = base.sack.query().available().filter(name=sorted(names))
+
+    pkg_objs = {}
+    for pkg in pkgs:
+        matching = [pkg_obj for pkg_obj in available
+                    if pkg in utils.get_pkg_labels(pkg_obj.name, str(pkg_obj.epoch), pkg_obj.version, pkg_obj.release,
+                                                   pkg_obj.arch)]
+        preferred = [pkg_obj for pkg_obj in matching if pkg_obj.arch in (system_info.arch, "noarch")]
+        candidates = sort_pkgs(preferred or matching)
+        pkg_objs[pkg] = candidates[-1] if candidates else None
+    return pkg_objs
+
+
+class _EVRSortKey(object):
+    """Sort key ordering packages by the name, the epoch, version and release the way rpm does, and the arch."""
+
+    __slots__ = ["pkg"]
+
+    def __init__(self, pkg):
+        self.pkg = pkg
+
+    def __lt__(self, other):
+        if self.pkg.name != other.pkg.name:
+            return self.pkg.name < other.pkg.name
+        evr_cmp = compare_evr(self.pkg, other.pkg)
+        if evr_cmp:
+            return evr_cmp < 0
+        return self.pkg.arch < other.pkg.arch
+
+
+def sort_pkgs(pkgs):
+    """Return the packages sorted by the name and from the oldest to the newest version."""
+    return sorted(pkgs, key=_EVRSortKey)
+
+
+# Files holding the installed packages in the rpm db - Berkeley DB (RHEL 6-8), NDB and SQLite (newer rpm). Other files
+# in the rpm db directory, like the Berkeley DB environment files, change even when the rpm db is just read.
+_RPMDB_PKG_FILES = ["Packages", "Packages.db", "rpmdb.sqlite", "rpmdb.sqlite-wal"]
+
+
+def get_rpmdb_state():
+    """Return an identifier of the current state of the rpm db.
+
+    The identifier is made of the inode, size and modification time of the rpm db files holding the installed
+    packages. Any package installation or removal changes it.
+    """
+    dbpath = rpm.expandMacro("%{_dbpath}")
+    state = []
+    for filename in _RPMDB_PKG_FILES:
+        try:
+            stat = os.stat(os.path.join(dbpath, filename))
+        except OSError:
+            continue
+        state.append((filename, stat.st_ino, stat.st_size, stat.st_mtime))
+    return tuple(state)
+
+
 def get_pkg_fingerprint(pkg_obj):
     """Get fingerprint of the key used to sign a package"""
     if pkgmanager.TYPE == 'yum':
-        hdr = pkg_obj.hdr
+        return get_hdr_fingerprint(pkg_obj.hdr)
     elif pkgmanager.TYPE == 'dnf':
-        hdr = get_rpm_header(pkg_obj)
+        return rpmdb_fingerprints.get(pkg_obj)
 
+
+def get_pkgs_fingerprints(pkg_objs):
+    """Get fingerprints of the keys used to sign the packages, in the order of the passed package objects."""
+    if pkgmanager.TYPE == 'yum':
+        return get_hdrs_fingerprints([pkg_obj.hdr for pkg_obj in pkg_objs])
+    return [get_pkg_fingerprint(pkg_obj) for pkg_obj in pkg_objs]
+
+
+# Header tags holding the package signatures, in the order of preference. The header-only signatures (DSAHEADER,
+# RSAHEADER) are preferred, the header+payload ones (SIGGPG, SIGPGP) are present alone in packages signed by old rpm.
+_SIGNATURE_TAGS = [rpm.RPMTAG_DSAHEADER, rpm.RPMTAG_RSAHEADER, rpm.RPMTAG_SIGGPG, rpm.RPMTAG_SIGPGP]
+
+
+# Number of signatures from which it pays off to decode them in multiple processes. Below that, starting the worker
+# processes and passing the signatures to them takes longer than decoding the signatures serially.
+PARALLEL_DECODING_MIN_SIGS = 4000
+
+
+def get_hdr_fingerprint(hdr):
+    """Get fingerprint of the key used to sign a package from its rpm header.
+
+    The key ID is read directly from the OpenPGP signature packet stored in the header. Only in case the packet is not
+    in one of the common formats, we let rpm format the signature and we get the key ID from the text.
+    """
+    sig = get_hdr_sig(hdr)
+    if not sig:
+        return "none"
+    return get_sig_key_id(sig) or _get_hdr_fingerprint_from_sprintf(hdr)
+
+
+def get_hdrs_fingerprints(hdrs):
+    """Get fingerprints of the keys used to sign packages from their rpm headers.
+
+    Same as get_hdr_fingerprint() for each of the headers, only the signatures are decoded in parallel in case there is
+    a lot of them.
+    """
+    sigs = [get_hdr_sig(hdr) for hdr in hdrs]
+    fingerprints = []
+    for hdr, sig, key_id in zip(hdrs, sigs, decode_sigs(sigs)):
+        if not sig:
+            fingerprints.append("none")
+        else:
+            fingerprints.append(key_id or _get_hdr_fingerprint_from_sprintf(hdr))
+    return fingerprints
+
+
+def get_hdr_sig(hdr):
+    """Return the raw OpenPGP signature packet from the rpm header, or None for an unsigned package."""
+    for tag in _SIGNATURE_TAGS:
+        sig = hdr[tag]
+        if sig:
+            return sig
+    return None
+
+
+def decode_sigs(sigs, processes=None):
+    """Get the key IDs from a list of raw signature packets using get_sig_key_id().
+
+    With many signatures to decode, the work is split across worker processes, one per CPU by default. The decoding
+    is done serially on single CPU systems, for a small number of signatures or when the worker processes cannot be
+    started.
+
+    Return a list of the key IDs in the order of the passed signatures, with None for missing or undecodable ones.
+    """
+    if processes is None:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    if processes <= 1 or len(sigs) < PARALLEL_DECODING_MIN_SIGS:
+        return _decode_sigs_chunk(sigs)
+
+    # Contiguous chunks so that the results can be simply concatenated in the original order
+    chunk_size = len(sigs) // processes + 1
+    chunks = [sigs[i:i + chunk_size] for i in range(0, len(sigs), chunk_size)]
+    loggerinst = logging.getLogger(__name__)
+    try:
+        pool = multiprocessing.Pool(processes)
+    except (OSError, ImportError) as err:
+        # E.g. no /dev/shm available in a container
+        loggerinst.debug("Unable to start processes for decoding the package signatures: %s" % err)
+        return _decode_sigs_chunk(sigs)
+    try:
+        results = pool.map(_decode_sigs_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    loggerinst.debug("Signatures of %d packages decoded in %d processes." % (len(sigs), len(chunks)))
+
+    key_ids = []
+    for result in results:
+        key_ids.extend(result)
+    return key_ids
+
+
+def _decode_sigs_chunk(sigs):
+    # Executed in the worker processes, hence a module level function
+    return [get_sig_key_id(sig) if sig else None for sig in sigs]
+
+
+def _get_hdr_fingerprint_from_sprintf(hdr):
     pkg_sig = hdr.sprintf(
         '%|DSAHEADER?{%{DSAHEADER:pgpsig}}:{%|RSAHEADER?{%{RSAHEADER:pgpsig}}:{(none)}|}|')
     fingerprint_match = re.search("Key ID (.*)", pkg_sig)
@@ -220,24 +1061,170 @@ def get_pkg_fingerprint(pkg_obj):
         return "none"
 
 
-def get_rpm_header(pkg_obj):
-    """The dnf python API does not provide the package rpm header:
-      https://bugzilla.redhat.com/show_bug.cgi?id=1876606.
-    So instead, we're getting the header directly from the rpm db.
+def _read_pgp_length(data, pos):
+    """Read a new format OpenPGP packet or subpacket length (RFC 4880, 4.2.2 and 5.2.3.1).
+
+    Return a tuple with the length and the position of the data following the length, or None for the partial body
+    lengths which we don't support.
+    """
+    first = data[pos]
+    if first < 192:
+        return first, pos + 1
+    if first < 224:
+        return ((first - 192) << 8) + data[pos + 1] + 192, pos + 2
+    if first == 255:
+        return (data[pos + 1] << 24) | (data[pos + 2] << 16) | (data[pos + 3] << 8) | data[pos + 4], pos + 5
+    return None
+
+
+def get_sig_key_id(sig):
+    """Get the ID of the key which made an OpenPGP signature (RFC 4880, 5.2).
+
+    The sig parameter holds the raw signature packet as stored in the rpm header. Return the key ID as a lowercase
+    hexadecimal string, the same way rpm prints it, or None when the packet is not a V3 signature or a V4 signature with
+    an issuer subpacket.
     """
-    ts = rpm.TransactionSet()
-    rpm_hdr_iter = ts.dbMatch('name', pkg_obj.name)
-    for rpm_hdr in rpm_hdr_iter:
-        # There might be multiple pkgs with the same name installed.
-        if rpm_hdr[rpm.RPMTAG_VERSION] == pkg_obj.v and rpm_hdr[rpm.RPMTAG_RELEASE] == pkg_obj.r:
-            # One might think that we could have used the package EVR for comparison, instead of version and release
+    data = bytearray(sig)
+    try:
+        # Packet header
+        ptag = data[0]
+        if not ptag & 0x80:
+            return None
+        if ptag & 0x40:
+            # New format packet
+            tag = ptag & 0x3f
+            length = _read_pgp_length(data, 1)
+            if not length:
+                return None
+            body_len, pos = length
+        else:
+            # Old format packet
+            tag = (ptag >> 2) & 0x0f
+            length_type = ptag & 0x03
+            if length_type == 3:
+                body_len, pos = len(data) - 1, 1
+            else:
+                len_bytes = 1 << length_type
+                body_len = 0
+                for i in range(len_bytes):
+                    body_len = (body_len << 8) | data[1 + i]
+                pos = 1 + len_bytes
+        if tag != 2 or pos + body_len > len(data):
+            # Not a signature packet or a truncated one
+            return None
+        body = data[pos:pos + body_len]
+
+        version = body[0]
+        if version == 3:
+            # Version, length of the hashed material (always 5), signature type, creation time, key ID
+            if body[1] != 5:
+                return None
+            return _to_hex(body[7:15])
+        if version == 4:
+            # Version, signature type, public key algorithm, hash algorithm, hashed subpackets, unhashed subpackets
+            hashed_len = (body[4] << 8) | body[5]
+            hashed_end = 6 + hashed_len
+            unhashed_len = (body[hashed_end] << 8) | body[hashed_end + 1]
+            key_id = _find_issuer_subpacket(body, 6, hashed_end)
+            if not key_id:
+                key_id = _find_issuer_subpacket(body, hashed_end + 2, hashed_end + 2 + unhashed_len)
+            return key_id
+    except IndexError:
+        # Malformed packet
+        return None
+    return None
+
+
+def _find_issuer_subpacket(body, pos, end):
+    """Return the key ID from the issuer subpacket (type 16) within the body[pos:end] subpacket area."""
+    while pos < end:
+        length = _read_pgp_length(body, pos)
+        if not length:
+            return None
+        subpacket_len, pos = length
+        # The highest bit of the subpacket type is the "critical" flag
+        if body[pos] & 0x7f == 16 and subpacket_len == 9:
+            return _to_hex(body[pos + 1:pos + 9])
+        pos += subpacket_len
+    return None
+
+
+def _to_hex(data):
+    return "".join(["%02x" % byte for byte in data])
+
+
+class RpmDbFingerprints(object):
+    """Fingerprints of the keys used to sign the installed packages, read in a single pass over the rpm database.
+
+    The dnf python API does not provide the package rpm header: https://bugzilla.redhat.com/show_bug.cgi?id=1876606.
+    So instead, we're getting the header directly from the rpm db. Opening the rpm db and querying it for every single
+    package is slow on systems with thousands of packages installed, so we iterate over all the headers once and keep
+    just the fingerprints, indexed by the package name, version, release and architecture.
+    """
+
+    def __init__(self):
+        self._index = None
+
+    def build(self):
+        """Read all the headers from the rpm db and index the fingerprints found in them.
+
+        Only the package identification and the raw signature are kept from each header, the signatures are decoded
+        all at once afterwards, possibly in parallel.
+        """
+        self._index = {}
+        ts = rpm.TransactionSet()
+        entries = []
+        for rpm_hdr in ts.dbMatch():
+            # One might think that we could have used the package EVR for the key, instead of version and release
             #  separately, but there's a bug: https://bugzilla.redhat.com/show_bug.cgi?id=1876885.
-            return rpm_hdr
-    else:
-        # Package not found in the rpm db
-        loggerinst = logging.getLogger(__name__)
-        loggerinst.critical(
-            "Unable to find package '%s' in the rpm database." % pkg_obj.name)
+            key = (rpm_hdr[rpm.RPMTAG_NAME], rpm_hdr[rpm.RPMTAG_VERSION], rpm_hdr[rpm.RPMTAG_RELEASE])
+            entries.append((key, rpm_hdr[rpm.RPMTAG_ARCH], get_hdr_sig(rpm_hdr)))
+
+        key_ids = decode_sigs([sig for _, _, sig in entries])
+        for (key, arch, sig), key_id in zip(entries, key_ids):
+            if not sig:
+                fingerprint = "none"
+            elif key_id:
+                fingerprint = key_id
+            else:
+                # A signature packet not known to get_sig_key_id(), let rpm format it
+                fingerprint = self._get_fingerprint_from_rpmdb(ts, key, arch)
+            self._index.setdefault(key, []).append((arch, fingerprint))
+
+    @staticmethod
+    def _get_fingerprint_from_rpmdb(ts, key, arch):
+        name, version, release = key
+        for rpm_hdr in ts.dbMatch('name', name):
+            if (rpm_hdr[rpm.RPMTAG_VERSION] == version and rpm_hdr[rpm.RPMTAG_RELEASE] == release
+                    and rpm_hdr[rpm.RPMTAG_ARCH] == arch):
+                return get_hdr_fingerprint(rpm_hdr)
+        return "none"
+
+    def clear(self):
+        self._index = None
+
+    def get(self, pkg_obj):
+        """Return the fingerprint of the key used to sign the package.
+
+        The index is (re)built when the package is not in it, e.g. in case it has been installed after the index
+        had been built.
+        """
+        key = (pkg_obj.name, pkg_obj.version, pkg_obj.release)
+        if self._index is None or key not in self._index:
+            self.build()
+        if key not in self._index:
+            # Package not found in the rpm db
+            loggerinst = logging.getLogger(__name__)
+            loggerinst.critical(
+                "Unable to find package '%s' in the rpm database." % pkg_obj.name)
+
+        # There might be multiple pkgs with the same name, version and release installed, differing in the arch only.
+        # Some packages, like gpg-pubkey, have no arch in the rpm db though, so we don't require the arch to match.
+        entries = self._index[key]
+        for arch, fingerprint in entries:
+            if arch == pkg_obj.arch:
+                return fingerprint
+        return entries[0][1]
 
 
 def get_installed_pkg_objects(name=""):
@@ -283,8 +1270,7 @@ def get_third_party_pkgs():
 
 
 def get_installed_pkgs_w_different_fingerprint(fingerprints, name=""):
-    """Return list of all the packages (yum.rpmsack.RPMInstalledPackage objects in case
-    of yum and hawkey.Package objects in case of dnf) that are not signed
+    """Return list of all the packages (PkgRecord objects) that are not signed
     by the specific OS GPG keys. Fingerprints of the GPG keys are passed as a
     list in the fingerprints parameter. The packages can be optionally
     filtered by name.
@@ -299,6 +1285,37 @@ def get_installed_pkgs_w_different_fingerprint(fingerprints, name=""):
             pkg.pkg_obj.name != "gpg-pubkey"]
 
 
+class PkgNameMatcher(object):
+    """Matcher of package names against multiple shell-style wildcard patterns (e.g. "rhn*") at once.
+
+    The patterns are compiled into a single regular expression which rejects the names not matching any of the
+    patterns in one go. Only the matching names are then checked against the individual patterns.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        translated = [fnmatch.translate(pattern) for pattern in self.patterns]
+        self._pattern_regexes = [re.compile(regex) for regex in translated]
+        self._any_regex = re.compile("|".join(["(?:%s)" % regex for regex in translated])) if translated else None
+
+    def match(self, name):
+        """Return the patterns the name matches, in the order the patterns were passed."""
+        if not self._any_regex or not self._any_regex.match(name):
+            return []
+        return [pattern for pattern, regex in zip(self.patterns, self._pattern_regexes) if regex.match(name)]
+
+    def classify(self, pkg_objects):
+        """Sort the package objects by the patterns their names match.
+
+        Return a dictionary with each of the patterns as a key and a list of the matching package objects as a value.
+        """
+        pkg_objects_per_pattern = dict((pattern, []) for pattern in self.patterns)
+        for pkg_obj in pkg_objects:
+            for pattern in self.match(pkg_obj.name):
+                pkg_objects_per_pattern[pattern].append(pkg_obj)
+        return pkg_objects_per_pattern
+
+
 def list_third_party_pkgs():
     """List packages not packaged by the original OS vendor or Red Hat and warn that these are not going
     to be converted.
@@ -320,7 +1337,7 @@ def print_pkg_info(pkgs):
     """Print package information."""
     max_nvra_length = max(map(len, [get_pkg_nvra(pkg) for pkg in pkgs]))
     max_packager_length = max(
-        max(map(len, [get_vendor(pkg) if hasattr(pkg, "vendor") else get_packager(pkg) for pkg in pkgs])),
+        max(map(len, [get_vendor(pkg) if _has_vendor(pkg) else get_packager(pkg) for pkg in pkgs])),
         len("Vendor/Packager"))
 
     header = "%-*s  %-*s  %s" % (max_nvra_length, "Package", max_packager_length,
@@ -331,21 +1348,10 @@ def print_pkg_info(pkgs):
 
     pkg_list = ""
     for pkg in pkgs:
-        if pkgmanager.TYPE == 'yum':
-            try:
-                from_repo = pkg.yumdb_info.from_repo
-            except AttributeError:
-                # A package may not have the installation repo set in case it was installed through rpm
-                from_repo = "N/A"
-
-        elif pkgmanager.TYPE == 'dnf':
-            # There's no public attribute for getting the installation repository.
-            # Bug filed: https://bugzilla.redhat.com/show_bug.cgi?id=1879168
-            from_repo = pkg._from_repo
-
+        from_repo = pkg.from_repo if isinstance(pkg, PkgRecord) else get_pkg_from_repo(pkg)
         pkg_list += "%-*s  %-*s  %s" % (max_nvra_length, get_pkg_nvra(pkg),
                                         max_packager_length,
-                                        get_vendor(pkg) if hasattr(pkg, "vendor") else get_packager(pkg),
+                                        get_vendor(pkg) if _has_vendor(pkg) else get_packager(pkg),
                                         from_repo) + "\n"
 
     pkg_table = header + header_underline + pkg_list
@@ -354,6 +1360,26 @@ def print_pkg_info(pkgs):
     return pkg_table
 
 
+def _has_vendor(pkg_obj):
+    # The vendor is not provided by dnf on RHEL 8.0-8.3 derived systems, see get_vendor()
+    return getattr(pkg_obj, "vendor", None) is not None
+
+
+def get_pkg_from_repo(pkg_obj):
+    """Get the ID of the repository the package was installed from, using the yum/dnf package object."""
+    if pkgmanager.TYPE == 'yum':
+        try:
+            return pkg_obj.yumdb_info.from_repo
+        except AttributeError:
+            # A package may not have the installation repo set in case it was installed through rpm
+            return "N/A"
+
+    elif pkgmanager.TYPE == 'dnf':
+        # There's no public attribute for getting the installation repository.
+        # Bug filed: https://bugzilla.redhat.com/show_bug.cgi?id=1879168
+        return pkg_obj._from_repo
+
+
 def get_pkg_nvra(pkg_obj):
     """Get package NVRA as a string: name, version, release, architecture.
 
@@ -387,7 +1413,7 @@ def get_pkg_nevra(pkg_obj):
 
 
 def get_packager(pkg_obj):
-    """Get the package packager from the yum/dnf package object.
+    """Get the package packager from the yum/dnf package object or a PkgRecord.
 
     The packager may not be set for all packages. E.g. Oracle Linux packages have the packager info empty.
     """
@@ -400,7 +1426,7 @@ def get_packager(pkg_obj):
 
 
 def get_vendor(pkg_obj):
-    """Get the package vendor from the yum/dnf package object.
+    """Get the package vendor from the yum/dnf package object or a PkgRecord.
     
     The vendor information is provided by the yum/dnf python API on all systems except systems derived from
     RHEL 8.0-8.3 (see bug https://bugzilla.redhat.com/show_bug.cgi?id=1876561).
@@ -455,10 +1481,14 @@ def remove_pkgs_with_confirm(pkgs, backup=True):
     """
     pkgs_to_remove = []
     loggerinst = logging.getLogger(__name__)
+    # Classify all the installed packages against all the patterns at once instead of querying them per pattern
+    pkg_objects_per_pattern = PkgNameMatcher(pkgs).classify(
+        get_installed_pkgs_w_different_fingerprint(system_info.fingerprints_rhel))
     for pkg in pkgs:
         temp = '.' * (50 - len(pkg) - 2)
-        pkg_objects = get_installed_pkgs_w_different_fingerprint(system_info.fingerprints_rhel, pkg)
-        pkgs_to_remove.extend(pkg_objects)
+        pkg_objects = pkg_objects_per_pattern[pkg]
+        # A package matching multiple patterns is removed just once
+        pkgs_to_remove.extend([pkg_obj for pkg_obj in pkg_objects if pkg_obj not in pkgs_to_remove])
         loggerinst.info("%s %s %s" %
                         (pkg, temp, str(len(pkg_objects))))
 
@@ -474,14 +1504,49 @@ def remove_pkgs_with_confirm(pkgs, backup=True):
 
 
 def replace_non_red_hat_packages():
+    """Replace the non-Red Hat packages with the Red Hat ones.
+
+    The replacement of all the packages is planned up front and run as a single yum transaction. Only in case the plan
+    cannot be made or the transaction fails, the packages are replaced by separate yum update, reinstall and
+    distro-sync calls which are able to resolve dependency errors.
+    """
+    loggerinst = logging.getLogger(__name__)
+
+    plan = plan_replacement(get_pkgs_to_replace())
+    if plan is None:
+        loggerinst.info("Unable to plan the replacement of the %s packages." % system_info.name)
+    else:
+        print_replacement_plan(plan)
+        if not plan:
+            return
+        ret_code = run_replacement_plan(plan)
+        planned = set([action.installed.name for action in plan])
+        not_replaced = [name for name in get_installed_pkgs_by_fingerprint(system_info.fingerprints_orig_os)
+                        if name in planned]
+        if ret_code == 0 and not not_replaced:
+            return
+        loggerinst.warning("Unable to replace all the %s packages in a single transaction." % system_info.name)
+
+    replace_non_red_hat_packages_separately()
+
+
+def get_pkgs_to_replace():
+    """Return the package objects of the installed packages to be replaced by the Red Hat ones.
+
+    These are the packages signed by the original OS vendor, including the subscription-manager packages installed
+    from the original OS repositories. The subscription-manager packages installed from the downloaded rpms, see
+    subscription.download_rhsm_pkgs(), are left as they are.
+    """
+    return [pkg.pkg_obj for pkg in get_installed_pkgs_w_fingerprints()
+            if pkg.fingerprint in system_info.fingerprints_orig_os]
+
+
+def replace_non_red_hat_packages_separately():
     """Wrapper for yum commands that replace the non-Red Hat packages with
     the Red Hat ones.
     """
     loggerinst = logging.getLogger(__name__)
 
-    # TODO: run yum commands with --assumeno first and show the user what will
-    # be done and then ask if we should continue the operation
-
     loggerinst.info(
         "Performing update of the %s packages ..." % system_info.name)
     call_yum_cmd_w_downgrades("update", system_info.fingerprints_orig_os)
@@ -497,6 +1562,138 @@ def replace_non_red_hat_packages():
     call_yum_cmd_w_downgrades(cmd, system_info.fingerprints_orig_os)
 
 
+def plan_replacement(pkgs):
+    """Plan the replacement of the passed installed packages by the packages available in the enabled repositories.
+
+    Each of the packages is updated to the newest available version if it's newer than the installed one, reinstalled
+    if the same version is available and downgraded to the newest available version otherwise, the same as the
+    separate yum update, reinstall and distro-sync calls would do. Packages without any version available are left
+    out of the plan. Return a list of PlannedAction, or None when the available packages cannot be listed.
+    """
+    names = sorted(set([pkg.name for pkg in pkgs]))
+    if not names:
+        return []
+    available_pkgs = pkg_query.available(*names)
+    if available_pkgs is None:
+        return None
+    available = {}
+    for available_pkg in available_pkgs:
+        available.setdefault(available_pkg.name, []).append(available_pkg)
+
+    plan = []
+    for pkg in pkgs:
+        candidates = [candidate for candidate in available.get(pkg.name, [])
+                      if candidate.arch == pkg.arch or "noarch" in (candidate.arch, pkg.arch)]
+        if not candidates:
+            continue
+        # The available packages are sorted from the oldest version
+        newest = candidates[-1]
+        if compare_evr(newest, pkg) > 0:
+            plan.append(PlannedAction(PLAN_UPDATE, pkg, newest))
+            continue
+        same = [candidate for candidate in candidates if compare_evr(candidate, pkg) == 0]
+        if same:
+            plan.append(PlannedAction(PLAN_REINSTALL, pkg, same[0]))
+        else:
+            plan.append(PlannedAction(PLAN_DOWNGRADE, pkg, newest))
+    return plan
+
+
+def compare_evr(pkg1, pkg2):
+    """Compare the epoch, version and release of two packages the way rpm does. Return 1, 0 or -1."""
+    return rpm.labelCompare((str(pkg1.epoch or 0), pkg1.version, pkg1.release),
+                            (str(pkg2.epoch or 0), pkg2.version, pkg2.release))
+
+
+def print_replacement_plan(plan):
+    loggerinst = logging.getLogger(__name__)
+    if not plan:
+        loggerinst.info("No %s package to replace." % system_info.name)
+        return
+    loggerinst.info("Replacing the %s packages in a single transaction:" % system_info.name)
+    for action in sorted(plan, key=lambda action: (action.action, action.installed.name)):
+        loggerinst.info("  %-10s %s -> %s" % (action.action, get_pkg_nevra(action.installed),
+                                             get_pkg_nevra(action.target)))
+    for action_name in (PLAN_UPDATE, PLAN_REINSTALL, PLAN_DOWNGRADE):
+        loggerinst.info("%ss: %d" % (action_name.capitalize(),
+                                    len([action for action in plan if action.action == action_name])))
+
+
+def run_replacement_plan(plan, download_only=False):
+    """Run all the planned actions in a single yum transaction and return the yum return code.
+
+    With download_only=True the packages of the transaction are just downloaded to the yum cache.
+    """
+    loggerinst = logging.getLogger(__name__)
+    script = ["%s %s" % (action.action, get_pkg_nevra(action.target)) for action in plan] + ["run"]
+    utils.store_content_to_file(_REPLACEMENT_TRANSACTION_PATH, script)
+    args = _REPLACEMENT_TRANSACTION_PATH
+    if download_only:
+        # The signatures are checked when the packages are installed
+        args = "--downloadonly --nogpgcheck %s" % args
+    _, ret_code = call_yum_cmd("shell", args)
+    loggerinst.info("Received return code: %s\n" % str(ret_code))
+    return ret_code
+
+
+def stage_rhel_pkgs():
+    """Download the RHEL packages to be installed after the point of no return to the yum cache.
+
+    The yum calls after the point of no return then take the packages from the cache, so a slow network lengthens only
+    the part of the conversion that can be rolled back. Failing to download the packages is not fatal, they are
+    downloaded when installed in such case.
+
+    The packages are the RHEL kernel with the additional kernel packages replacing the removed ones, see
+    preserve_only_rhel_kernel(), and the packages replacing the original OS packages. The packages are kept in the cache
+    until clean_staged_pkgs() is called.
+    """
+    loggerinst = logging.getLogger(__name__)
+
+    loggerinst.info("Downloading the RHEL kernel ...")
+    # The staging call itself already keeps the packages in the cache
+    pkg_cache.keep = True
+    output, ret_code = call_yum_cmd("install", "--downloadonly --nogpgcheck kernel")
+    if ret_code != 0 and _DOWNLOADONLY_UNSUPPORTED_RE.search(output):
+        pkg_cache.keep = False
+        loggerinst.info("Yum doesn't support downloading the packages in advance without the yum-plugin-downloadonly"
+                        " package installed. The RHEL packages will be downloaded when installed.")
+        return
+    if ret_code != 0:
+        loggerinst.warning("Unable to download the RHEL kernel in advance.")
+
+    installed, available = get_kernel_availability()
+    if len(installed) == 1 and set(available) == set(installed):
+        # The only installed kernel is going to be replaced by the RHEL kernel with the same version, see
+        # replace_non_rhel_installed_kernel(). The rpm downloaded now is taken from the package store then.
+        utils.download_pkg("kernel-%s" % installed[0], dest=utils.TMP_DIR, disable_repos=tool_opts.disablerepo,
+                           enable_repos=tool_opts.enablerepo)
+
+    for name in get_additional_kernel_pkg_names(get_installed_pkgs_w_different_fingerprint(
+            system_info.fingerprints_rhel, "kernel*")):
+        loggerinst.info("Downloading RHEL %s ..." % name)
+        _, ret_code = call_yum_cmd("install", "--downloadonly --nogpgcheck %s" % name)
+        if ret_code != 0:
+            loggerinst.warning("Unable to download RHEL %s in advance." % name)
+
+    loggerinst.info("Downloading the RHEL packages replacing the %s packages ..." % system_info.name)
+    plan = plan_replacement(get_pkgs_to_replace())
+    if plan is None:
+        loggerinst.warning("Unable to plan the replacement of the %s packages." % system_info.name)
+    elif plan and run_replacement_plan(plan, download_only=True) != 0:
+        loggerinst.warning("Unable to download all the RHEL packages in advance.")
+
+
+def clean_staged_pkgs():
+    """Stop keeping the packages in the yum cache and remove the packages downloaded by stage_rhel_pkgs() from it.
+
+    To be called once the staged packages have been installed, or on rollback.
+    """
+    if not pkg_cache.keep:
+        return
+    pkg_cache.keep = False
+    call_yum_cmd("clean", "packages", print_output=False)
+
+
 def install_gpg_keys():
     loggerinst = logging.getLogger(__name__)
     gpg_path = os.path.join(utils.DATA_DIR, "gpg-keys")
@@ -505,6 +1702,7 @@ def install_gpg_keys():
         output, ret_code = utils.run_subprocess(
             'rpm --import %s' % os.path.join(gpg_path, gpg_key),
             print_output=False)
+        installed_pkgs_snapshot.invalidate()
         if ret_code != 0:
             loggerinst.critical("Unable to import GPG key: %s", output)
 
@@ -584,17 +1782,10 @@ def get_kernel_availability():
     """Return a tuple - a list of installed kernel versions and a list of
     available kernel versions.
     """
-    output, _ = call_yum_cmd(command="list", args="--showduplicates kernel",
-                             print_output=False)
-    return (list(get_kernel(data))
-            for data in output.split("Available Packages"))
-
-
-def get_kernel(kernels_raw):
-    for kernel in re.findall(
-            r"kernel.*?\s+(\S+)\s+\S+",
-            kernels_raw, re.MULTILINE):
-        yield kernel
+    installed = pkg_query.installed("kernel")
+    available = pkg_query.available("kernel") or []
+    return (["%s-%s" % (pkg.version, pkg.release) for pkg in installed],
+            ["%s-%s" % (pkg.version, pkg.release) for pkg in available])
 
 
 def replace_non_rhel_installed_kernel(version):
@@ -624,6 +1815,7 @@ def replace_non_rhel_installed_kernel(version):
         # is not installed at this stage.
         'rpm -i --force --nodeps --replacepkgs %s*' % os.path.join(utils.TMP_DIR, pkg),
         print_output=False)
+    installed_pkgs_snapshot.invalidate()
     if ret_code != 0:
         loggerinst.critical("Unable to replace the kernel package: %s" % output)
 
@@ -706,16 +1898,20 @@ def install_additional_rhel_kernel_pkgs(additional_pkgs):
     tries to install back all of these from RHEL repositories.
     """
     loggerinst = logging.getLogger(__name__)
+    for name in get_additional_kernel_pkg_names(additional_pkgs):
+        loggerinst.info("Installing RHEL %s" % name)
+        call_yum_cmd("install %s" % name)
+
+
+def get_additional_kernel_pkg_names(kernel_pkgs):
+    """Return the names of the RHEL packages replacing the removed non-RHEL kernel packages, other than the kernel."""
     # OL renames some of the kernel packages by adding "-uek" (Unbreakable
     # Enterprise Kernel), e.g. kernel-uek-devel instead of kernel-devel. Such
     # package names need to be mapped to the RHEL kernel package names to have
     # them installed on the converted system.
     ol_kernel_ext = '-uek'
-    pkg_names = [p.name.replace(ol_kernel_ext, '', 1) for p in additional_pkgs]
-    for name in set(pkg_names):
-        if name != "kernel":
-            loggerinst.info("Installing RHEL %s" % name)
-            call_yum_cmd("install %s" % name)
+    pkg_names = [p.name.replace(ol_kernel_ext, '', 1) for p in kernel_pkgs]
+    return sorted([name for name in set(pkg_names) if name != "kernel"])
 
 
 def update_rhel_kernel():
@@ -761,3 +1957,10 @@ def has_duplicate_repos_across_disablerepo_enablerepo_options():
             message += "\n%s" % repo
         message += "\nThis ambiguity may have unintended consequences."
         loggerinst.warning(message)
+
+
+rpmdb_fingerprints = RpmDbFingerprints()  # pylint: disable=C0103
+installed_pkgs_snapshot = InstalledPkgsSnapshot()  # pylint: disable=C0103
+repo_metadata = RepoMetadata()  # pylint: disable=C0103
+pkg_cache = PkgCache()  # pylint: disable=C0103
+pkg_query = PkgQuery()  # pylint: disable=C0103
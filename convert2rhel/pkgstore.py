@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+A content-addressed store of the downloaded rpms shared across the uses of the packages and the runs of the tool.
+
+The backups of the removed packages, the subscription-manager packages and the kernel are downloaded into different
+directories, and again upon each run of the tool. The rpms downloaded through pkghandler.download_pkgs_in_process()
+are kept in a single store instead, keyed by the NEVRA and the checksum from the repository metadata, and hardlinked
+into the directories they are requested in. A package already in the store is not downloaded again.
+
+The store is bounded in size. When it grows over PkgStore.max_size, the least recently used rpms are evicted. Evicting
+an rpm doesn't affect its hardlinks in the other directories.
+
+The store can be pre-seeded from a directory with rpm files, e.g. an NFS share filled once for a whole fleet of
+systems, see the --pkg-store-seed option. An rpm from the seed directory is used only when its checksum matches the
+repository metadata.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from collections import namedtuple
+
+from convert2rhel import utils
+
+PKG_STORE_DIR = os.path.join(utils.TMP_DIR, "pkgstore")
+# The maximum total size of the rpms in the store, in bytes
+MAX_PKG_STORE_SIZE = 4 * 1024 * 1024 * 1024
+
+# The key of an rpm in the store: the NEVRA of the package, e.g. "bash-0:4.2.46-35.el7_9.x86_64", the type of the
+# checksum as named in the repository metadata, e.g. "sha256", and the checksum
+PkgKey = namedtuple("PkgKey", ["nevra", "checksum_type", "checksum"])
+
+# The checksum types of the repository metadata not named the same as in hashlib
+_CHECKSUM_TYPES = {"sha": "sha1"}
+
+_READ_BLOCK_SIZE = 1024 * 1024
+
+
+class PkgStore(object):
+    """The store of the downloaded rpms, see the module docstring."""
+
+    def __init__(self, path=PKG_STORE_DIR, max_size=MAX_PKG_STORE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def get(self, key, filename, seed_dir=None):
+        """Return the path of the rpm with the key in the store, None when it's not stored.
+
+        An rpm not stored yet is looked for under the filename in the seed directory and, when its checksum matches the
+        key, copied into the store.
+        """
+        loggerinst = logging.getLogger(__name__)
+        stored_path = self._get_stored_path(key)
+        if os.path.isfile(stored_path):
+            _touch(stored_path)
+            return stored_path
+        if not seed_dir:
+            return None
+        seed_path = os.path.join(seed_dir, filename)
+        if not os.path.isfile(seed_path):
+            return None
+        try:
+            if get_checksum(seed_path, key.checksum_type) != key.checksum:
+                loggerinst.warning("The checksum of %s doesn't match the repository metadata, not using it."
+                                   % seed_path)
+                return None
+            utils.mkdir_p(self.path)
+            # Copied under a temporary name first so that an interrupted copy doesn't end up in the store
+            fd, tmp_path = tempfile.mkstemp(dir=self.path)
+            os.close(fd)
+            shutil.copy2(seed_path, tmp_path)
+            os.rename(tmp_path, stored_path)
+        except (IOError, OSError) as err:
+            loggerinst.warning("Unable to copy %s into the package store: %s" % (seed_path, str(err)))
+            return None
+        _touch(stored_path)
+        loggerinst.debug("Copied %s from the seed directory into the package store." % filename)
+        return stored_path
+
+    def add(self, path, key):
+        """Add the downloaded rpm with the key to the store. Return the path of the stored rpm, None on failure."""
+        loggerinst = logging.getLogger(__name__)
+        stored_path = self._get_stored_path(key)
+        try:
+            utils.mkdir_p(self.path)
+            if not os.path.isfile(stored_path):
+                _link_or_copy(path, stored_path)
+        except (IOError, OSError) as err:
+            loggerinst.warning("Unable to add %s to the package store: %s" % (path, str(err)))
+            return None
+        _touch(stored_path)
+        return stored_path
+
+    def evict(self):
+        """Remove the least recently used rpms from the store until the total size is within the maximum size."""
+        loggerinst = logging.getLogger(__name__)
+        try:
+            entries = []
+            for filename in os.listdir(self.path):
+                if filename.endswith(".rpm"):
+                    stat = os.stat(os.path.join(self.path, filename))
+                    entries.append((stat.st_mtime, stat.st_size, filename))
+        except OSError:
+            return
+        total_size = sum([size for _, size, _ in entries])
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            loggerinst.debug("Evicting %s from the package store." % filename)
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except OSError as err:
+                loggerinst.debug("Unable to evict %s: %s" % (filename, str(err)))
+                continue
+            total_size -= size
+
+    def _get_stored_path(self, key):
+        return os.path.join(self.path, "%s-%s-%s.rpm" % (key.nevra, key.checksum_type, key.checksum))
+
+
+def link(path, dest, filename):
+    """Hardlink the rpm into the dest directory under the filename, copy it when a hardlink is not possible. Return the
+    path of the linked rpm.
+    """
+    dest_path = os.path.join(dest, filename)
+    if os.path.exists(dest_path):
+        if os.path.samefile(path, dest_path):
+            return dest_path
+        os.remove(dest_path)
+    _link_or_copy(path, dest_path)
+    return dest_path
+
+
+def get_checksum(path, checksum_type):
+    checksum = hashlib.new(_CHECKSUM_TYPES.get(checksum_type, checksum_type))
+    with open(path, "rb") as rpm_file:
+        while True:
+            block = rpm_file.read(_READ_BLOCK_SIZE)
+            if not block:
+                break
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _link_or_copy(path, dest_path):
+    try:
+        os.link(path, dest_path)
+    except OSError as err:
+        # Different file systems, or a file system not supporting hardlinks
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copy2(path, dest_path)
+
+
+def _touch(path):
+    # The modification time of the stored rpms is the time of their last use, for the LRU eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+pkg_store = PkgStore()  # pylint: disable=C0103
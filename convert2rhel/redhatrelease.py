@@ -70,6 +70,8 @@ class YumConf(object):
         release version ($releasever) based on the installed redhat-release
         package.
         """
+        # The yum.conf is a file of an installed package, the verification of the packages must not see the change
+        system_info.wait_for_rpm_va()
         self._comment_out_distroverpkg_tag()
         self._write_altered_yum_conf()
         self.loggerinst.debug("%s patched." % self._yum_conf_path)
@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Verification of the installed packages, equivalent to 'rpm -Va'.
+
+Verifying all the packages means reading and checksumming all the files installed on the system. To use all the CPUs
+and the full bandwidth of the disks, the installed packages are split into shards verified by concurrently running
+'rpm -V <packages>' commands. The outputs of the shards are concatenated in the order of the packages in the rpm db,
+which is the order 'rpm -Va' verifies them in, so the result is the same as the output of a single 'rpm -Va'.
+
+The output lines are also attributed to the individual packages. That allows verifying after the conversion only the
+packages that the conversion has changed and taking the results of the rest of the packages from the verification
+done before the conversion. Similarly, the results are cached across the runs of the tool, see
+pkgcache.VerificationCache.
+
+The verification before the conversion runs in the background, see BackgroundVerification, so that it overlaps with
+the preparation steps which don't change the installed packages. It runs in a child process, not in a thread, so that
+it has its own handle of the rpm db and the main process stays single-threaded when forking, e.g. for decoding the
+package signatures in pkghandler.get_installed_pkgs_w_fingerprints().
+"""
+
+import fnmatch
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+from collections import namedtuple
+
+import rpm
+
+from six.moves import queue
+
+from convert2rhel import utils
+
+# Maximum number of packages passed to a single 'rpm -V' call, to keep the command line reasonably short
+MAX_PKGS_PER_SHARD = 500
+
+# The verification profiles and the 'rpm -V' options they translate to. Verifying the file digests means reading all
+# the installed files, the other checks need just the file metadata. 'rpm -V' has no option to verify just the
+# configuration files (-c/--configfiles is a query option), so the output lines of the other files are filtered out
+# for the config-files-only profile, see VerificationProfile.filter_lines().
+PROFILES = {
+    "full": "",
+    "metadata-only": "--nofiledigest",
+    "config-files-only": "",
+}
+DEFAULT_PROFILE = "full"
+CONFIG_FILES_ONLY_PROFILE = "config-files-only"
+
+# The rpm file attribute marker of the configuration files in the 'rpm -V' output
+_CONFIG_FILE_TYPE = "c"
+
+# How often to report the progress of a background verification while waiting for it, in seconds
+PROGRESS_REPORT_INTERVAL = 10
+
+# The package NVRA as accepted by 'rpm -V' and the SHA1 digest of the package header. Some packages, like gpg-pubkey,
+# have no architecture.
+_PKG_QUERY_FORMAT = r"%{NAME}-%{VERSION}-%{RELEASE}%|ARCH?{.%{ARCH}}| %{SHA1HEADER}\n"
+
+# A file verification line, e.g. "S.5....T.  c /etc/yum.conf" or "missing     /usr/bin/foo"
+_FILE_LINE_RE = re.compile(r"^(?P<flags>\S+)\s+(?:(?P<file_type>[cdglr])\s+)?(?P<path>/.*)$")
+# The first line of the dependency problems of a package, e.g. "Unsatisfied dependencies for foo-1:1.0-1.x86_64:"
+_DEPS_LINE_RE = re.compile(r"^Unsatisfied dependencies for (\S+):(?:\s|$)")
+_NOT_INSTALLED_LINE_RE = re.compile(r"^package (\S+) is not installed$")
+
+
+class VerificationProfile(object):
+    """What the verification checks: one of the PROFILES and shell-style wildcards of the paths excluded from it.
+
+    Results of verifications with different profiles are not comparable. The string representation of a profile
+    identifies it, e.g. in the exported comparison of two verifications.
+    """
+
+    def __init__(self, name=DEFAULT_PROFILE, exclude=None):
+        if name not in PROFILES:
+            raise ValueError("Unknown verification profile: %s" % name)
+        self.name = name
+        self.exclude = list(exclude or [])
+        self._exclude_re = None
+        if self.exclude:
+            self._exclude_re = re.compile("|".join(["(?:%s)" % fnmatch.translate(glob) for glob in self.exclude]))
+
+    @property
+    def rpm_options(self):
+        return PROFILES[self.name]
+
+    def is_excluded(self, path):
+        return bool(self._exclude_re and self._exclude_re.match(path))
+
+    def filter_lines(self, lines):
+        """Return the output lines without the lines of the excluded files.
+
+        With the config-files-only profile, the lines of the files other than the configuration files are left out as
+        well.
+        """
+        if not self.exclude and self.name != CONFIG_FILES_ONLY_PROFILE:
+            return lines
+        filtered = []
+        for line in lines:
+            match = _FILE_LINE_RE.match(line)
+            if match and (self.is_excluded(match.group("path")) or (self.name == CONFIG_FILES_ONLY_PROFILE
+                                                                    and match.group("file_type") != _CONFIG_FILE_TYPE)):
+                continue
+            filtered.append(line)
+        return filtered
+
+    def __str__(self):
+        if self.exclude:
+            return "%s, excluding %s" % (self.name, ", ".join(self.exclude))
+        return self.name
+
+    def __eq__(self, other):
+        return isinstance(other, VerificationProfile) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class VerificationResult(object):
+    """Output of the verification of all the installed packages.
+
+    pkgs is a list of (NVRA, SHA1 digest of the header) tuples of the verified packages in the rpm db order.
+    lines_per_pkg holds the output lines of each of the packages keyed by the NVRA. It is None when the output could not
+    be attributed to the packages. files_digests holds the digests of the state of the package files at the time of
+    the verification keyed by the NVRA, see get_files_state_digests(). It is None when not known. profile is the
+    VerificationProfile the packages have been verified with.
+    """
+
+    def __init__(self, output, pkgs=None, lines_per_pkg=None, files_digests=None, profile=None):
+        self.output = output
+        self.pkgs = pkgs
+        self.lines_per_pkg = lines_per_pkg
+        self.files_digests = files_digests
+        self.profile = profile or VerificationProfile()
+
+
+# A file reported by the verification. The file_type is the rpm file attribute marker, e.g. "c" for a config file, or
+# an empty string. The pkg is the NVRA of the owning package, None when not known.
+VerifiedFile = namedtuple("VerifiedFile", ["pkg", "flags", "file_type", "path"])
+
+# A difference between two verifications, the flags of a file that has not been reported by a verification are None
+FileChange = namedtuple("FileChange", ["change", "pkg", "path", "file_type", "flags_before", "flags_after"])
+
+# The kinds of the file changes
+FILE_MODIFIED = "modified"
+FILE_FIXED = "fixed"
+FILE_FLAGS_CHANGED = "flags changed"
+
+
+class VerificationProgress(object):
+    """Number of the packages to verify and of those verified so far, updated from the verification threads.
+
+    The counters are kept in shared memory, so the progress of a verification running in a child process is visible to
+    the parent process.
+    """
+
+    def __init__(self):
+        self._total = multiprocessing.Value("i", 0)
+        self._verified = multiprocessing.Value("i", 0)
+
+    @property
+    def total(self):
+        return self._total.value
+
+    @property
+    def verified(self):
+        return self._verified.value
+
+    def add_total(self, count):
+        _add(self._total, count)
+
+    def add_verified(self, count):
+        _add(self._verified, count)
+
+
+def _add(value, count):
+    lock = value.get_lock()
+    lock.acquire()
+    try:
+        value.value += count
+    finally:
+        lock.release()
+
+
+class _RecordingHandler(logging.Handler):
+    """Logging handler keeping the level and the message of the records, to be sent to the parent process."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+class BackgroundVerification(object):
+    """Verification of all the installed packages, see verify_all_pkgs(), running in a background child process.
+
+    The verification must be waited for before anything changes the installed packages or their files, otherwise the
+    result would include those changes. The messages logged by the verification are logged by wait(), so that they
+    don't interleave with the output of the main process, e.g. with the questions to the user.
+    """
+
+    def __init__(self, previous=None, cache=None, profile=None):
+        self.previous = previous
+        self.cache = cache
+        self.profile = profile
+        self.progress = VerificationProgress()
+        self.start_time = None
+        self._process = None
+        self._conn = None
+
+    def start(self):
+        self.start_time = time.time()
+        self._conn, child_conn = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(target=self._run, args=(child_conn,))
+        # Don't keep the tool running after an early exit just because of the verification
+        self._process.daemon = True
+        self._process.start()
+        child_conn.close()
+
+    def _run(self, conn):
+        # Runs in the child process. The log records are sent to the parent process instead of being written out.
+        handler = _RecordingHandler()
+        root_logger = logging.getLogger("convert2rhel")
+        root_logger.handlers = [handler]
+        root_logger.propagate = False
+        result = None
+        error = None
+        try:
+            result = verify_all_pkgs(previous=self.previous, progress=self.progress, cache=self.cache,
+                                     profile=self.profile)
+        except Exception as err:  # pylint: disable=broad-except
+            error = "%s: %s" % (type(err).__name__, str(err))
+        conn.send((result, error, handler.records))
+        conn.close()
+
+    def wait(self):
+        """Wait for the verification to finish, reporting its progress, and return its VerificationResult.
+
+        The verification is just informational, so a failure of it doesn't stop the conversion. Return None when the
+        verification has failed.
+        """
+        loggerinst = logging.getLogger(__name__)
+        wait_start = time.time()
+        while not self._conn.poll(PROGRESS_REPORT_INTERVAL):
+            if self.progress.total:
+                loggerinst.info("Waiting for the 'rpm -Va' command to finish. Verified %d of %d packages."
+                                % (self.progress.verified, self.progress.total))
+            else:
+                loggerinst.info("Waiting for the 'rpm -Va' command to finish.")
+        try:
+            result, error, records = self._conn.recv()
+        except EOFError:
+            result, error, records = None, "The verification process exited unexpectedly.", []
+        self._conn.close()
+        self._process.join()
+        for level, message in records:
+            loggerinst.log(level, message)
+
+        message = "The 'rpm -Va' command took %.1f s." % (time.time() - self.start_time)
+        if wait_start - self.start_time >= 1:
+            message += " %.1f s of that ran in parallel with the other steps." % (wait_start - self.start_time)
+        loggerinst.info(message)
+        if error:
+            loggerinst.warning("The 'rpm -Va' command failed: %s" % error)
+            return None
+        return result
+
+
+def get_installed_pkgs():
+    """Return a list of (NVRA, SHA1 digest of the header) tuples of the installed packages in the rpm db order.
+
+    Return None when the packages cannot be listed.
+    """
+    output, ret_code = utils.run_subprocess("rpm -qa --qf '%s'" % _PKG_QUERY_FORMAT, print_output=False)
+    if ret_code != 0:
+        return None
+    return [tuple(line.split(" ", 1)) for line in output.splitlines()]
+
+
+def get_installed_nvras():
+    """Return the NVRAs of all the installed packages in the rpm db order."""
+    pkgs = get_installed_pkgs()
+    return [nvra for nvra, _ in pkgs] if pkgs is not None else None
+
+
+def split_into_shards(nvras, shard_count):
+    """Split the list of packages into at least shard_count contiguous shards of at most MAX_PKGS_PER_SHARD packages.
+    """
+    shard_count = max(shard_count, (len(nvras) + MAX_PKGS_PER_SHARD - 1) // MAX_PKGS_PER_SHARD, 1)
+    shard_size = (len(nvras) + shard_count - 1) // shard_count
+    return [nvras[i:i + shard_size] for i in range(0, len(nvras), max(shard_size, 1))]
+
+
+def verify_all_pkgs(processes=None, previous=None, progress=None, cache=None, profile=None):
+    """Verify all the installed packages and return a VerificationResult with output equivalent to 'rpm -Va'.
+
+    The verification runs in as many concurrent 'rpm -V' processes as there are CPUs, unless the number of
+    processes is passed. When the installed packages cannot be listed or verified in shards, 'rpm -Va' is called.
+
+    With the result of a previous verification passed, only the packages which have changed since are verified. The
+    result of the rest is taken from the previous verification, apart from the dependencies which are always checked.
+    With a pkgcache.VerificationCache passed and no previous verification, the results cached by a previous run of
+    the tool are used the same way. The cache is then updated with the result. Results of verifications with a
+    different profile are not used.
+
+    The packages are verified according to the passed VerificationProfile, by default fully. Packages with all their
+    files excluded by the profile are not verified at all.
+
+    The number of the verified packages is counted in the passed VerificationProgress.
+    """
+    loggerinst = logging.getLogger(__name__)
+    if processes is None:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    profile = profile or VerificationProfile()
+    rpm_va_cmd = "rpm -Va %s" % profile.rpm_options if profile.rpm_options else "rpm -Va"
+
+    pkgs = get_installed_pkgs()
+    if not pkgs:
+        output, _ = utils.run_subprocess(rpm_va_cmd, print_output=False)
+        return VerificationResult("".join(profile.filter_lines(output.splitlines(True))), profile=profile)
+    if profile.exclude:
+        excluded = get_fully_excluded_pkgs([nvra for nvra, _ in pkgs], profile)
+        loggerinst.debug("Skipping the verification of %d packages with all files excluded." % len(excluded))
+        pkgs = [(nvra, digest) for nvra, digest in pkgs if nvra not in excluded]
+    nvras = [nvra for nvra, _ in pkgs]
+
+    # The state of the files before verifying them, a file changed during the verification is verified again next time
+    files_digests = get_files_state_digests(nvras)
+    if previous is None and cache is not None and files_digests is not None:
+        previous = _get_cached_result(pkgs, cache.load(profile), profile)
+
+    result = None
+    if previous is not None and previous.lines_per_pkg is not None and previous.profile == profile:
+        result = _verify_changed_pkgs(pkgs, previous, processes, progress, files_digests)
+        if not result:
+            loggerinst.debug("Unable to verify just the changed packages. Verifying all of them.")
+
+    if not result:
+        outputs = verify_shards(split_into_shards(nvras, processes), processes, profile.rpm_options, progress)
+        if None in outputs:
+            loggerinst.debug("Verification of some of the shards failed. Falling back to 'rpm -Va'.")
+            output, _ = utils.run_subprocess(rpm_va_cmd, print_output=False)
+            return VerificationResult("".join(profile.filter_lines(output.splitlines(True))), profile=profile)
+        lines_per_pkg = attribute_lines_to_pkgs("".join(outputs), nvras)
+        if lines_per_pkg is None:
+            output = "".join(profile.filter_lines("".join(outputs).splitlines(True)))
+        else:
+            for nvra in lines_per_pkg:
+                lines_per_pkg[nvra] = profile.filter_lines(lines_per_pkg[nvra])
+            output = "".join(["".join(lines_per_pkg.get(nvra, [])) for nvra in nvras])
+        result = VerificationResult(output, pkgs, lines_per_pkg, files_digests, profile)
+
+    if cache is not None and result.lines_per_pkg is not None and files_digests is not None:
+        cache.save(profile, dict((nvra, (digest, files_digests[nvra], result.lines_per_pkg.get(nvra, [])))
+                                 for nvra, digest in pkgs if digest != "(none)" and nvra in files_digests))
+    return result
+
+
+def _get_cached_result(pkgs, cached, profile):
+    """Return the cached results of the installed packages as a VerificationResult, None when there are none."""
+    cached_pkgs = []
+    lines_per_pkg = {}
+    files_digests = {}
+    for nvra, digest in pkgs:
+        if nvra in cached and cached[nvra][0] == digest:
+            cached_pkgs.append((nvra, digest))
+            files_digests[nvra] = cached[nvra][1]
+            lines_per_pkg[nvra] = cached[nvra][2]
+    if not cached_pkgs:
+        return None
+    return VerificationResult(None, cached_pkgs, lines_per_pkg, files_digests, profile)
+
+
+def _verify_changed_pkgs(pkgs, previous, processes, progress=None, files_digests=None):
+    """Verify the packages changed since the previous verification and take the result of the rest from it.
+
+    A package has changed when the digest of its header is different or, when known for both of the verifications,
+    the digest of the state of its files. Return None when the result cannot be put together this way.
+    """
+    loggerinst = logging.getLogger(__name__)
+    profile = previous.profile
+    previous_digests = dict(previous.pkgs)
+    unchanged = set()
+    for nvra, digest in pkgs:
+        if digest == "(none)" or previous_digests.get(nvra) != digest:
+            continue
+        if files_digests is not None and previous.files_digests is not None \
+                and files_digests.get(nvra) != previous.files_digests.get(nvra):
+            continue
+        unchanged.add(nvra)
+    # A file shared with a changed package might have been modified by the change
+    unchanged -= get_pkgs_sharing_files(unchanged, [nvra for nvra, _ in pkgs if nvra not in unchanged])
+    changed = [nvra for nvra, _ in pkgs if nvra not in unchanged]
+    unchanged = [nvra for nvra, _ in pkgs if nvra in unchanged]
+    loggerinst.debug("Verifying %d changed packages. Taking the result of %d unchanged packages from the previous"
+                     " verification." % (len(changed), len(unchanged)))
+
+    # The dependencies of the unchanged packages might have changed, so check just them for the unchanged packages
+    changed_outputs = verify_shards(split_into_shards(changed, processes), processes, profile.rpm_options, progress)
+    deps_outputs = verify_shards(split_into_shards(unchanged, processes), processes,
+                                 " ".join(["--nofiles --noscripts", profile.rpm_options]).strip(), progress)
+    if None in changed_outputs + deps_outputs:
+        return None
+    changed_lines = attribute_lines_to_pkgs("".join(changed_outputs), changed)
+    deps_lines = attribute_lines_to_pkgs("".join(deps_outputs), unchanged)
+    if changed_lines is None or deps_lines is None:
+        return None
+
+    lines_per_pkg = {}
+    for nvra in changed:
+        lines_per_pkg[nvra] = profile.filter_lines(changed_lines.get(nvra, []))
+    for nvra in unchanged:
+        # rpm checks the dependencies of a package before its files
+        file_lines = [line for line in previous.lines_per_pkg.get(nvra, []) if _FILE_LINE_RE.match(line)]
+        lines_per_pkg[nvra] = deps_lines.get(nvra, []) + file_lines
+    output = "".join(["".join(lines_per_pkg.get(nvra, [])) for nvra, _ in pkgs])
+    return VerificationResult(output, pkgs, lines_per_pkg, files_digests, profile)
+
+
+def verify_shards(shards, processes, options="", progress=None):
+    """Verify the shards of packages in concurrent 'rpm -V' calls and return their outputs in the order of the shards.
+
+    The output of a shard that could not be verified is None. The verified packages are counted in the passed
+    VerificationProgress.
+    """
+    outputs = [None] * len(shards)
+    shard_queue = queue.Queue()
+    for index in range(len(shards)):
+        shard_queue.put(index)
+    cmd = "rpm -V %s" % options if options else "rpm -V"
+    if progress:
+        progress.add_total(sum([len(shard) for shard in shards]))
+
+    def worker():
+        while True:
+            try:
+                index = shard_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                # The command would be too long to log
+                outputs[index], _ = utils.run_subprocess("%s %s" % (cmd, " ".join(shards[index])), print_cmd=False,
+                                                         print_output=False)
+            except EnvironmentError:
+                # Leave the output of the shard as None
+                pass
+            if progress:
+                progress.add_verified(len(shards[index]))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(processes, len(shards)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outputs
+
+
+def attribute_lines_to_pkgs(output, nvras):
+    """Split the 'rpm -V' output of the listed packages into the lines of the individual packages.
+
+    The dependency problems name the package. The file lines are attributed to the owner of the file, in case of a
+    file owned by multiple packages to its owners in the order they have been verified in. Return a dictionary with the
+    lines of each package keyed by the NVRA, or None in case any of the lines cannot be attributed.
+    """
+    positions = dict((nvra, position) for position, nvra in enumerate(nvras))
+    if len(positions) != len(nvras):
+        # Multiple packages with the same NVRA installed, 'rpm -V <NVRA>' verifies all of them at once
+        return None
+
+    lines_per_pkg = {}
+    path_occurrences = {}
+    current_pkg = None
+    ts = None
+    for line in output.splitlines(True):
+        file_match = _FILE_LINE_RE.match(line)
+        deps_match = _DEPS_LINE_RE.match(line)
+        not_installed_match = _NOT_INSTALLED_LINE_RE.match(line)
+        if file_match:
+            if ts is None:
+                ts = rpm.TransactionSet()
+            path = file_match.group("path")
+            owners = get_path_owners(ts, path, positions)
+            occurrence = path_occurrences.get(path, 0)
+            if occurrence >= len(owners):
+                return None
+            path_occurrences[path] = occurrence + 1
+            current_pkg = owners[occurrence]
+        elif deps_match:
+            # The NEVRA with the epoch removed
+            current_pkg = re.sub(r"-\d+:", "-", deps_match.group(1))
+        elif not_installed_match:
+            current_pkg = not_installed_match.group(1)
+        elif not (line[:1].isspace() and current_pkg):
+            # Only the continuation lines of the dependency problems start with a whitespace
+            return None
+        if current_pkg not in positions:
+            return None
+        lines_per_pkg.setdefault(current_pkg, []).append(line)
+    return lines_per_pkg
+
+
+def get_path_owners(ts, path, positions):
+    """Return the NVRAs of the packages, out of those in positions, that own the path, ordered by the positions."""
+    owners = [_get_hdr_nvra(hdr) for hdr in ts.dbMatch("basenames", path)]
+    return sorted([owner for owner in owners if owner in positions], key=lambda owner: positions[owner])
+
+
+def get_pkgs_sharing_files(nvras, other_nvras):
+    """Return a set of the packages, out of nvras, owning any file that is owned by any of the other_nvras packages too.
+    """
+    if not nvras or not other_nvras:
+        return set()
+    other_nvras = set(other_nvras)
+    ts = rpm.TransactionSet()
+    owners_per_path = {}
+    for hdr in ts.dbMatch():
+        nvra = _get_hdr_nvra(hdr)
+        if nvra in nvras:
+            for path in hdr[rpm.RPMTAG_FILENAMES]:
+                owners_per_path.setdefault(path, []).append(nvra)
+
+    sharing = set()
+    for hdr in ts.dbMatch():
+        if _get_hdr_nvra(hdr) in other_nvras:
+            for path in hdr[rpm.RPMTAG_FILENAMES]:
+                sharing.update(owners_per_path.get(path, []))
+    return sharing
+
+
+def get_fully_excluded_pkgs(nvras, profile):
+    """Return a set of the packages, out of nvras, with all their files excluded by the VerificationProfile."""
+    nvras = set(nvras)
+    excluded = set()
+    ts = rpm.TransactionSet()
+    for hdr in ts.dbMatch():
+        nvra = _get_hdr_nvra(hdr)
+        paths = hdr[rpm.RPMTAG_FILENAMES]
+        if nvra in nvras and paths and all(profile.is_excluded(_to_str(path)) for path in paths):
+            excluded.add(nvra)
+    return excluded
+
+
+def get_files_state_digests(nvras):
+    """Return the digests of the state of the files of the listed packages keyed by the NVRA.
+
+    The state of a file is what the file system keeps about it, including the inode number and the modification and
+    status change times, not the content. Any change of the content, the attributes or the owner of a file, or its
+    replacement, changes the digest without the need to read the files. Return None when the rpm db cannot be read.
+    """
+    loggerinst = logging.getLogger(__name__)
+    nvras = set(nvras)
+    digests = {}
+    try:
+        ts = rpm.TransactionSet()
+        for hdr in ts.dbMatch():
+            nvra = _get_hdr_nvra(hdr)
+            if nvra not in nvras:
+                continue
+            digest = hashlib.sha1()
+            for path in hdr[rpm.RPMTAG_FILENAMES]:
+                try:
+                    stat = os.lstat(path)
+                    state = (stat.st_dev, stat.st_ino, stat.st_mode, stat.st_nlink, stat.st_uid, stat.st_gid,
+                             stat.st_size, stat.st_mtime, stat.st_ctime)
+                except OSError:
+                    state = "missing"
+                digest.update(("%r %r\n" % (_to_str(path), state)).encode("utf-8"))
+            digests[nvra] = digest.hexdigest()
+    except rpm.error as err:
+        loggerinst.debug("Unable to read the files of the installed packages: %s" % err)
+        return None
+    return digests
+
+
+def _get_hdr_nvra(hdr):
+    nvra = "%s-%s-%s" % (_to_str(hdr[rpm.RPMTAG_NAME]), _to_str(hdr[rpm.RPMTAG_VERSION]),
+                         _to_str(hdr[rpm.RPMTAG_RELEASE]))
+    arch = hdr[rpm.RPMTAG_ARCH]
+    return "%s.%s" % (nvra, _to_str(arch)) if arch else nvra
+
+
+def _to_str(value):
+    # Some versions of the rpm Python 3 bindings return bytes instead of strings
+    return value.decode() if isinstance(value, bytes) and not isinstance(value, str) else value
+
+
+def get_verified_files(result):
+    """Parse the file lines of the VerificationResult into VerifiedFile records keyed by the path.
+
+    A file owned by multiple packages may be reported multiple times. The first of the records is kept in such case.
+    """
+    if result.lines_per_pkg is not None:
+        lines_w_pkgs = []
+        for nvra, _ in result.pkgs:
+            lines_w_pkgs.extend([(nvra, line) for line in result.lines_per_pkg.get(nvra, [])])
+    else:
+        lines_w_pkgs = [(None, line) for line in result.output.splitlines()]
+
+    files = {}
+    for nvra, line in lines_w_pkgs:
+        file_match = _FILE_LINE_RE.match(line)
+        if file_match and file_match.group("path") not in files:
+            files[file_match.group("path")] = VerifiedFile(nvra, file_match.group("flags"),
+                                                           file_match.group("file_type") or "", file_match.group("path"))
+    return files
+
+
+def compare_verified_files(before, after):
+    """Compare two sets of verified files, as returned by get_verified_files(), and return a list of FileChange records
+    sorted by the package and the path.
+
+    A file reported only after is modified, reported only before is fixed, and reported by both with different flags
+    has its flags changed. The package of a change is the owner after, if known, as the packages are replaced during
+    the conversion.
+    """
+    changes = []
+    for path, verified_after in after.items():
+        verified_before = before.get(path)
+        if verified_before is None:
+            changes.append(FileChange(FILE_MODIFIED, verified_after.pkg, path, verified_after.file_type, None,
+                                      verified_after.flags))
+        elif verified_before.flags != verified_after.flags:
+            changes.append(FileChange(FILE_FLAGS_CHANGED, verified_after.pkg or verified_before.pkg, path,
+                                      verified_after.file_type, verified_before.flags, verified_after.flags))
+    for path, verified_before in before.items():
+        if path not in after:
+            changes.append(FileChange(FILE_FIXED, verified_before.pkg, path, verified_before.file_type,
+                                      verified_before.flags, None))
+    changes.sort(key=lambda change: (change.pkg or "", change.path))
+    return changes
@@ -20,7 +20,7 @@ try:
     import ConfigParser as configparser
 except ImportError:
     import configparser  # pylint: disable=import-error
-import difflib
+import json
 import os
 import re
 import logging
@@ -28,11 +28,15 @@ import logging
 from convert2rhel import utils
 from convert2rhel.toolopts import tool_opts
 from convert2rhel import logger
+from convert2rhel import pkgcache
+from convert2rhel import rpmverify
 
 # For a list of modified rpm files before the conversion starts
 PRE_RPM_VA_LOG_FILENAME = 'rpm_va.log'
 # For a list of modified rpm files after the conversion finishes for comparison purposes
 POST_RPM_VA_LOG_FILENAME = 'rpm_va_after_conversion.log'
+# For the differences between the two lists above
+RPM_VA_DIFF_FILENAME = 'rpm_va_diff.json'
 
 
 class SystemInfo(object):
@@ -70,6 +74,11 @@ class SystemInfo(object):
         # List of repositories enabled through subscription-manager
         self.submgr_enabled_repos = []
         self.releasever = None
+        # Result of the last verification of the installed packages (rpmverify.VerificationResult)
+        self.rpm_va_result = None
+        # The verification running in the background
+        self._rpm_va = None
+        self._rpm_va_log_filename = None
 
     def resolve_system_info(self):
         self.logger = logging.getLogger(__name__)
@@ -85,7 +94,8 @@ class SystemInfo(object):
         self.repofile_pkgs = self._get_repofile_pkgs()
         self.default_rhsm_repoids = self._get_default_rhsm_repoids()
         self.fingerprints_orig_os = self._get_gpg_key_fingerprints()
-        self.generate_rpm_va()
+        # Let the verification run while the preparation steps, which don't change the system, are being done
+        self.generate_rpm_va(background=True)
         self.releasever = self._get_releasever()
 
     @staticmethod
@@ -174,12 +184,15 @@ class SystemInfo(object):
     def _get_releasever(self):
         return self._get_cfg_opt("releasever")
 
-    def generate_rpm_va(self, log_filename=PRE_RPM_VA_LOG_FILENAME):
+    def generate_rpm_va(self, log_filename=PRE_RPM_VA_LOG_FILENAME, background=False):
         """RPM is able to detect if any file installed as part of a package has been changed in any way after the
         package installation.
 
         Here we are getting a list of changed package files of all the installed packages. Such a list is useful for
-        debug and support purposes. It's being saved to the default log folder as log_filename."""
+        debug and support purposes. It's being saved to the default log folder as log_filename.
+
+        With background=True the verification runs in a background process and wait_for_rpm_va() needs to be called
+        before any change to the installed packages or their files is made."""
         if tool_opts.no_rpm_va:
             self.logger.info("Skipping the execution of 'rpm -Va'.")
             return
@@ -187,30 +200,86 @@ class SystemInfo(object):
         self.logger.info("Running the 'rpm -Va' command which can take several"
                          " minutes. It can be disabled by using the"
                          " --no-rpm-va option.")
-        rpm_va, _ = utils.run_subprocess("rpm -Va", print_output=False)
-        output_file = os.path.join(logger.LOG_DIR, log_filename)
-        utils.store_content_to_file(output_file, rpm_va)
-        self.logger.info("The 'rpm -Va' output has been stored in the %s file" % output_file)
+        # After the conversion, verify just the packages changed since the verification before the conversion
+        previous = self.rpm_va_result if log_filename == POST_RPM_VA_LOG_FILENAME else None
+        # Other than that, verify just the packages changed since the previous run of the tool
+        profile = rpmverify.VerificationProfile(tool_opts.rpm_va_profile, tool_opts.rpm_va_exclude)
+        if profile != rpmverify.VerificationProfile():
+            self.logger.info("Using the '%s' verification profile." % profile)
+        self._rpm_va = rpmverify.BackgroundVerification(previous=previous, cache=pkgcache.rpm_va_cache,
+                                                        profile=profile)
+        self._rpm_va_log_filename = log_filename
+        self._rpm_va.start()
+        if background:
+            self.logger.info("The 'rpm -Va' command is running in the background.")
+        else:
+            self.wait_for_rpm_va()
+
+    def wait_for_rpm_va(self):
+        """Wait for the 'rpm -Va' started by generate_rpm_va() to finish and store its output.
+
+        Does nothing when no verification is running. When the verification fails, rpm_va_result is left None.
+        """
+        if not self._rpm_va:
+            return
+        rpm_va, self._rpm_va = self._rpm_va, None
+        self.rpm_va_result = rpm_va.wait()
+        if self.rpm_va_result is None:
+            return
+        output_file = os.path.join(logger.LOG_DIR, self._rpm_va_log_filename)
+        utils.store_content_to_file(output_file, self.rpm_va_result.output)
+        self.logger.info("The 'rpm -Va' output has been stored in the %s file. Verification profile: %s"
+                         % (output_file, self.rpm_va_result.profile))
 
     def modified_rpm_files_diff(self):
         """Get a list of modified rpm files after the conversion and compare it to the one from before the conversion.
+
+        The changes are logged grouped by package and exported to a JSON file in the log folder.
         """
+        pre_rpm_va_result = self.rpm_va_result
         self.generate_rpm_va(log_filename=POST_RPM_VA_LOG_FILENAME)
 
-        pre_rpm_va_log_path = os.path.join(logger.LOG_DIR, PRE_RPM_VA_LOG_FILENAME)
-        if not os.path.exists(pre_rpm_va_log_path):
+        if pre_rpm_va_result is None or self.rpm_va_result is None or self.rpm_va_result is pre_rpm_va_result:
+            # One of the verifications has not been done
             self.logger.info("Skipping comparison of the 'rpm -Va' output from before and after the conversion.")
             return
-        pre_rpm_va = utils.get_file_content(pre_rpm_va_log_path, True)
-        post_rpm_va_log_path = os.path.join(logger.LOG_DIR, POST_RPM_VA_LOG_FILENAME)
-        post_rpm_va = utils.get_file_content(post_rpm_va_log_path, True)
-        modified_rpm_files_diff = "\n".join(
-            difflib.unified_diff(pre_rpm_va, post_rpm_va, fromfile=pre_rpm_va_log_path, tofile=post_rpm_va_log_path,
-                                 n=0, lineterm=""))
-
-        if modified_rpm_files_diff:
+        if pre_rpm_va_result.profile != self.rpm_va_result.profile:
+            self.logger.warning("Not comparing the 'rpm -Va' output from before and after the conversion as they have"
+                                " been made with different verification profiles: '%s' and '%s'."
+                                % (pre_rpm_va_result.profile, self.rpm_va_result.profile))
+            return
+        changes = rpmverify.compare_verified_files(rpmverify.get_verified_files(pre_rpm_va_result),
+                                                   rpmverify.get_verified_files(self.rpm_va_result))
+
+        changes_per_pkg = []
+        for change in changes:
+            if not changes_per_pkg or changes_per_pkg[-1][0] != change.pkg:
+                changes_per_pkg.append((change.pkg, []))
+            changes_per_pkg[-1][1].append(change)
+
+        diff_file = os.path.join(logger.LOG_DIR, RPM_VA_DIFF_FILENAME)
+        utils.store_content_to_file(diff_file, json.dumps({
+            "profile": str(self.rpm_va_result.profile),
+            "packages": [{"package": pkg, "changes": [{"change": change.change, "path": change.path,
+                                                       "file_type": change.file_type,
+                                                       "flags_before": change.flags_before,
+                                                       "flags_after": change.flags_after} for change in pkg_changes]}
+                         for pkg, pkg_changes in changes_per_pkg]}, indent=2))
+
+        if changes:
+            report = []
+            for pkg, pkg_changes in changes_per_pkg:
+                report.append("%s:" % (pkg or "Files of unknown packages"))
+                for change in pkg_changes:
+                    if change.change == rpmverify.FILE_FLAGS_CHANGED:
+                        flags = "%s -> %s" % (change.flags_before, change.flags_after)
+                    else:
+                        flags = change.flags_after or change.flags_before
+                    report.append("    %-13s %s %1s %s" % (change.change, flags, change.file_type, change.path))
             self.logger.info(
-                "Comparison of modified rpm files from before and after the conversion:\n%s" % modified_rpm_files_diff)
+                "Comparison of modified rpm files from before and after the conversion:\n%s" % "\n".join(report))
+        self.logger.info("The comparison of the 'rpm -Va' output from before and after the conversion has been stored"
+                         " in the %s file" % diff_file)
 
 
 # Code to be executed upon module import
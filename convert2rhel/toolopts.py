@@ -40,6 +40,10 @@ class ToolOpts(object):
         self.org = None
         self.arch = None
         self.no_rpm_va = False
+        self.rpm_va_profile = "full"
+        self.rpm_va_exclude = []
+        self.offline_pkg_backup = False
+        self.pkg_store_seed = None
         self.disable_colors = False
 
         # set True when credentials (username & password) are given through CLI
@@ -66,8 +70,15 @@ class CLI(object):
                  " -a] [--disablerepo repoid] [--enablerepo repoid] [-v"
                  " variant] [--serverurl url] [--no-rpm-va] [--debug]"
                  " [--restart] [--disable-colors] [-y]")
+        # Importing here instead of on top of the file to keep the imports of this module minimal
+        from convert2rhel.pkgcache import PKG_INVENTORY_CACHE_PATH
+        epilog = ("The fingerprints of the keys the installed packages are signed with are cached in %s and reused"
+                  " by the next run of the tool in case the installed packages have not changed. The content of"
+                  " the cache can be inspected by running 'python -m convert2rhel.pkgcache [--list]'."
+                  % PKG_INVENTORY_CACHE_PATH)
         return optparse.OptionParser(conflict_handler='resolve',
                                      usage=usage,
+                                     epilog=epilog,
                                      add_help_option=False)
 
     def _register_options(self):
@@ -80,12 +91,29 @@ class CLI(object):
         self._parser.add_option("--disable-colors", action="store_true", help="Disable color output")
         # Importing here instead of on top of the file to avoid cyclic dependency
         from convert2rhel.systeminfo import PRE_RPM_VA_LOG_FILENAME, POST_RPM_VA_LOG_FILENAME
+        from convert2rhel.rpmverify import DEFAULT_PROFILE, PROFILES
         self._parser.add_option("--no-rpm-va", action="store_true", help="Skip gathering changed rpm files using"
                                                                          " 'rpm -Va'. By default it's performed before and after the conversion with the output"
                                                                          " stored in log files %s and %s. At the end of the conversion, these logs are compared"
                                                                          " to show you what rpm files have been affected by the conversion."
                                                                          % (PRE_RPM_VA_LOG_FILENAME,
                                                                             POST_RPM_VA_LOG_FILENAME))
+        self._parser.add_option("--rpm-va-profile", type="choice", choices=sorted(PROFILES.keys()),
+                                default=DEFAULT_PROFILE, help="What to check when gathering changed rpm files."
+                                " 'full' runs all the checks of 'rpm -Va', 'metadata-only' skips the checksums of the"
+                                " file contents which avoids reading all the installed files and 'config-files-only'"
+                                " checks just the configuration files. Defaults to '%s'." % DEFAULT_PROFILE)
+        self._parser.add_option("--rpm-va-exclude", metavar="pathglob", action="append",
+                                help="Do not report changes of rpm files matching the path glob when gathering"
+                                " changed rpm files. Packages with all their files excluded are not checked at all."
+                                " To exclude more paths, use this option multiple times.")
+        self._parser.add_option("--offline-pkg-backup", action="store_true", help="Back up the packages removed"
+                                " during the conversion from the rpm database and the installed files instead of"
+                                " downloading them from the original repositories. Without this option, only the"
+                                " packages that fail to be downloaded are backed up this way.")
+        self._parser.add_option("--pkg-store-seed", metavar="directory", help="Directory with rpm files, e.g. on"
+                                " an NFS share, to take the packages from instead of downloading them. A package is"
+                                " taken from the directory only when its checksum matches the repository metadata.")
         self._parser.add_option("--enablerepo", metavar="repoidglob",
                                 action="append", help="Enable specific"
                                                       " repositories by ID or glob. For more repositories to enable, use this option"
@@ -180,6 +208,16 @@ class CLI(object):
         if parsed_opts.no_rpm_va:
             tool_opts.no_rpm_va = True
 
+        if parsed_opts.offline_pkg_backup:
+            tool_opts.offline_pkg_backup = True
+
+        if parsed_opts.pkg_store_seed:
+            tool_opts.pkg_store_seed = parsed_opts.pkg_store_seed
+
+        tool_opts.rpm_va_profile = parsed_opts.rpm_va_profile
+        if parsed_opts.rpm_va_exclude:
+            tool_opts.rpm_va_exclude = parsed_opts.rpm_va_exclude
+
         if parsed_opts.username:
             tool_opts.username = parsed_opts.username
 
@@ -171,6 +171,20 @@ class CountableMockObject(MockFunction):
         return
 
 
+class RunSubprocessSequenceMocked(MockFunction):
+    """Mock of utils.run_subprocess recording the commands and returning the passed (output, return code) tuples in
+    order. Once they run out, ("", 0) is returned.
+    """
+
+    def __init__(self, results=None):
+        self.results = list(results or [])
+        self.cmds = []
+
+    def __call__(self, cmd, print_cmd=True, print_output=True, **kwargs):
+        self.cmds.append(cmd)
+        return self.results.pop(0) if self.results else ("", 0)
+
+
 def is_rpm_based_os():
     """Check if the OS is rpm based."""
     try:
@@ -185,6 +199,7 @@ def is_rpm_based_os():
 class GetLoggerMocked(MockFunction):
     def __init__(self):
         self.info_msgs = []
+        self.warning_msgs = []
         self.critical_msgs = []
 
     def __call__(self, msg):
@@ -200,5 +215,8 @@ class GetLoggerMocked(MockFunction):
     def info(self, msg):
         pass
 
+    def warning(self, msg):
+        self.warning_msgs.append(msg)
+
     def debug(self, msg):
         pass
@@ -135,8 +135,10 @@ class TestMain(unittest.TestCase):
     @unit_tests.mock(redhatrelease.yum_conf, "restore", unit_tests.CountableMockObject())
     @unit_tests.mock(subscription, "rollback", unit_tests.CountableMockObject())
     @unit_tests.mock(pkghandler.versionlock_file, "restore", unit_tests.CountableMockObject())
+    @unit_tests.mock(pkghandler, "clean_staged_pkgs", unit_tests.CountableMockObject())
     def test_rollback_changes(self):
         main.rollback_changes()
+        self.assertEqual(pkghandler.clean_staged_pkgs.called, 1)
         self.assertEqual(utils.changed_pkgs_control.restore_pkgs.called, 1)
         self.assertEqual(redhatrelease.system_release_file.restore.called, 1)
         self.assertEqual(redhatrelease.yum_conf.restore.called, 1)
@@ -151,12 +153,14 @@ class TestMain(unittest.TestCase):
     @mock_calls(pkghandler, "remove_repofile_pkgs", CallOrderMocked)
     @mock_calls(cert.SystemCert, "install", CallOrderMocked)
     @mock_calls(redhatrelease.YumConf, "patch", CallOrderMocked)
+    @mock_calls(pkghandler, "stage_rhel_pkgs", CallOrderMocked)
     @mock_calls(pkghandler, "list_third_party_pkgs", CallOrderMocked)
     @mock_calls(subscription, "subscribe_system", CallOrderMocked)
     @mock_calls(repo, "get_rhel_repoids", CallOrderMocked)
     @mock_calls(subscription, "check_needed_repos_availability", CallOrderMocked)
     @mock_calls(subscription, "disable_repos", CallOrderMocked)
     @mock_calls(subscription, "enable_repos", CallOrderMocked)
+    @mock_calls(pkghandler, "warm_up_repo_metadata", CallOrderMocked)
     @mock_calls(subscription, "download_rhsm_pkgs", CallOrderMocked)
     def test_pre_ponr_conversion_order_with_rhsm(self):
         self.CallOrderMocked.reset()
@@ -173,8 +177,10 @@ class TestMain(unittest.TestCase):
         intended_call_order["check_needed_repos_availability"] = 1
         intended_call_order["disable_repos"] = 1
         intended_call_order["enable_repos"] = 1
+        intended_call_order["warm_up_repo_metadata"] = 1
         intended_call_order["remove_repofile_pkgs"] = 1
         intended_call_order["patch"] = 1
+        intended_call_order["stage_rhel_pkgs"] = 1
 
         # Merge the two together like a zipper, creates a tuple which we can assert with - including method call order!
         zipped_call_order = zip(intended_call_order.items(), self.CallOrderMocked.calls.items())
@@ -190,12 +196,14 @@ class TestMain(unittest.TestCase):
     @mock_calls(pkghandler, "remove_repofile_pkgs", CallOrderMocked)
     @mock_calls(cert.SystemCert, "install", CallOrderMocked)
     @mock_calls(redhatrelease.YumConf, "patch", CallOrderMocked)
+    @mock_calls(pkghandler, "stage_rhel_pkgs", CallOrderMocked)
     @mock_calls(pkghandler, "list_third_party_pkgs", CallOrderMocked)
     @mock_calls(subscription, "subscribe_system", CallOrderMocked)
     @mock_calls(repo, "get_rhel_repoids", CallOrderMocked)
     @mock_calls(subscription, "check_needed_repos_availability", CallOrderMocked)
     @mock_calls(subscription, "disable_repos", CallOrderMocked)
     @mock_calls(subscription, "enable_repos", CallOrderMocked)
+    @mock_calls(pkghandler, "warm_up_repo_metadata", CallOrderMocked)
     @mock_calls(subscription, "download_rhsm_pkgs", CallOrderMocked)
     def test_pre_ponr_conversion_order_without_rhsm(self):
         self.CallOrderMocked.reset()
@@ -216,8 +224,10 @@ class TestMain(unittest.TestCase):
         intended_call_order["disable_repos"] = 0
         intended_call_order["enable_repos"] = 0
 
+        intended_call_order["warm_up_repo_metadata"] = 1
         intended_call_order["remove_repofile_pkgs"] = 1
         intended_call_order["patch"] = 1
+        intended_call_order["stage_rhel_pkgs"] = 1
 
         # Merge the two together like a zipper, creates a tuple which we can assert with - including method call order!
         zipped_call_order = zip(intended_call_order.items(), self.CallOrderMocked.calls.items())
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import grp
+import hashlib
+import os
+import pwd
+import shutil
+import stat
+import struct
+import tempfile
+
+import pytest
+import rpm
+
+from convert2rhel import pkgarchive
+from convert2rhel import unit_tests  # Imports unit_tests/__init__.py
+from convert2rhel import utils
+from convert2rhel.unit_tests import is_rpm_based_os
+
+
+class RunSubprocessMocked(unit_tests.MockFunction):
+    def __init__(self, ret_code=0):
+        self.cmds = []
+        self.rpm_files = []
+        self.ret_code = ret_code
+
+    def __call__(self, cmd, print_cmd=True, print_output=True):
+        self.cmds.append(cmd)
+        if cmd.startswith("selinuxenabled"):
+            return "", 1
+        if cmd.startswith("rpm -i "):
+            # The package file is removed after the call
+            with open(cmd.split()[-1], "rb") as rpm_file:
+                self.rpm_files.append(rpm_file.read())
+        return "", self.ret_code
+
+
+class Hdr(dict):
+    def unload(self):
+        return b"header blob"
+
+
+def create_pkg(root):
+    """Create the files of a package in the root directory and return its header."""
+    user = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    os.makedirs(os.path.join(root, "etc", "pkg1"))
+    files = [
+        (os.path.join(root, "etc", "pkg1"), stat.S_IFDIR | 0o755, 0, b"", ""),
+        (os.path.join(root, "etc", "pkg1", "pkg1.conf"), stat.S_IFREG | 0o644, 1, b"original\n", ""),
+        (os.path.join(root, "etc", "pkg1", "data"), stat.S_IFREG | 0o600, 0, b"data\n", ""),
+        (os.path.join(root, "etc", "pkg1", "link"), stat.S_IFLNK | 0o777, 0, b"", "data"),
+        (os.path.join(root, "etc", "pkg1", "ghost"), stat.S_IFREG | 0o644, rpm.RPMFILE_GHOST, b"", ""),
+        (os.path.join(root, "etc", "pkg1", "nodocs"), stat.S_IFREG | 0o644, 0, b"doc\n", ""),
+        (os.path.join(root, "etc", "pkg1", "hardlink"), stat.S_IFREG | 0o600, 0, b"data\n", ""),
+    ]
+    for path, mode, _, content, link_to in files:
+        if path.endswith("hardlink"):
+            os.link(files[2][0], path)
+        elif stat.S_ISREG(mode) and not path.endswith(("ghost", "nodocs")):
+            with open(path, "wb") as f:
+                f.write(content)
+        elif stat.S_ISLNK(mode):
+            os.symlink(link_to, path)
+    # The configuration file has been modified since the installation
+    with open(files[1][0], "wb") as f:
+        f.write(b"modified\n")
+
+    return Hdr({
+        rpm.RPMTAG_NAME: "pkg1", rpm.RPMTAG_EPOCH: None, rpm.RPMTAG_VERSION: "1.0", rpm.RPMTAG_RELEASE: "1.el7",
+        rpm.RPMTAG_ARCH: "x86_64", rpm.RPMTAG_FILEDIGESTALGO: 8,
+        rpm.RPMTAG_FILENAMES: [path for path, _, _, _, _ in files],
+        rpm.RPMTAG_FILEMODES: [mode for _, mode, _, _, _ in files],
+        rpm.RPMTAG_FILEFLAGS: [flags for _, _, flags, _, _ in files],
+        rpm.RPMTAG_FILEDIGESTS: [hashlib.sha256(content).hexdigest() if stat.S_ISREG(mode) else ""
+                                 for _, mode, _, content, _ in files],
+        rpm.RPMTAG_FILELINKTOS: [link_to for _, _, _, _, link_to in files],
+        rpm.RPMTAG_FILEUSERNAME: [user] * len(files),
+        rpm.RPMTAG_FILEGROUPNAME: [group] * len(files),
+        rpm.RPMTAG_FILEMTIMES: [1600000000] * len(files),
+        rpm.RPMTAG_FILECAPS: ["", "", "cap_net_raw=ep", "", "", "", "cap_net_raw=ep"],
+        # The data file and the hardlink share the inode
+        rpm.RPMTAG_FILEINODES: [1, 2, 3, 4, 5, 6, 3],
+    })
+
+
+class TransactionSetMocked(object):
+    def __init__(self, hdrs):
+        self.hdrs = hdrs
+
+    def __call__(self):
+        return self
+
+    def dbMatch(self):  # pylint: disable=invalid-name
+        return iter(self.hdrs)
+
+
+class TestPkgArchive(unit_tests.ExtendedTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    @unit_tests.mock(pkgarchive.logging, "getLogger", unit_tests.GetLoggerMocked())
+    def test_archive_and_restore_pkg(self):
+        root = os.path.join(self.tmp_dir, "root")
+        archive_dir = os.path.join(self.tmp_dir, "archive")
+        hdr = create_pkg(root)
+
+        archived_pkg = pkgarchive.archive_pkg(hdr, archive_dir)
+
+        # The ghost file and the file not installed are not archived
+        self.assertEqual([archived_file.path for archived_file in archived_pkg.files],
+                         hdr[rpm.RPMTAG_FILENAMES][:4] + hdr[rpm.RPMTAG_FILENAMES][6:])
+        # The modified configuration file is archived as it is on the disk
+        self.assertEqual(archived_pkg.files[1].digest, hashlib.sha256(b"modified\n").hexdigest())
+        self.assertEqual(archived_pkg.files[2].digest, hdr[rpm.RPMTAG_FILEDIGESTS][2])
+
+        os.remove(os.path.join(root, "etc", "pkg1", "hardlink"))
+        os.remove(os.path.join(root, "etc", "pkg1", "link"))
+        os.remove(os.path.join(root, "etc", "pkg1", "data"))
+        os.remove(os.path.join(root, "etc", "pkg1", "pkg1.conf"))
+        os.rmdir(os.path.join(root, "etc", "pkg1"))
+
+        self.assertTrue(archived_pkg.restore())
+
+        with open(os.path.join(root, "etc", "pkg1", "pkg1.conf"), "rb") as f:
+            self.assertEqual(f.read(), b"modified\n")
+        # The file modified before the backup is reported, compared to the digest in the rpm header
+        warning_msgs = pkgarchive.logging.getLogger.warning_msgs
+        self.assertEqual(len(warning_msgs), 1)
+        self.assertIn("modified before pkg1-1.0-1.el7.x86_64 was backed up", warning_msgs[0])
+        self.assertTrue(warning_msgs[0].endswith("restored as modified:\n%s"
+                                                 % os.path.join(root, "etc", "pkg1", "pkg1.conf")))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(root, "etc", "pkg1", "data")).st_mode), 0o600)
+        self.assertEqual(os.stat(os.path.join(root, "etc", "pkg1", "data")).st_mtime, 1600000000)
+        self.assertEqual(os.readlink(os.path.join(root, "etc", "pkg1", "link")), "data")
+        self.assertTrue(os.path.samefile(os.path.join(root, "etc", "pkg1", "hardlink"),
+                                         os.path.join(root, "etc", "pkg1", "data")))
+        # The package is registered in the rpm db using a package file with the archived header
+        self.assertTrue(utils.run_subprocess.cmds[0].startswith("rpm -i --justdb "))
+        self.assertTrue(utils.run_subprocess.rpm_files[0].endswith(b"header blob"))
+        # The file capabilities are restored once the package is registered
+        if getattr(rpm, "__version_info__", (0,)) >= (4, 11):
+            self.assertEqual(utils.run_subprocess.cmds[1], "rpm --restore pkg1-1.0-1.el7.x86_64")
+        else:
+            self.assertEqual(utils.run_subprocess.cmds[1],
+                             'setcap "cap_net_raw=ep" "%s"' % os.path.join(root, "etc", "pkg1", "data"))
+
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    def test_restore_pkg_with_corrupted_file(self):
+        root = os.path.join(self.tmp_dir, "root")
+        archive_dir = os.path.join(self.tmp_dir, "archive")
+        hdr = create_pkg(root)
+        archived_pkg = pkgarchive.archive_pkg(hdr, archive_dir)
+        os.remove(os.path.join(root, "etc", "pkg1", "data"))
+        with open(pkgarchive.get_object_path(archived_pkg.files[2].digest, archive_dir), "wb") as f:
+            f.write(b"corrupted\n")
+
+        self.assertFalse(archived_pkg.restore())
+
+        # No file with unverified content is left behind and the package is not registered
+        self.assertEqual(sorted(os.listdir(os.path.join(root, "etc", "pkg1"))), ["link", "pkg1.conf"])
+        self.assertEqual(utils.run_subprocess.cmds, [])
+
+    @unit_tests.mock(rpm, "TransactionSet", TransactionSetMocked(
+        [Hdr({rpm.RPMTAG_NAME: name, rpm.RPMTAG_EPOCH: None, rpm.RPMTAG_VERSION: "1.0", rpm.RPMTAG_RELEASE: "1",
+              rpm.RPMTAG_ARCH: "noarch"}) for name in ("pkg1", "pkg2", "pkg3")]))
+    @unit_tests.mock(pkgarchive, "archive_pkg", lambda hdr, archive_dir: "archived %s" % hdr[rpm.RPMTAG_NAME])
+    def test_archive_pkgs(self):
+        archived = pkgarchive.archive_pkgs(["pkg1", "pkg3-1.0-1.noarch", "pkg4"], "/archive")
+
+        self.assertEqual(archived, {"pkg1": "archived pkg1", "pkg3-1.0-1.noarch": "archived pkg3", "pkg4": None})
+
+    def _get_archived_pkg_to_register(self):
+        hdr_path = os.path.join(self.tmp_dir, "pkg1.hdr")
+        with open(hdr_path, "wb") as hdr_file:
+            hdr_file.write(b"header blob")
+        return pkgarchive.ArchivedPackage("pkg1-1.0-1.el7.x86_64", hdr_path, "sha256", [], self.tmp_dir)
+
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    def test_register(self):
+        archived_pkg = self._get_archived_pkg_to_register()
+
+        self.assertTrue(archived_pkg._register())  # pylint: disable=protected-access
+
+        cmd = utils.run_subprocess.cmds[0]
+        self.assertTrue(cmd.startswith("rpm -i --justdb --nodeps --noscripts --notriggers --nosignature --nodigest"
+                                       " --replacepkgs --replacefiles "))
+        self.assertTrue(cmd.endswith("/pkg1-1.0-1.el7.x86_64.rpm"))
+        self.assertTrue(utils.run_subprocess.rpm_files[0].startswith(b"\xed\xab\xee\xdb"))
+        self.assertTrue(utils.run_subprocess.rpm_files[0].endswith(b"\x8e\xad\xe8\x01\x00\x00\x00\x00header blob"))
+        # The package file is removed after the call
+        self.assertFalse(os.path.exists(os.path.dirname(cmd.split()[-1])))
+
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked(ret_code=1))
+    @unit_tests.mock(pkgarchive.logging, "getLogger", unit_tests.GetLoggerMocked())
+    def test_register_error(self):
+        archived_pkg = self._get_archived_pkg_to_register()
+
+        self.assertFalse(archived_pkg.restore())
+
+        self.assertTrue(pkgarchive.logging.getLogger.warning_msgs[0].startswith(
+            "Couldn't register pkg1-1.0-1.el7.x86_64 in the rpm db"))
+        # Nothing else is done for a package failing to be registered
+        self.assertEqual(len(utils.run_subprocess.cmds), 1)
+        self.assertFalse(os.path.exists(os.path.dirname(utils.run_subprocess.cmds[0].split()[-1])))
+
+    def test_store_file_deduplicates(self):
+        archive_dir = os.path.join(self.tmp_dir, "archive")
+        paths = [os.path.join(self.tmp_dir, "file1"), os.path.join(self.tmp_dir, "file2")]
+        for path in paths:
+            with open(path, "wb") as f:
+                f.write(b"content")
+
+        digest1 = pkgarchive.store_file(paths[0], "sha256", archive_dir)
+        digest2 = pkgarchive.store_file(paths[1], "sha256", archive_dir)
+
+        self.assertEqual(digest1, hashlib.sha256(b"content").hexdigest())
+        self.assertEqual(digest2, digest1)
+        self.assertEqual(os.listdir(os.path.join(archive_dir, "objects")), [digest1[:2]])
+        self.assertEqual(os.listdir(os.path.join(archive_dir, "objects", digest1[:2])), [digest1])
+
+    def test_write_header_only_rpm(self):
+        path = os.path.join(self.tmp_dir, "pkg1.rpm")
+
+        pkgarchive.write_header_only_rpm(b"header blob", "pkg1-1.0-1.el7.x86_64", path)
+
+        with open(path, "rb") as rpm_file:
+            content = rpm_file.read()
+        self.assertEqual(content[:4], b"\xed\xab\xee\xdb")
+        self.assertEqual(content[10:31], b"pkg1-1.0-1.el7.x86_64")
+        # An empty signature header follows the 96 bytes long lead, then the header with the header magic
+        self.assertEqual(content[96:104], b"\x8e\xad\xe8\x01\x00\x00\x00\x00")
+        self.assertEqual(struct.unpack(">ii", content[104:112]), (1, 16))
+        self.assertEqual(content[144:], b"\x8e\xad\xe8\x01\x00\x00\x00\x00header blob")
+
+    @pytest.mark.skipif(not is_rpm_based_os(), reason="Current test runs only on rpm based systems.")
+    def test_register_header_only_rpm(self):
+        # A real header of an installed package, registered into a scratch rpm db
+        hdr = list(rpm.TransactionSet().dbMatch("name", "rpm"))[0]
+        name, _, version, release, arch = pkgarchive._get_hdr_nevra(hdr)  # pylint: disable=protected-access
+        nvra = "%s-%s-%s.%s" % (name, version, release, arch)
+        path = os.path.join(self.tmp_dir, "%s.rpm" % nvra)
+        dbpath = os.path.join(self.tmp_dir, "rpmdb")
+        pkgarchive.write_header_only_rpm(hdr.unload(), nvra, path)
+
+        _, ret_code = utils.run_subprocess("rpm --initdb --dbpath %s" % dbpath, print_output=False)
+        self.assertEqual(ret_code, 0)
+        output, ret_code = utils.run_subprocess("%s --dbpath %s %s" % (pkgarchive._REGISTER_CMD, dbpath, path),
+                                                print_output=False)
+        self.assertEqual(ret_code, 0, output)
+
+        output, ret_code = utils.run_subprocess("rpm -q --dbpath %s %s" % (dbpath, nvra), print_output=False)
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(output.strip(), nvra)
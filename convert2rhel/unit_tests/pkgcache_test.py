@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from convert2rhel import pkgcache
+
+
+class PkgObj(object):
+    def __init__(self, name, installtime=1600000000):
+        self.name = name
+        self.epoch = 0
+        self.version = "1.0"
+        self.release = "1.el8"
+        self.arch = "x86_64"
+        self.installtime = installtime
+
+
+class TestPkgCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_pkg_key(self):
+        self.assertEqual(pkgcache.get_pkg_key(PkgObj("pkg1")), ("pkg1", "0", "1.0", "1.el8", "x86_64", 1600000000))
+        # A reinstalled package gets a different key
+        self.assertNotEqual(pkgcache.get_pkg_key(PkgObj("pkg1")),
+                            pkgcache.get_pkg_key(PkgObj("pkg1", installtime=1600000001)))
+        # No installation time, no key
+        self.assertEqual(pkgcache.get_pkg_key(PkgObj("pkg1", installtime=None)), None)
+
+    def test_pkg_inventory_cache_save_and_load(self):
+        cache = pkgcache.PkgInventoryCache(os.path.join(self.tmp_dir, "cache.sqlite"))
+        self.assertEqual(cache.load(), {})
+        self.assertEqual(cache.get_rpmdb_state(), None)
+
+        fingerprints = {pkgcache.get_pkg_key(PkgObj("pkg1")): "199e2f91fd431d51",
+                        pkgcache.get_pkg_key(PkgObj("pkg2")): "none"}
+        cache.save((("Packages", 1, 2, 3.0),), fingerprints)
+
+        self.assertEqual(cache.load(), fingerprints)
+        self.assertEqual(cache.get_rpmdb_state(), repr((("Packages", 1, 2, 3.0),)))
+
+        # Saving replaces the whole content, e.g. removed packages are dropped
+        del fingerprints[pkgcache.get_pkg_key(PkgObj("pkg2"))]
+        cache.save("new state", fingerprints)
+
+        self.assertEqual(cache.load(), fingerprints)
+
+    def test_pkg_inventory_cache_invalidated_on_rpmdb_change(self):
+        cache = pkgcache.PkgInventoryCache(os.path.join(self.tmp_dir, "cache.sqlite"))
+        fingerprints = {pkgcache.get_pkg_key(PkgObj("pkg1")): "199e2f91fd431d51"}
+        cache.save((("Packages", 1, 2, 3.0),), fingerprints)
+
+        self.assertEqual(cache.load((("Packages", 1, 2, 3.0),)), fingerprints)
+        # E.g. pkg1 reinstalled from a build signed by a different key, keeping the installation time
+        self.assertEqual(cache.load((("Packages", 1, 4, 5.0),)), {})
+
+    def test_pkg_inventory_cache_discarded_on_schema_change(self):
+        path = os.path.join(self.tmp_dir, "cache.sqlite")
+        cache = pkgcache.PkgInventoryCache(path)
+        cache.save("state", {pkgcache.get_pkg_key(PkgObj("pkg1")): "199e2f91fd431d51"})
+
+        conn = sqlite3.connect(path)
+        conn.execute("UPDATE meta SET value = 'old' WHERE key = 'schema_version'")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(cache.load(), {})
+
+    def test_pkg_inventory_cache_not_saved_without_dir(self):
+        cache = pkgcache.PkgInventoryCache(os.path.join(self.tmp_dir, "nonexisting_dir", "cache.sqlite"))
+        cache.save("state", {pkgcache.get_pkg_key(PkgObj("pkg1")): "199e2f91fd431d51"})
+
+        self.assertFalse(os.path.exists(cache.path))
+        self.assertEqual(cache.load(), {})
@@ -25,8 +25,10 @@ import pytest
 import rpm
 
 from convert2rhel import logger
+from convert2rhel import pkgcache
 from convert2rhel import pkghandler
 from convert2rhel import pkgmanager
+from convert2rhel import pkgstore
 from convert2rhel import utils
 from convert2rhel import unit_tests  # Imports unit_tests/__init__.py
 from convert2rhel.systeminfo import system_info
@@ -34,6 +36,40 @@ from convert2rhel.toolopts import tool_opts
 from convert2rhel.unit_tests import is_rpm_based_os
 
 
+def create_v4_sig(key_id, hashed_issuer=False):
+    """Create a V4 OpenPGP signature packet (new packet format) with the issuer subpacket holding the key_id."""
+    creation_time_subpkt = bytearray([5, 2, 0x56, 0xb7, 0x84, 0x4c])
+    issuer_subpkt = bytearray([9, 16]) + bytearray.fromhex(key_id)
+    hashed = creation_time_subpkt + (issuer_subpkt if hashed_issuer else bytearray())
+    unhashed = bytearray() if hashed_issuer else issuer_subpkt
+    body = bytearray([4, 0, 1, 8]) + bytearray([len(hashed) >> 8, len(hashed) & 0xff]) + hashed \
+        + bytearray([len(unhashed) >> 8, len(unhashed) & 0xff]) + unhashed + bytearray([0xab, 0xcd]) \
+        + bytearray(260)  # hash prefix and a dummy MPI
+    return bytes(bytearray([0xc2, 192 + ((len(body) - 192) >> 8), (len(body) - 192) & 0xff]) + body)
+
+
+def create_v3_sig(key_id):
+    """Create a V3 OpenPGP signature packet (old packet format, two-octet length) made by the key_id."""
+    body = bytearray([3, 5, 0, 0x56, 0xb7, 0x84, 0x4c]) + bytearray.fromhex(key_id) + bytearray([1, 2, 0xab, 0xcd]) \
+        + bytearray(130)
+    return bytes(bytearray([0x89, len(body) >> 8, len(body) & 0xff]) + body)
+
+
+def _kernel(version_release, from_repo):
+    version, release = version_release.split("-")
+    return pkghandler.PkgRecord("kernel", "0", version, release, "x86_64", from_repo=from_repo)
+
+
+# (available, installed) kernels
+KERNELS_OLDER_AVAILABLE = ([_kernel("4.5.5-300.fc24", "fedora"), _kernel("4.7.2-201.fc24", "updates"),
+                            _kernel("4.7.4-200.fc24", "updates")],
+                           [_kernel("4.7.4-200.fc24", "updates")])
+KERNELS_OLDER_NOT_AVAILABLE = ([_kernel("4.7.4-200.fc24", "updates")], [_kernel("4.7.4-200.fc24", "updates")])
+KERNELS_OLDER_NOT_AVAILABLE_MULTIPLE_INSTALLED = ([_kernel("4.7.4-200.fc24", "updates")],
+                                                  [_kernel("4.7.2-201.fc24", "updates"),
+                                                   _kernel("4.7.4-200.fc24", "updates")])
+
+
 class TestPkgHandler(unit_tests.ExtendedTestCase):
     class GetInstalledPkgsWithFingerprintMocked(unit_tests.MockFunction):
         def __init__(self, data=None):
@@ -59,6 +95,10 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
                 self.return_code = 0
             self.called += 1
             self.command = command
+            error_parser = kwargs.get("error_parser")
+            if error_parser:
+                for line in self.return_string.splitlines(True):
+                    error_parser.feed(line)
             return self.return_string, self.return_code
 
     class GetInstalledPkgsByFingerprintMocked(unit_tests.MockFunction):
@@ -73,7 +113,7 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
             self.output = output_text
             self.ret_code = 0
 
-        def __call__(self, cmd, print_cmd=True, print_output=True):
+        def __call__(self, cmd, print_cmd=True, print_output=True, **kwargs):
             self.cmd = cmd
             self.cmds += "%s\n" % cmd
             self.called += 1
@@ -221,6 +261,73 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
         self.assertEqual(utils.run_subprocess.cmd,
                          "yum install -y --disablerepo=disable-repo --enablerepo=enable-repo pkg")
 
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(pkghandler.repo_metadata, "warm", True)
+    @unit_tests.mock(tool_opts, "disablerepo", ["*"])
+    @unit_tests.mock(system_info, "submgr_enabled_repos", ["rhel-7-server-rpms"])
+    @unit_tests.mock(utils, "run_subprocess", unit_tests.RunSubprocessSequenceMocked([]))
+    def test_call_yum_cmd_w_cached_metadata(self):
+        pkghandler.call_yum_cmd("install", "pkg")
+
+        self.assertEqual(utils.run_subprocess.cmds, ["yum --setopt=*.metadata_expire=never install -y --disablerepo=*"
+                                                     " --enablerepo=rhel-7-server-rpms pkg"])
+
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(pkghandler.repo_metadata, "warm", True)
+    @unit_tests.mock(tool_opts, "disablerepo", ["*"])
+    @unit_tests.mock(system_info, "submgr_enabled_repos", ["rhel-7-server-rpms"])
+    @unit_tests.mock(utils, "run_subprocess", unit_tests.RunSubprocessSequenceMocked([
+        ("pkg-1-2.el7.x86_64.rpm: [Errno 14] HTTPS Error 404 - Not Found\n"
+         "Error downloading packages:\n  pkg-1-2.el7.x86_64: [Errno 256] No more mirrors to try.\n", 1),
+        ("1 metadata files removed\n", 0),
+        ("Installed: pkg-1-3.el7.x86_64\n", 0)]))
+    def test_call_yum_cmd_w_stale_metadata(self):
+        output, ret_code = pkghandler.call_yum_cmd("install", "pkg")
+
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(output, "Installed: pkg-1-3.el7.x86_64\n")
+        self.assertEqual(utils.run_subprocess.cmds, [
+            "yum --setopt=*.metadata_expire=never install -y --disablerepo=* --enablerepo=rhel-7-server-rpms pkg",
+            "yum clean expire-cache --disablerepo=* --enablerepo=rhel-7-server-rpms",
+            "yum install -y --disablerepo=* --enablerepo=rhel-7-server-rpms pkg"])
+
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(pkghandler.repo_metadata, "warm", True)
+    @unit_tests.mock(utils, "run_subprocess",
+                     unit_tests.RunSubprocessSequenceMocked([("No package pkg available.\n", 1)]))
+    def test_call_yum_cmd_w_cached_metadata_other_error(self):
+        _, ret_code = pkghandler.call_yum_cmd("install", "pkg")
+
+        self.assertEqual(ret_code, 1)
+        self.assertEqual(len(utils.run_subprocess.cmds), 1)
+
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(pkghandler.pkg_cache, "keep", True)
+    @unit_tests.mock(utils, "run_subprocess", unit_tests.RunSubprocessSequenceMocked([]))
+    def test_call_yum_cmd_w_kept_pkg_cache(self):
+        pkghandler.call_yum_cmd("install", "pkg", enable_repos=[], disable_repos=[])
+        pkghandler.call_yum_cmd("makecache", enable_repos=[], disable_repos=[])
+
+        self.assertEqual(utils.run_subprocess.cmds, ["yum --setopt=keepcache=1 install -y pkg", "yum makecache -y"])
+
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(pkghandler.repo_metadata, "warm", False)
+    @unit_tests.mock(utils, "run_subprocess", unit_tests.RunSubprocessSequenceMocked([("Metadata Cache Created\n", 0)]))
+    def test_warm_up_repo_metadata(self):
+        pkghandler.warm_up_repo_metadata()
+
+        self.assertTrue(pkghandler.repo_metadata.warm)
+        self.assertEqual(utils.run_subprocess.cmds, ["yum makecache -y"])
+
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(pkghandler.repo_metadata, "warm", False)
+    @unit_tests.mock(utils, "run_subprocess",
+                     unit_tests.RunSubprocessSequenceMocked([("Cannot find a valid baseurl\n", 1)]))
+    def test_warm_up_repo_metadata_failure(self):
+        pkghandler.warm_up_repo_metadata()
+
+        self.assertFalse(pkghandler.repo_metadata.warm)
+
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
     @unit_tests.mock(pkghandler, "get_installed_pkgs_by_fingerprint",
                      GetInstalledPkgsByFingerprintMocked())
@@ -239,20 +346,71 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
 
         self.assertEqual(pkghandler.call_yum_cmd.called, 2)
 
+    def test_yum_error_parser_prepend_dropped(self):
+        output = ["Resolving Dependencies\n",
+                  "Error: Package: libreport-plugin-rhtsupport-2.1.11-38.el7.centos.x86_64 (@base)\n",
+                  "           Requires: libreport-web = 2.1.11-38.el7.centos\n",
+                  "Downloading packages:\n",
+                  "Error: Nothing to do"]
+        parser = pkghandler.YumErrorParser()
+        for line in output:
+            parser(line)
+
+        # The error lines that are not in the output tail are put in front of it
+        self.assertEqual(parser.prepend_dropped("".join(output[3:])), "".join(output[1:]))
+        # No line has been dropped from the output
+        self.assertEqual(parser.prepend_dropped("".join(output)), "".join(output))
+        self.assertTrue(parser.nothing_to_do)
+
+    def test_yum_error_parser_nothing_to_do(self):
+        # Just the last non-empty line of the output tells that yum has nothing to do
+        parser = pkghandler.YumErrorParser()
+        for line in ["Resolving Dependencies\n", "Nothing to do.\n", "\n"]:
+            parser(line)
+        self.assertTrue(parser.nothing_to_do)
+
+        parser = pkghandler.YumErrorParser()
+        for line in ["Error: Nothing to do\n", "Error: Package: libreport-2.1.11-38.el7.x86_64 (@base)\n"]:
+            parser(line)
+        self.assertFalse(parser.nothing_to_do)
+
+    def test_yum_error_parser(self):
+        problems = pkghandler.parse_yum_errors(YUM_REQUIRES_ERROR + "\n" + YUM_MULTILIB_ERROR)
+
+        self.assertEqual([(problem.kind, problem.pkg_name) for problem in problems],
+                         [(pkghandler.YUM_PROBLEM_DEPENDENCY, "libreport-anaconda"),
+                          (pkghandler.YUM_PROBLEM_REQUIRES, "libreport-plugin-rhtsupport"),
+                          (pkghandler.YUM_PROBLEM_DEPENDENCY, "abrt-cli"),
+                          (pkghandler.YUM_PROBLEM_REQUIRES, "libreport-plugin-rhtsupport"),
+                          (pkghandler.YUM_PROBLEM_MULTILIB, "p11-kit"),
+                          (pkghandler.YUM_PROBLEM_MULTILIB, "openldap")])
+        self.assertEqual(problems[0].line, YUM_REQUIRES_ERROR.splitlines()[0])
+
+    def test_yum_error_parser_dnf(self):
+        problems = pkghandler.parse_yum_errors(DNF_DEPENDENCY_ERROR)
+
+        self.assertEqual([(problem.kind, problem.pkg_name) for problem in problems],
+                         [(pkghandler.YUM_PROBLEM_DEPENDENCY, "python3-libdnf"),
+                          (pkghandler.YUM_PROBLEM_REQUIRES, "libdnf"),
+                          (pkghandler.YUM_PROBLEM_DEPENDENCY, "perl-IO-Socket-SSL"),
+                          (pkghandler.YUM_PROBLEM_REQUIRES, None),
+                          (pkghandler.YUM_PROBLEM_PROTECTED, "systemd"),
+                          (pkghandler.YUM_PROBLEM_PROTECTED, "dnf")])
+
     def test_get_problematic_pkgs(self):
-        error_pkgs = pkghandler.get_problematic_pkgs("", [])
+        error_pkgs = pkghandler.get_problematic_pkgs([], [])
         self.assertEqual(error_pkgs, [])
 
-        error_pkgs = pkghandler.get_problematic_pkgs(YUM_PROTECTED_ERROR, [])
+        error_pkgs = pkghandler.get_problematic_pkgs(pkghandler.parse_yum_errors(YUM_PROTECTED_ERROR), [])
         self.assertIn("systemd", error_pkgs)
         self.assertIn("yum", error_pkgs)
 
-        error_pkgs = pkghandler.get_problematic_pkgs(YUM_REQUIRES_ERROR, [])
+        error_pkgs = pkghandler.get_problematic_pkgs(pkghandler.parse_yum_errors(YUM_REQUIRES_ERROR), [])
         self.assertIn("libreport-anaconda", error_pkgs)
         self.assertIn("abrt-cli", error_pkgs)
         self.assertIn("libreport-plugin-rhtsupport", error_pkgs)
 
-        error_pkgs = pkghandler.get_problematic_pkgs(YUM_MULTILIB_ERROR, [])
+        error_pkgs = pkghandler.get_problematic_pkgs(pkghandler.parse_yum_errors(YUM_MULTILIB_ERROR), [])
         self.assertIn("openldap", error_pkgs)
         self.assertIn("p11-kit", error_pkgs)
 
@@ -260,16 +418,17 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
     def test_resolve_dep_errors_one_downgrade_fixes_the_error(self):
         pkghandler.call_yum_cmd.fail_once = True
 
-        pkghandler.resolve_dep_errors(YUM_PROTECTED_ERROR, [])
+        self.assertTrue(pkghandler.resolve_dep_errors(pkghandler.parse_yum_errors(YUM_PROTECTED_ERROR), []))
 
-        self.assertEqual(pkghandler.call_yum_cmd.called, 1)
+        # The dry run and the real distro-sync
+        self.assertEqual(pkghandler.call_yum_cmd.called, 2)
 
     @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdMocked())
     def test_resolve_dep_errors_unable_to_fix_by_downgrades(self):
         pkghandler.call_yum_cmd.return_code = 1
         pkghandler.call_yum_cmd.return_string = YUM_MULTILIB_ERROR
 
-        pkghandler.resolve_dep_errors(YUM_PROTECTED_ERROR, [])
+        pkghandler.resolve_dep_errors(pkghandler.parse_yum_errors(YUM_PROTECTED_ERROR), [])
 
         # Firts call of the resolve_dep_errors, pkgs from protected error
         # are detected, the second call pkgs from multilib error are detected,
@@ -278,17 +437,57 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
         # downgrades do not solve the yum errors)
         self.assertEqual(pkghandler.call_yum_cmd.called, 2)
 
+    class CallYumCmdDistroSyncMocked(unit_tests.MockFunction):
+        def __init__(self, new_problem_every_call=False):
+            self.new_problem_every_call = new_problem_every_call
+            self.args = []
+
+        def __call__(self, command, args="", error_parser=None, **kwargs):
+            self.args.append(args)
+            if self.new_problem_every_call:
+                error_parser.feed("Error: Package: pkg%d-1.0-1.el7.x86_64 (rhel-7-server-rpms)\n" % len(self.args))
+            else:
+                error_parser.feed(YUM_PROTECTED_ERROR.splitlines()[0] + "\n")
+            return "", 1
+
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdDistroSyncMocked(new_problem_every_call=True))
+    def test_dep_error_resolver_limit(self):
+        resolver = pkghandler.DepErrorResolver(max_yum_calls=3)
+
+        self.assertFalse(resolver.resolve(pkghandler.parse_yum_errors(YUM_PROTECTED_ERROR)))
+
+        self.assertEqual(resolver.yum_calls, 3)
+        # Only dry runs as none of them resolved the dependencies
+        self.assertTrue(all(args.startswith("--assumeno ") for args in pkghandler.call_yum_cmd.args))
+        self.assertEqual(pkghandler.call_yum_cmd.args[-1], "--assumeno systemd yum pkg1 pkg2")
+
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdDistroSyncMocked())
+    def test_dep_error_resolver_remembers_attempted_pkgs(self):
+        resolver = pkghandler.DepErrorResolver()
+
+        self.assertFalse(resolver.resolve(pkghandler.parse_yum_errors(YUM_PROTECTED_ERROR)))
+        self.assertEqual(resolver.yum_calls, 1)
+
+        # The same problems again bring no new information
+        self.assertFalse(resolver.resolve(pkghandler.parse_yum_errors(YUM_PROTECTED_ERROR)))
+        self.assertEqual(resolver.yum_calls, 1)
+
     @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdMocked())
     def test_resolve_dep_errors_unable_to_detect_problematic_pkgs(self):
         # Even though resolve_dep_errors was called (meaning that the previous
         # yum call ended with non-zero status), the string returned by yum
         # does not hold information recognizable by get_problematic_pkgs
-        pkghandler.resolve_dep_errors("No info about problematic pkgs.", [])
+        pkghandler.resolve_dep_errors(pkghandler.parse_yum_errors("No info about problematic pkgs."), [])
 
         self.assertEqual(pkghandler.call_yum_cmd.called, 0)
 
     class TestPkgObj(object):
         class PkgObjHdr(object):
+            def __getitem__(self, tag):
+                if tag == rpm.RPMTAG_RSAHEADER:
+                    return create_v4_sig("73bde98381b46521")
+                return None
+
             def sprintf(self, *args, **kwargs):
                 return "RSA/SHA256, Sun Feb  7 18:35:40 2016, Key ID" \
                        " 73bde98381b46521"
@@ -356,29 +555,144 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
 
         self.assertEqual(pkgs_by_fingerprint, [])
 
+    class PkgInventoryCacheMocked(unit_tests.MockFunction):
+        def __init__(self, cached):
+            self.cached = cached
+            self.saved = None
+
+        def load(self, rpmdb_state=None):
+            return self.cached
+
+        def save(self, rpmdb_state, fingerprints):
+            self.saved = fingerprints
+
     class GetInstalledPkgObjectsMocked(unit_tests.MockFunction):
         def __call__(self, name=""):
             if name and name != "installed_pkg":
                 return []
             pkg_obj = TestPkgHandler.create_pkg_obj(name="installed_pkg", version="0.1", release="1",
-                                                    arch="x86_64", packager="Oracle", from_repo="repoid")
+                                                    arch="x86_64", packager="Oracle", from_repo="repoid",
+                                                    manager=pkgmanager.TYPE)
             return [pkg_obj]
 
 
+    class RpmDbFingerprintsMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.pkgs = []
+
+        def get(self, pkg_obj):
+            self.pkgs.append(pkg_obj.name)
+            return "some_fingerprint"
+
+        def clear(self):
+            pass
+
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
     @unit_tests.mock(pkghandler, "get_installed_pkg_objects", GetInstalledPkgObjectsMocked())
-    @unit_tests.mock(pkghandler, "get_pkg_fingerprint", lambda pkg: "some_fingerprint")
+    @unit_tests.mock(pkghandler, "get_pkgs_fingerprints", lambda pkgs: ["some_fingerprint"] * len(pkgs))
+    @unit_tests.mock(pkghandler, "get_rpmdb_state", lambda: "state")
+    @unit_tests.mock(pkgcache, "pkg_inventory_cache", PkgInventoryCacheMocked({}))
     def test_get_installed_pkgs_w_fingerprints(self):
+        self._test_get_installed_pkgs_w_fingerprints()
+
+    @unit_tests.mock(pkgmanager, "TYPE", "dnf")
+    @unit_tests.mock(pkghandler, "get_installed_pkg_objects", GetInstalledPkgObjectsMocked())
+    @unit_tests.mock(pkghandler, "rpmdb_fingerprints", RpmDbFingerprintsMocked())
+    @unit_tests.mock(pkghandler, "get_rpmdb_state", lambda: "state")
+    @unit_tests.mock(pkgcache, "pkg_inventory_cache", PkgInventoryCacheMocked({}))
+    def test_get_installed_pkgs_w_fingerprints_dnf(self):
+        # On dnf, the fingerprints come from the index of the rpm db fingerprints
+        self._test_get_installed_pkgs_w_fingerprints()
+        self.assertEqual(pkghandler.rpmdb_fingerprints.pkgs, ["installed_pkg"])
+
+    def _test_get_installed_pkgs_w_fingerprints(self):
+        pkghandler.installed_pkgs_snapshot.invalidate()
         pkgs = pkghandler.get_installed_pkgs_w_fingerprints()
 
         self.assertEqual(len(pkgs), 1)
         self.assertEqual(pkgs[0].pkg_obj.name, "installed_pkg")
         self.assertEqual(pkgs[0].fingerprint, "some_fingerprint")
 
+        pkgs = pkghandler.get_installed_pkgs_w_fingerprints("installed_*")
+
+        self.assertEqual(len(pkgs), 1)
+
         pkgs = pkghandler.get_installed_pkgs_w_fingerprints("non_existing")
 
         self.assertEqual(len(pkgs), 0)
+        pkghandler.installed_pkgs_snapshot.invalidate()
+
+    class ReadInstalledPkgsMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.called = 0
+
+        def __call__(self):
+            self.called += 1
+            return [pkghandler.PkgWFingerprint(TestPkgHandler.create_pkg_obj("pkg1"), "some_fingerprint")]
+
+    class GetRpmdbStateMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.state = "state"
+
+        def __call__(self):
+            return self.state
+
+    @unit_tests.mock(pkghandler, "_read_installed_pkgs_w_fingerprints", ReadInstalledPkgsMocked())
+    @unit_tests.mock(pkghandler, "get_rpmdb_state", GetRpmdbStateMocked())
+    def test_installed_pkgs_snapshot(self):
+        snapshot = pkghandler.InstalledPkgsSnapshot()
+
+        # Repeated queries with no change to the rpm db are served from memory
+        snapshot.get()
+        snapshot.get("pkg*")
+        snapshot.get("other")
+        self.assertEqual(pkghandler._read_installed_pkgs_w_fingerprints.called, 1)
+
+        # The rpm db has changed on disk
+        pkghandler.get_rpmdb_state.state = "changed state"
+        self.assertEqual(len(snapshot.get("pkg1")), 1)
+        self.assertEqual(pkghandler._read_installed_pkgs_w_fingerprints.called, 2)
+
+        # We've changed the rpm db ourselves
+        snapshot.invalidate()
+        snapshot.get()
+        self.assertEqual(pkghandler._read_installed_pkgs_w_fingerprints.called, 3)
+
+    class GetPkgsFingerprintsMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.pkgs = []
+
+        def __call__(self, pkg_objs):
+            self.pkgs.extend([pkg_obj.name for pkg_obj in pkg_objs])
+            return ["decoded_fingerprint"] * len(pkg_objs)
+
+    class InstalledPkgObjectsWInstalltimeMocked(unit_tests.MockFunction):
+        def __call__(self, name=""):
+            pkgs = []
+            for pkg_name in ["unchanged", "added"]:
+                pkg_obj = TestPkgHandler.create_pkg_obj(pkg_name, version="1", release="1", arch="x86_64")
+                pkg_obj.installtime = 1
+                pkgs.append(pkg_obj)
+            return pkgs
+
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
+    @unit_tests.mock(pkghandler, "get_rpmdb_state", lambda: "state")
+    @unit_tests.mock(pkghandler, "get_pkgs_fingerprints", GetPkgsFingerprintsMocked())
+    @unit_tests.mock(pkgcache, "pkg_inventory_cache", PkgInventoryCacheMocked(
+        {("unchanged", "0", "1", "1", "x86_64", 1): "cached_fingerprint",
+         ("removed", "0", "1", "1", "x86_64", 1): "cached_fingerprint"}))
+    @unit_tests.mock(pkghandler, "get_installed_pkg_objects", InstalledPkgObjectsWInstalltimeMocked())
+    def test_read_installed_pkgs_w_fingerprints_uses_cache(self):
+        pkgs = pkghandler._read_installed_pkgs_w_fingerprints()
+
+        self.assertEqual([pkg.fingerprint for pkg in pkgs], ["cached_fingerprint", "decoded_fingerprint"])
+        # Only the package not found in the cache has had its signature decoded
+        self.assertEqual(pkghandler.get_pkgs_fingerprints.pkgs, ["added"])
+        self.assertEqual(pkgcache.pkg_inventory_cache.saved,
+                         {("unchanged", "0", "1", "1", "x86_64", 1): "cached_fingerprint",
+                          ("added", "0", "1", "1", "x86_64", 1): "decoded_fingerprint"})
 
-    @unit_tests.mock(pkghandler, "get_rpm_header", lambda pkg: TestPkgHandler.TestPkgObj.PkgObjHdr())
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
     def test_get_pkg_fingerprint(self):
         pkg = TestPkgHandler.create_pkg_obj("pkg")
 
@@ -386,6 +700,49 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
 
         self.assertEqual(fingerprint, "73bde98381b46521")
 
+    def test_get_sig_key_id(self):
+        self.assertEqual(pkghandler.get_sig_key_id(create_v4_sig("199e2f91fd431d51")), "199e2f91fd431d51")
+        self.assertEqual(pkghandler.get_sig_key_id(create_v4_sig("199e2f91fd431d51", hashed_issuer=True)),
+                         "199e2f91fd431d51")
+        self.assertEqual(pkghandler.get_sig_key_id(create_v3_sig("5326810137017186")), "5326810137017186")
+
+        # Not a signature packet
+        self.assertEqual(pkghandler.get_sig_key_id(b"\x99\x01\x0d" + b"\x00" * 269), None)
+        # Truncated packet
+        self.assertEqual(pkghandler.get_sig_key_id(create_v4_sig("199e2f91fd431d51")[:20]), None)
+        # V4 signature without the issuer subpacket
+        sig = bytearray(create_v4_sig("199e2f91fd431d51"))
+        sig[18] = 0x2a  # change the type of the unhashed issuer subpacket to an unknown one
+        self.assertEqual(pkghandler.get_sig_key_id(bytes(sig)), None)
+
+    @unit_tests.mock(pkghandler, "PARALLEL_DECODING_MIN_SIGS", 2)
+    def test_decode_sigs(self):
+        sigs = [create_v4_sig("199e2f91fd431d51"), None, create_v3_sig("5326810137017186"), b"\x88\x00",
+                create_v4_sig("05b555b38483c65d")]
+        expected = ["199e2f91fd431d51", None, "5326810137017186", None, "05b555b38483c65d"]
+
+        self.assertEqual(pkghandler.decode_sigs(sigs, processes=1), expected)
+        # The results from the worker processes are merged in the original order
+        self.assertEqual(pkghandler.decode_sigs(sigs, processes=2), expected)
+        self.assertEqual(pkghandler.decode_sigs(sigs[:1], processes=2), expected[:1])
+
+    def test_get_hdr_fingerprint(self):
+        hdr = TestPkgHandler.RpmHdrMocked({"key_id": "73bde98381b46521"})
+        self.assertEqual(pkghandler.get_hdr_fingerprint(hdr), "73bde98381b46521")
+
+        # An unsigned package
+        hdr = TestPkgHandler.RpmHdrMocked({"key_id": None})
+        self.assertEqual(pkghandler.get_hdr_fingerprint(hdr), "none")
+
+        # A signature not decodable by get_sig_key_id is left to rpm
+        hdr = TestPkgHandler.RpmHdrMocked({rpm.RPMTAG_DSAHEADER: b"\x88\x00", "key_id": "73bde98381b46521"})
+        self.assertEqual(pkghandler.get_hdr_fingerprint(hdr), "73bde98381b46521")
+
+        hdrs = [TestPkgHandler.RpmHdrMocked({"key_id": "199e2f91fd431d51"}),
+                TestPkgHandler.RpmHdrMocked({"key_id": None}),
+                hdr]
+        self.assertEqual(pkghandler.get_hdrs_fingerprints(hdrs), ["199e2f91fd431d51", "none", "73bde98381b46521"])
+
     class LogMocked(unit_tests.MockFunction):
         def __init__(self):
             self.msg = ""
@@ -395,19 +752,40 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
             self.msg += "%s\n" % msg
             self.called += 1
 
+    class RpmHdrMocked(dict):
+        def __missing__(self, tag):
+            if tag == rpm.RPMTAG_RSAHEADER and self.get("key_id"):
+                return create_v4_sig(self["key_id"])
+            return None
+
+        def sprintf(self, *args, **kwargs):
+            return "RSA/SHA256, Sun Feb  7 18:35:40 2016, Key ID %s" % self["key_id"]
+
     class TransactionSetMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.db_match_called = 0
+
         def __call__(self):
             return self
 
         def dbMatch(self, key='name', value=''):
-            db = [{rpm.RPMTAG_NAME: "pkg1",
-                   rpm.RPMTAG_VERSION: "1",
-                   rpm.RPMTAG_RELEASE: "2",
-                   rpm.RPMTAG_EVR: "1-2"},
-                  {rpm.RPMTAG_NAME: "pkg2",
-                   rpm.RPMTAG_VERSION: "2",
-                   rpm.RPMTAG_RELEASE: "3",
-                   rpm.RPMTAG_EVR: "2-3"}]
+            self.db_match_called += 1
+            hdr = TestPkgHandler.RpmHdrMocked
+            db = [hdr({rpm.RPMTAG_NAME: "pkg1",
+                       rpm.RPMTAG_VERSION: "1",
+                       rpm.RPMTAG_RELEASE: "2",
+                       rpm.RPMTAG_ARCH: "x86_64",
+                       "key_id": "199e2f91fd431d51"}),
+                  hdr({rpm.RPMTAG_NAME: "pkg1",
+                       rpm.RPMTAG_VERSION: "1",
+                       rpm.RPMTAG_RELEASE: "2",
+                       rpm.RPMTAG_ARCH: "i686",
+                       "key_id": "5326810137017186"}),
+                  hdr({rpm.RPMTAG_NAME: "gpg-pubkey",
+                       rpm.RPMTAG_VERSION: "fd431d51",
+                       rpm.RPMTAG_RELEASE: "4ae0493b",
+                       rpm.RPMTAG_ARCH: None,
+                       "key_id": None})]
             if key != 'name':  # everything else than 'name' is unsupported ATM :)
                 return []
             if not value:
@@ -415,19 +793,28 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
             else:
                 return [db_entry for db_entry in db if db_entry[rpm.RPMTAG_NAME] == value]
 
+    @unit_tests.mock(pkgmanager, "TYPE", "dnf")
     @unit_tests.mock(logger.CustomLogger, "warning", LogMocked())
     @unit_tests.mock(rpm, "TransactionSet", TransactionSetMocked())
     @pytest.mark.skipif(not is_rpm_based_os(), reason="Current test runs only on rpm based systems.")
-    def test_get_rpm_header(self):
-        pkg = TestPkgHandler.create_pkg_obj(name="pkg1", version="1", release="2")
-        hdr = pkghandler.get_rpm_header(pkg)
-        self.assertEqual(hdr, {rpm.RPMTAG_NAME: "pkg1",
-                               rpm.RPMTAG_VERSION: "1",
-                               rpm.RPMTAG_RELEASE: "2",
-                               rpm.RPMTAG_EVR: "1-2"})
+    def test_get_pkg_fingerprint_from_rpmdb(self):
+        pkghandler.rpmdb_fingerprints.clear()
+        pkg = TestPkgHandler.create_pkg_obj(name="pkg1", version="1", release="2", arch="i686")
+        self.assertEqual(pkghandler.get_pkg_fingerprint(pkg), "5326810137017186")
+
+        pkg = TestPkgHandler.create_pkg_obj(name="pkg1", version="1", release="2", arch="x86_64")
+        self.assertEqual(pkghandler.get_pkg_fingerprint(pkg), "199e2f91fd431d51")
+
+        # The arch of gpg-pubkey is not stored in the rpm db
+        pkg = TestPkgHandler.create_pkg_obj(name="gpg-pubkey", version="fd431d51", release="4ae0493b", arch="noarch")
+        self.assertEqual(pkghandler.get_pkg_fingerprint(pkg), "none")
+
+        # The rpm db has been read just once for all the packages
+        self.assertEqual(rpm.TransactionSet.db_match_called, 1)
 
         unknown_pkg = TestPkgHandler.create_pkg_obj(name="unknown", version="1", release="1")
-        self.assertRaises(SystemExit, pkghandler.get_rpm_header, unknown_pkg)
+        self.assertRaises(SystemExit, pkghandler.get_pkg_fingerprint, unknown_pkg)
+        pkghandler.rpmdb_fingerprints.clear()
 
     class ReturnPackagesMocked(unit_tests.MockFunction):
         def __call__(self, patterns=None):
@@ -582,6 +969,27 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
         self.assertTrue(re.search(r"^pkg2-0\.1-1\.x86_64\s+N/A\s+@@System$", result, re.MULTILINE))
         self.assertTrue(re.search(r"^gpg-pubkey-0\.1-1\.x86_64\s+N/A\s+test$", result, re.MULTILINE))
 
+    @unit_tests.mock(pkgmanager, "TYPE", "dnf")
+    def test_pkg_record(self):
+        pkg_obj = TestPkgHandler.create_pkg_obj(name="pkg1", epoch=1, version="0.1", release="1", arch="x86_64",
+                                                packager="CentOS Buildsys <bugs@centos.org>", manager="dnf")
+        record = pkghandler.PkgRecord.from_pkg_obj(pkg_obj, "24c6a8a7f4a80eb5")
+
+        self.assertEqual(record.fingerprint, "24c6a8a7f4a80eb5")
+        self.assertEqual(record.from_repo, "@@System")
+        self.assertEqual(record.vendor, None)
+        self.assertEqual(pkghandler.get_pkg_nvra(record), "pkg1-0.1-1.x86_64")
+        self.assertEqual(pkghandler.get_pkg_nevra(record), "pkg1-1:0.1-1.x86_64")
+        self.assertEqual(pkghandler.get_packager(record), "CentOS Buildsys")
+        self.assertEqual(pkghandler.get_vendor(record), "N/A")
+        self.assertTrue(re.search(r"^pkg1-0\.1-1\.x86_64\s+CentOS Buildsys\s+@@System$",
+                                  pkghandler.print_pkg_info([record]), re.MULTILINE))
+
+        self.assertRaises(AttributeError, setattr, record, "name", "pkg2")
+        self.assertRaises(AttributeError, setattr, record, "installtime", 1)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record, pkghandler.PkgRecord.from_pkg_obj(pkg_obj, "24c6a8a7f4a80eb5"))
+
     @unit_tests.mock(pkgmanager, "TYPE", "dnf")
     def test_get_pkg_nevra(self):
         obj = TestPkgHandler.create_pkg_obj(name="pkg", epoch=1, version="2", release="3", arch="x86_64")
@@ -646,11 +1054,27 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
     @unit_tests.mock(pkghandler, "get_installed_pkgs_w_different_fingerprint",
                      GetInstalledPkgObjectsWDiffFingerprintMocked())
     def test_remove_pkgs_with_confirm(self):
-        pkghandler.remove_pkgs_with_confirm(["installed_pkg", "not_installed_pkg"])
+        pkghandler.remove_pkgs_with_confirm(["installed_pkg", "not_installed_pkg", "installed_*"])
 
         self.assertEqual(len(utils.remove_pkgs.pkgs), 1)
         self.assertEqual(utils.remove_pkgs.pkgs[0], "installed_pkg-0.1-1.x86_64")
 
+    def test_pkg_name_matcher(self):
+        matcher = pkghandler.PkgNameMatcher(["rhn*", "rhnsd", "yum-rhn-plugin", "centos-release*"])
+        self.assertEqual(matcher.match("rhnsd"), ["rhn*", "rhnsd"])
+        self.assertEqual(matcher.match("rhn-client-tools"), ["rhn*"])
+        self.assertEqual(matcher.match("yum-rhn-plugin"), ["yum-rhn-plugin"])
+        self.assertEqual(matcher.match("yum"), [])
+        self.assertEqual(matcher.match("Rhnsd"), [])
+        self.assertEqual(pkghandler.PkgNameMatcher([]).match("rhnsd"), [])
+
+        pkgs = [TestPkgHandler.create_pkg_obj(name) for name in ["rhnsd", "bash", "centos-release"]]
+        pkgs_per_pattern = matcher.classify(pkgs)
+        self.assertEqual([pkg.name for pkg in pkgs_per_pattern["rhn*"]], ["rhnsd"])
+        self.assertEqual([pkg.name for pkg in pkgs_per_pattern["rhnsd"]], ["rhnsd"])
+        self.assertEqual(pkgs_per_pattern["yum-rhn-plugin"], [])
+        self.assertEqual([pkg.name for pkg in pkgs_per_pattern["centos-release*"]], ["centos-release"])
+
     class CallYumCmdWDowngradesMocked(unit_tests.MockFunction):
         def __init__(self):
             self.cmd = ""
@@ -660,15 +1084,162 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
 
     @unit_tests.mock(utils, "ask_to_continue", DumbCallableObject())
     @unit_tests.mock(system_info, "fingerprints_orig_os", ["24c6a8a7f4a80eb5"])
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_w_fingerprints", lambda: [])
+    @unit_tests.mock(pkghandler, "plan_replacement", lambda pkgs: None)
     @unit_tests.mock(pkghandler, "call_yum_cmd_w_downgrades",
                      CallYumCmdWDowngradesMocked())
     def test_replace_non_red_hat_packages_distrosync(self):
+        # Without a plan, the packages are replaced by the separate yum calls
         pkghandler.replace_non_red_hat_packages()
 
         output = "update\nreinstall\ndistro-sync\n"
         self.assertTrue(pkghandler.call_yum_cmd_w_downgrades.cmd ==
                         output)
 
+    AVAILABLE_PKGS = [
+        pkghandler.PkgRecord("bash", "0", "4.2.46", "34.el7", "x86_64", from_repo="rhel-7-server-rpms"),
+        pkghandler.PkgRecord("bash", "0", "4.2.46", "35.el7_9", "x86_64", from_repo="rhel-7-server-rpms"),
+        pkghandler.PkgRecord("bash", "0", "4.2.46", "36.el7", "i686", from_repo="rhel-7-server-rpms"),
+        pkghandler.PkgRecord("python-perf-with-a-long-name", "0", "3.10.0", "1160.el7", "x86_64",
+                             from_repo="rhel-7-server-rpms"),
+        pkghandler.PkgRecord("shadow-utils", "2", "4.6", "5.el7", "x86_64", from_repo="rhel-7-server-rpms"),
+        pkghandler.PkgRecord("yum", "0", "3.4.3", "167.el7", "noarch", from_repo="rhel-7-server-rpms")]
+
+    class PkgQueryMocked(unit_tests.MockFunction):
+        def __init__(self, available=None, installed=None):
+            self.available_pkgs = available
+            self.installed_pkgs = installed or []
+
+        def available(self, *names):
+            if self.available_pkgs is None:
+                return None
+            return [pkg for pkg in self.available_pkgs if pkg.name in names]
+
+        def installed(self, name=""):
+            return [pkg for pkg in self.installed_pkgs if not name or pkg.name == name]
+
+    class CallYumCmdPlanMocked(unit_tests.MockFunction):
+        def __init__(self, shell_ret_code=0, output=""):
+            self.shell_ret_code = shell_ret_code
+            self.output = output
+            self.commands = []
+            self.args = []
+
+        def __call__(self, command, args="", **kwargs):
+            self.commands.append(command)
+            self.args.append(args)
+            return self.output, self.shell_ret_code
+
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(AVAILABLE_PKGS))
+    def test_plan_replacement(self):
+        pkgs = [pkghandler.PkgRecord("bash", "0", "4.2.46", "34.el7", "x86_64"),
+                pkghandler.PkgRecord("python-perf-with-a-long-name", "0", "3.10.0", "1160.el7", "x86_64"),
+                pkghandler.PkgRecord("shadow-utils", "2", "4.7", "1.el7", "x86_64"),
+                pkghandler.PkgRecord("yum", "0", "3.4.3", "167.el7.centos", "noarch"),
+                pkghandler.PkgRecord("centos-logos", "0", "70.0.6", "3.el7.centos", "noarch")]
+
+        plan = pkghandler.plan_replacement(pkgs)
+
+        self.assertEqual([(action.action, action.installed.name, action.target.release) for action in plan],
+                         [(pkghandler.PLAN_UPDATE, "bash", "35.el7_9"),
+                          (pkghandler.PLAN_REINSTALL, "python-perf-with-a-long-name", "1160.el7"),
+                          (pkghandler.PLAN_DOWNGRADE, "shadow-utils", "5.el7"),
+                          (pkghandler.PLAN_DOWNGRADE, "yum", "167.el7")])
+
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(None))
+    def test_plan_replacement_unable_to_list(self):
+        self.assertEqual(pkghandler.plan_replacement([pkghandler.PkgRecord("bash", "0", "1", "1", "x86_64")]), None)
+
+    class StoreContentToFileMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.content = None
+
+        def __call__(self, filename, content):
+            self.content = content
+
+    @unit_tests.mock(system_info, "fingerprints_orig_os", ["24c6a8a7f4a80eb5"])
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_w_fingerprints", lambda: [
+        pkghandler.PkgWFingerprint(pkghandler.PkgRecord("bash", "0", "4.2.46", "34.el7", "x86_64"),
+                                   "24c6a8a7f4a80eb5"),
+        pkghandler.PkgWFingerprint(pkghandler.PkgRecord("yum", "0", "3.4.3", "167.el7.centos", "noarch"),
+                                   "24c6a8a7f4a80eb5"),
+        pkghandler.PkgWFingerprint(pkghandler.PkgRecord("kernel", "0", "3.10.0", "1160.el7", "x86_64"),
+                                   "199e2f91fd431d51")])
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_by_fingerprint", lambda fingerprints: [])
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(AVAILABLE_PKGS))
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdPlanMocked())
+    @unit_tests.mock(pkghandler, "call_yum_cmd_w_downgrades", CallYumCmdWDowngradesMocked())
+    @unit_tests.mock(utils, "store_content_to_file", StoreContentToFileMocked())
+    def test_replace_non_red_hat_packages_single_transaction(self):
+        pkghandler.replace_non_red_hat_packages()
+
+        self.assertEqual(pkghandler.call_yum_cmd.commands, ["shell"])
+        self.assertEqual(utils.store_content_to_file.content, ["update bash-4.2.46-35.el7_9.x86_64",
+                                                               "downgrade yum-3.4.3-167.el7.noarch",
+                                                               "run"])
+        self.assertEqual(pkghandler.call_yum_cmd_w_downgrades.cmd, "")
+
+    @unit_tests.mock(system_info, "fingerprints_orig_os", ["24c6a8a7f4a80eb5"])
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_w_fingerprints", lambda: [
+        pkghandler.PkgWFingerprint(pkghandler.PkgRecord("bash", "0", "4.2.46", "34.el7", "x86_64"),
+                                   "24c6a8a7f4a80eb5")])
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_by_fingerprint", lambda fingerprints: ["bash"])
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(AVAILABLE_PKGS))
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdPlanMocked())
+    @unit_tests.mock(pkghandler, "call_yum_cmd_w_downgrades", CallYumCmdWDowngradesMocked())
+    @unit_tests.mock(utils, "store_content_to_file", StoreContentToFileMocked())
+    def test_replace_non_red_hat_packages_single_transaction_fallback(self):
+        # A planned package has not been replaced by the transaction
+        pkghandler.replace_non_red_hat_packages()
+
+        self.assertEqual(pkghandler.call_yum_cmd_w_downgrades.cmd, "update\nreinstall\ndistro-sync\n")
+
+    @unit_tests.mock(system_info, "fingerprints_orig_os", ["24c6a8a7f4a80eb5"])
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_w_fingerprints", lambda: [
+        pkghandler.PkgWFingerprint(pkghandler.PkgRecord("bash", "0", "4.2.46", "34.el7", "x86_64"),
+                                   "24c6a8a7f4a80eb5"),
+        pkghandler.PkgWFingerprint(pkghandler.PkgRecord("yum", "0", "3.4.3", "999.el7", "noarch"),
+                                   "199e2f91fd431d51")])
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(AVAILABLE_PKGS))
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdPlanMocked())
+    @unit_tests.mock(pkghandler.pkg_cache, "keep", False)
+    @unit_tests.mock(utils, "store_content_to_file", StoreContentToFileMocked())
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_w_different_fingerprint", lambda *args: [])
+    def test_stage_rhel_pkgs(self):
+        pkghandler.stage_rhel_pkgs()
+
+        self.assertEqual(pkghandler.call_yum_cmd.commands, ["install", "shell"])
+        self.assertEqual(pkghandler.call_yum_cmd.args[0], "--downloadonly --nogpgcheck kernel")
+        self.assertTrue(pkghandler.call_yum_cmd.args[1].startswith("--downloadonly --nogpgcheck "))
+        # Only the packages signed by the original OS vendor are downloaded
+        self.assertEqual(utils.store_content_to_file.content, ["update bash-4.2.46-35.el7_9.x86_64", "run"])
+        # The downloaded packages are kept in the cache by the subsequent yum calls
+        self.assertTrue(pkghandler.pkg_cache.keep)
+
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdPlanMocked(
+        shell_ret_code=1, output="Command line error: no such option: --downloadonly\n"))
+    @unit_tests.mock(pkghandler.pkg_cache, "keep", False)
+    @unit_tests.mock(pkghandler, "plan_replacement", DumbCallableObject())
+    def test_stage_rhel_pkgs_downloadonly_unsupported(self):
+        pkghandler.stage_rhel_pkgs()
+
+        self.assertEqual(pkghandler.call_yum_cmd.commands, ["install"])
+        self.assertEqual(pkghandler.plan_replacement.called, 0)
+        self.assertFalse(pkghandler.pkg_cache.keep)
+
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdPlanMocked())
+    @unit_tests.mock(pkghandler.pkg_cache, "keep", True)
+    def test_clean_staged_pkgs(self):
+        pkghandler.clean_staged_pkgs()
+
+        self.assertEqual(pkghandler.call_yum_cmd.commands, ["clean"])
+        self.assertEqual(pkghandler.call_yum_cmd.args, ["packages"])
+        self.assertFalse(pkghandler.pkg_cache.keep)
+
+        # Nothing has been staged since
+        pkghandler.clean_staged_pkgs()
+        self.assertEqual(pkghandler.call_yum_cmd.commands, ["clean"])
+
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
     @unit_tests.mock(pkghandler, "install_rhel_kernel", lambda: True)
     @unit_tests.mock(pkghandler, "fix_invalid_grub2_entries", lambda: None)
@@ -776,29 +1347,228 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
 
         self.assertEqual(pkghandler.get_installed_pkgs_w_different_fingerprint.called, 2)
 
-    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
-    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    YumPkgObj = namedtuple("YumPkgObj", ["name", "epoch", "version", "release", "arch", "packager", "repoid"])
+
+    class YumPkgSack(object):
+        def __init__(self, pkg_objs):
+            self.pkg_objs = pkg_objs
+
+        def returnPackages(self, patterns=None):
+            return [pkg_obj for pkg_obj in self.pkg_objs if pkg_obj.name in patterns]
+
+        def searchProvides(self, capability):
+            return [pkg_obj for pkg_obj in self.pkg_objs if pkg_obj.name == "kernel-core"]
+
+    class YumQueryBase(object):
+        def __init__(self, pkg_sack):
+            self.pkgSack = pkg_sack
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    class LoadReposMocked(unit_tests.MockFunction):
+        def __init__(self, pkg_objs=None):
+            self.pkg_objs = pkg_objs
+            self.called = 0
+            self.bases = []
+
+        def __call__(self, repos_to_disable, repos_to_enable):
+            self.called += 1
+            if self.pkg_objs is None:
+                raise IOError("Cannot retrieve repository metadata (repomd.xml)")
+            self.bases.append(TestPkgHandler.YumQueryBase(TestPkgHandler.YumPkgSack(self.pkg_objs)))
+            return self.bases[-1]
+
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
+    @unit_tests.mock(system_info, "releasever", "7Server")
+    @unit_tests.mock(tool_opts, "disable_submgr", True)
+    @unit_tests.mock(tool_opts, "enablerepo", ["rhel-7-server-rpms"])
+    @unit_tests.mock(pkghandler, "_load_repos", LoadReposMocked([
+        YumPkgObj("kernel", 0, "4.10.0", "1.el7", "x86_64", "Red Hat", "rhel-7-server-rpms"),
+        YumPkgObj("kernel", 0, "4.9.0", "1.el7", "x86_64", "Red Hat", "rhel-7-server-rpms"),
+        YumPkgObj("kernel-core", 0, "4.9.0", "1.el7", "x86_64", "Red Hat", "rhel-7-server-rpms"),
+        YumPkgObj("kernel", 1, "3.10.0", "1.el7", "x86_64", "Red Hat", "rhel-7-server-rpms")]))
+    def test_pkg_query(self):
+        pkg_query = pkghandler.PkgQuery()
+
+        available = pkg_query.available("kernel")
+
+        self.assertEqual([pkghandler.get_pkg_nevra(pkg) for pkg in available],
+                         ["kernel-4.9.0-1.el7.x86_64", "kernel-4.10.0-1.el7.x86_64", "1:kernel-3.10.0-1.el7.x86_64"])
+        self.assertEqual(available[0].from_repo, "rhel-7-server-rpms")
+        self.assertEqual([pkg.name for pkg in pkg_query.whatprovides("kernel-core-uname-r")], ["kernel-core"])
+        # The metadata is loaded just once
+        self.assertEqual(pkghandler._load_repos.called, 1)
+
+        # and again when the repositories change
+        tool_opts.enablerepo = ["rhel-7-server-optional-rpms"]
+        pkg_query.available("kernel")
+        self.assertEqual(pkghandler._load_repos.called, 2)
+        # The replaced base is closed
+        self.assertEqual([base.closed for base in pkghandler._load_repos.bases], [True, False])
+
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
+    @unit_tests.mock(pkghandler, "_load_repos", LoadReposMocked(None))
+    def test_pkg_query_unable_to_load_repos(self):
+        self.assertEqual(pkghandler.PkgQuery().available("kernel"), None)
+
+    class YumDownloadPkgObj(object):
+        def __init__(self, name, version, release, arch):
+            self.name = name
+            self.epoch = 0
+            self.version = version
+            self.release = release
+            self.arch = arch
+            self.remote_path = "Packages/%s-%s-%s.%s.rpm" % (name, version, release, arch)
+
+        def returnIdSum(self):
+            return "sha256", "%s-%s-checksum" % (self.name, self.version)
+
+    class PkgStoreMocked(unit_tests.MockFunction):
+        def __init__(self, stored):
+            self.stored = stored
+            self.added = []
+            self.evicted = 0
+
+        def get(self, key, filename, seed_dir=None):
+            return self.stored.get(key)
+
+        def add(self, path, key):
+            self.added.append((path, key))
+            return "/store/%s.rpm" % key.nevra
+
+        def evict(self):
+            self.evicted += 1
+
+    class YumDownloadBase(object):
+        def __init__(self, pkg_sack, failing):
+            self.pkgSack = pkg_sack
+            self.failing = failing
+            self.downloaded = []
+            self.closed = False
+
+        def downloadPkgs(self, pkg_objs):
+            self.downloaded.extend(pkg_objs)
+            return dict([(pkg_obj, ["[Errno 256] No more mirrors to try."]) for pkg_obj in pkg_objs
+                         if pkg_obj.name in self.failing])
+
+        def close(self):
+            self.closed = True
+
+    class DownloadPkgsWYumdownloaderMocked(unit_tests.MockFunction):
+        def __init__(self, found):
+            self.found = found
+            self.pkgs = []
+
+        def __call__(self, pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever):
+            self.pkgs.extend(pkgs)
+            return dict([(pkg, os.path.join(dest, "%s.rpm" % pkg) if pkg in self.found else None) for pkg in pkgs])
+
+    class LoadDownloadReposMocked(unit_tests.MockFunction):
+        def __init__(self, base):
+            self.base = base
+
+        def __call__(self, repos_to_disable, repos_to_enable, reposdir=None, set_releasever=True):
+            return self.base
+
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
+    @unit_tests.mock(system_info, "arch", "x86_64")
+    @unit_tests.mock(utils, "mkdir_p", lambda path: None)
+    @unit_tests.mock(pkgstore, "pkg_store", PkgStoreMocked({
+        pkgstore.PkgKey("kernel-0:4.9.0-1.el7.x86_64", "sha256", "kernel-4.9.0-checksum"): "/store/kernel.rpm"}))
+    @unit_tests.mock(pkgstore, "link", lambda path, dest, filename: os.path.join(dest, filename))
+    @unit_tests.mock(pkghandler, "_load_repos", LoadDownloadReposMocked(YumDownloadBase(YumPkgSack([
+        YumDownloadPkgObj("bash", "4.2.46", "34.el7", "x86_64"),
+        YumDownloadPkgObj("bash", "4.2.46", "35.el7_9", "x86_64"),
+        YumDownloadPkgObj("bash", "4.2.46", "36.el7", "i686"),
+        YumDownloadPkgObj("kernel", "4.9.0", "1.el7", "x86_64"),
+        YumDownloadPkgObj("kernel", "4.10.0", "1.el7", "x86_64"),
+        YumDownloadPkgObj("yum", "3.4.3", "167.el7", "noarch")]), failing=["yum"])))
+    @unit_tests.mock(utils, "download_pkgs_w_yumdownloader", DownloadPkgsWYumdownloaderMocked(["uln-pkg"]))
+    def test_download_pkgs_in_process(self):
+        base = pkghandler._load_repos.base
+        dest = "/dest"
+
+        results = pkghandler.download_pkgs_in_process(["bash", "kernel-4.9.0-1.el7.x86_64", "yum", "missing",
+                                                       "uln-pkg"], dest)
+
+        # The newest package of the system architecture, all downloaded by the package manager at once except for the
+        # package already in the package store
+        self.assertEqual([pkg_obj.remote_path for pkg_obj in base.downloaded],
+                         ["Packages/bash-4.2.46-35.el7_9.x86_64.rpm", "Packages/yum-3.4.3-167.el7.noarch.rpm"])
+        self.assertEqual(pkgstore.pkg_store.added, [
+            (os.path.join(dest, "bash-4.2.46-35.el7_9.x86_64.rpm"),
+             pkgstore.PkgKey("bash-0:4.2.46-35.el7_9.x86_64", "sha256", "bash-4.2.46-checksum"))])
+        self.assertEqual(pkgstore.pkg_store.evicted, 1)
+        self.assertEqual(results["bash"], pkghandler.DownloadResult(
+            "bash", os.path.join(dest, "bash-4.2.46-35.el7_9.x86_64.rpm"), None))
+        self.assertEqual(results["kernel-4.9.0-1.el7.x86_64"].path,
+                         os.path.join(dest, "kernel-4.9.0-1.el7.x86_64.rpm"))
+        self.assertEqual(results["yum"], pkghandler.DownloadResult("yum", None, "[Errno 256] No more mirrors to try."))
+        self.assertEqual(results["missing"],
+                         pkghandler.DownloadResult("missing", None, "No package missing available."))
+        # The packages not found in-process, e.g. from a repository provided by a yum plugin, are downloaded by
+        # yumdownloader
+        self.assertEqual(utils.download_pkgs_w_yumdownloader.pkgs, ["missing", "uln-pkg"])
+        self.assertEqual(results["uln-pkg"], pkghandler.DownloadResult("uln-pkg", "/dest/uln-pkg.rpm", None))
+        self.assertTrue(base.closed)
+
+    class LinkMocked(unit_tests.MockFunction):
+        def __init__(self, failing_dir):
+            self.failing_dir = failing_dir
+
+        def __call__(self, path, dest, filename):
+            if path.startswith(self.failing_dir):
+                raise OSError(13, "Permission denied")
+            return os.path.join(dest, filename)
+
+    @unit_tests.mock(pkgmanager, "TYPE", "yum")
+    @unit_tests.mock(system_info, "arch", "x86_64")
+    @unit_tests.mock(utils, "mkdir_p", lambda path: None)
+    @unit_tests.mock(pkgstore, "pkg_store", PkgStoreMocked({
+        pkgstore.PkgKey("kernel-0:4.9.0-1.el7.x86_64", "sha256", "kernel-4.9.0-checksum"): "/store/kernel.rpm"}))
+    @unit_tests.mock(pkgstore, "link", LinkMocked("/store"))
+    @unit_tests.mock(pkghandler, "_load_repos", LoadDownloadReposMocked(YumDownloadBase(YumPkgSack([
+        YumDownloadPkgObj("kernel", "4.9.0", "1.el7", "x86_64"),
+        YumDownloadPkgObj("bash", "4.2.46", "35.el7_9", "x86_64")]), failing=[])))
+    def test_download_pkgs_in_process_unable_to_link(self):
+        base = pkghandler._load_repos.base
+
+        results = pkghandler.download_pkgs_in_process(["kernel", "bash"], "/dest")
+
+        # The package failing to be linked from the package store is downloaded, the downloaded package failing to be
+        # linked from the package store is used from where it has been downloaded to
+        self.assertEqual([pkg_obj.name for pkg_obj in base.downloaded], ["kernel", "bash"])
+        self.assertEqual(results["kernel"].path, "/dest/kernel-4.9.0-1.el7.x86_64.rpm")
+        self.assertEqual(results["bash"].path, "/dest/bash-4.2.46-35.el7_9.x86_64.rpm")
+
+    @unit_tests.mock(pkghandler, "_load_repos", LoadReposMocked(None))
+    def test_download_pkgs_in_process_unable_to_load_repos(self):
+        self.assertEqual(pkghandler.download_pkgs_in_process(["bash"], "/dest"), None)
+
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(*KERNELS_OLDER_AVAILABLE))
     def test_get_kernel_availability(self):
-        utils.run_subprocess.output = YUM_KERNEL_LIST_OLDER_AVAILABLE
         installed, available = pkghandler.get_kernel_availability()
         self.assertEqual(installed, ['4.7.4-200.fc24'])
         self.assertEqual(available, ['4.5.5-300.fc24', '4.7.2-201.fc24', '4.7.4-200.fc24'])
 
-        utils.run_subprocess.output = YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(*KERNELS_OLDER_NOT_AVAILABLE_MULTIPLE_INSTALLED))
+    def test_get_kernel_availability_multiple_installed(self):
         installed, available = pkghandler.get_kernel_availability()
-        self.assertEqual(installed, ['4.7.4-200.fc24'])
+        self.assertEqual(installed, ['4.7.2-201.fc24', '4.7.4-200.fc24'])
         self.assertEqual(available, ['4.7.4-200.fc24'])
 
-        utils.run_subprocess.output = YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE_MULTIPLE_INSTALLED
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(None, KERNELS_OLDER_AVAILABLE[1]))
+    def test_get_kernel_availability_unable_to_load_repos(self):
         installed, available = pkghandler.get_kernel_availability()
-        self.assertEqual(installed, ['4.7.2-201.fc24', '4.7.4-200.fc24'])
-        self.assertEqual(available, ['4.7.4-200.fc24'])
+        self.assertEqual(installed, ['4.7.4-200.fc24'])
+        self.assertEqual(available, [])
 
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(*KERNELS_OLDER_AVAILABLE))
     def test_handle_older_rhel_kernel_available(self):
-        utils.run_subprocess.output = YUM_KERNEL_LIST_OLDER_AVAILABLE
-
         pkghandler.handle_no_newer_rhel_kernel_available()
 
         self.assertEqual(utils.run_subprocess.cmd, "yum install -y kernel-4.7.2-201.fc24")
@@ -814,12 +1584,11 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
 
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(*KERNELS_OLDER_NOT_AVAILABLE))
     @unit_tests.mock(pkghandler,
                      "replace_non_rhel_installed_kernel",
                      ReplaceNonRhelInstalledKernelMocked())
     def test_handle_older_rhel_kernel_not_available(self):
-        utils.run_subprocess.output = YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE
-
         pkghandler.handle_no_newer_rhel_kernel_available()
 
         self.assertEqual(pkghandler.replace_non_rhel_installed_kernel.called, 1)
@@ -827,9 +1596,8 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     @unit_tests.mock(utils, "remove_pkgs", RemovePkgsMocked())
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(*KERNELS_OLDER_NOT_AVAILABLE_MULTIPLE_INSTALLED))
     def test_handle_older_rhel_kernel_not_available_multiple_installed(self):
-        utils.run_subprocess.output = YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE_MULTIPLE_INSTALLED
-
         pkghandler.handle_no_newer_rhel_kernel_available()
 
         self.assertEqual(len(utils.remove_pkgs.pkgs), 1)
@@ -853,6 +1621,26 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
             self.disable_repos = disable_repos
             return self.to_return
 
+    @unit_tests.mock(pkghandler, "pkg_query", PkgQueryMocked(
+        available=[pkghandler.PkgRecord("kernel", "0", "3.10.0", "1127.19.1.el7", "x86_64")],
+        installed=[pkghandler.PkgRecord("kernel", "0", "3.10.0", "1127.19.1.el7", "x86_64")]))
+    @unit_tests.mock(pkghandler, "call_yum_cmd", CallYumCmdPlanMocked())
+    @unit_tests.mock(pkghandler.pkg_cache, "keep", False)
+    @unit_tests.mock(pkghandler, "get_installed_pkgs_w_different_fingerprint",
+                     GetInstalledPkgsWDifferentFingerprintMocked())
+    @unit_tests.mock(pkghandler, "get_pkgs_to_replace", lambda: [])
+    @unit_tests.mock(pkghandler, "plan_replacement", lambda pkgs: [])
+    @unit_tests.mock(utils, "download_pkg", DownloadPkgMocked())
+    def test_stage_rhel_pkgs_kernel(self):
+        pkghandler.stage_rhel_pkgs()
+
+        self.assertEqual(pkghandler.call_yum_cmd.args, ["--downloadonly --nogpgcheck kernel",
+                                                        "--downloadonly --nogpgcheck kernel-firmware",
+                                                        "--downloadonly --nogpgcheck kernel-headers"])
+        # The only installed kernel is going to be replaced by the RHEL one with the same version
+        self.assertEqual(utils.download_pkg.pkg, "kernel-3.10.0-1127.19.1.el7")
+        self.assertEqual(utils.download_pkg.dest, utils.TMP_DIR)
+
     @unit_tests.mock(utils, "ask_to_continue", DumbCallableObject())
     @unit_tests.mock(utils, "download_pkg", DownloadPkgMocked())
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
@@ -879,12 +1667,6 @@ class TestPkgHandler(unit_tests.ExtendedTestCase):
         version = '4.7.4-200.fc24'
         self.assertRaises(SystemExit, pkghandler.replace_non_rhel_installed_kernel, version)
 
-    def test_get_kernel(self):
-        kernel_version = list(pkghandler.get_kernel(
-            YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE))
-
-        self.assertEqual(kernel_version, ["4.7.4-200.fc24", "4.7.4-200.fc24"])
-
     @unit_tests.mock(pkghandler, "is_rhel_kernel_installed", lambda: True)
     def test_verify_rhel_kernel_installed(self):
         pkghandler.verify_rhel_kernel_installed()
@@ -1018,6 +1800,11 @@ YUM_MULTILIB_ERROR = """
 Error: Protected multilib versions: 2:p11-kit-0.18.7-1.fc19.i686 != p11-kit-0.18.3-1.fc19.x86_64
 Error: Protected multilib versions: openldap-2.4.36-4.fc19.i686 != openldap-2.4.35-4.fc19.x86_64"""
 
+DNF_DEPENDENCY_ERROR = """Error:
+ Problem 1: package python3-libdnf-0.39.1-6.el8_2.x86_64 requires libdnf(x86-64) = 0.39.1-6.el8_2, but none of the providers can be installed
+ Problem 2: package perl-IO-Socket-SSL-2.066-4.el8.noarch requires perl(Net::SSLeay) >= 1.88, but none of the providers can be installed
+ Problem 3: The operation would result in removing the following protected packages: systemd, dnf"""  # pylint: disable=C0301
+
 # The following yum error is currently not being handled by the tool. The
 # tool would somehow need to decide, which of the two packages to remove and
 # ask the user to confirm the removal.
@@ -1025,21 +1812,3 @@ YUM_FILE_CONFLICT_ERROR = """Transaction Check Error:
   file /lib/firmware/ql2500_fw.bin from install of ql2500-firmware-7.03.00-1.el6_5.noarch conflicts with file from package linux-firmware-20140911-0.1.git365e80c.0.8.el6.noarch
   file /lib/firmware/ql2400_fw.bin from install of ql2400-firmware-7.03.00-1.el6_5.noarch conflicts with file from package linux-firmware-20140911-0.1.git365e80c.0.8.el6.noarch
   file /lib/firmware/phanfw.bin from install of netxen-firmware-4.0.534-3.1.el6.noarch conflicts with file from package linux-firmware-20140911-0.1.git365e80c.0.8.el6.noarch"""  # pylint: disable=C0301
-
-YUM_KERNEL_LIST_OLDER_AVAILABLE = """Installed Packages
-kernel.x86_64    4.7.4-200.fc24   @updates
-Available Packages
-kernel.x86_64    4.5.5-300.fc24   fedora
-kernel.x86_64    4.7.2-201.fc24   @updates
-kernel.x86_64    4.7.4-200.fc24   @updates"""
-
-YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE = """Installed Packages
-kernel.x86_64    4.7.4-200.fc24   @updates
-Available Packages
-kernel.x86_64    4.7.4-200.fc24   @updates"""
-
-YUM_KERNEL_LIST_OLDER_NOT_AVAILABLE_MULTIPLE_INSTALLED = """Installed Packages
-kernel.x86_64    4.7.2-201.fc24   @updates
-kernel.x86_64    4.7.4-200.fc24   @updates
-Available Packages
-kernel.x86_64    4.7.4-200.fc24   @updates"""
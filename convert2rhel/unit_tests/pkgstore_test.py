@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from convert2rhel import pkgstore
+
+
+def write_rpm(directory, filename, content):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, filename)
+    with open(path, "wb") as rpm_file:
+        rpm_file.write(content)
+    return path
+
+
+def get_key(name, content):
+    return pkgstore.PkgKey("%s-0:1.0-1.el7.x86_64" % name, "sha256", hashlib.sha256(content).hexdigest())
+
+
+class TestPkgStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_add_and_get(self):
+        store = pkgstore.PkgStore(os.path.join(self.tmp_dir, "store"))
+        downloaded = write_rpm(os.path.join(self.tmp_dir, "backup"), "pkg1-1.0-1.el7.x86_64.rpm", b"pkg1")
+        key = get_key("pkg1", b"pkg1")
+        self.assertEqual(store.get(key, "pkg1-1.0-1.el7.x86_64.rpm"), None)
+
+        stored_path = store.add(downloaded, key)
+
+        self.assertEqual(store.get(key, "pkg1-1.0-1.el7.x86_64.rpm"), stored_path)
+        # The store and the other directories share the rpm through hardlinks
+        linked_path = pkgstore.link(stored_path, os.path.join(self.tmp_dir, "backup"), "pkg1-1.0-1.el7.x86_64.rpm")
+        self.assertEqual(linked_path, downloaded)
+        os.makedirs(os.path.join(self.tmp_dir, "rhsm"))
+        linked_path = pkgstore.link(stored_path, os.path.join(self.tmp_dir, "rhsm"), "pkg1-1.0-1.el7.x86_64.rpm")
+        self.assertTrue(os.path.samefile(linked_path, stored_path))
+        self.assertEqual(os.stat(stored_path).st_nlink, 3)
+
+    def test_get_from_seed_dir(self):
+        store = pkgstore.PkgStore(os.path.join(self.tmp_dir, "store"))
+        seed_dir = os.path.join(self.tmp_dir, "seed")
+        write_rpm(seed_dir, "pkg1-1.0-1.el7.x86_64.rpm", b"pkg1")
+        write_rpm(seed_dir, "pkg2-1.0-1.el7.x86_64.rpm", b"tampered")
+
+        stored_path = store.get(get_key("pkg1", b"pkg1"), "pkg1-1.0-1.el7.x86_64.rpm", seed_dir)
+
+        with open(stored_path, "rb") as rpm_file:
+            self.assertEqual(rpm_file.read(), b"pkg1")
+        # Copied into the store, not shared with the seed directory
+        self.assertFalse(os.path.samefile(stored_path, os.path.join(seed_dir, "pkg1-1.0-1.el7.x86_64.rpm")))
+        # An rpm not matching the checksum from the repository metadata is not used
+        self.assertEqual(store.get(get_key("pkg2", b"pkg2"), "pkg2-1.0-1.el7.x86_64.rpm", seed_dir), None)
+        self.assertEqual(store.get(get_key("pkg3", b"pkg3"), "pkg3-1.0-1.el7.x86_64.rpm", seed_dir), None)
+
+    def test_evict_least_recently_used(self):
+        store = pkgstore.PkgStore(os.path.join(self.tmp_dir, "store"), max_size=30)
+        downloads_dir = os.path.join(self.tmp_dir, "downloads")
+        stored_paths = []
+        for i, name in enumerate(["pkg1", "pkg2", "pkg3"]):
+            content = (name * 3).encode()
+            stored_paths.append(store.add(write_rpm(downloads_dir, "%s.rpm" % name, content), get_key(name, content)))
+            os.utime(stored_paths[-1], (1600000000 + i, 1600000000 + i))
+        # pkg1 has been used most recently
+        os.utime(stored_paths[0], (1600000010, 1600000010))
+
+        store.evict()
+
+        self.assertEqual([os.path.exists(path) for path in stored_paths], [True, False, True])
+        # The evicted rpm is kept where it has been downloaded to
+        self.assertTrue(os.path.exists(os.path.join(downloads_dir, "pkg2.rpm")))
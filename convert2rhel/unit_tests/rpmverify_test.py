@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+import tempfile
+
+from convert2rhel import pkgcache, rpmverify
+from convert2rhel import unit_tests  # Imports unit_tests/__init__.py
+from convert2rhel import utils
+
+
+INSTALLED_NVRAS = ["pkg%d-1.0-1.el7.x86_64" % i for i in range(10)] + ["gpg-pubkey-f4a80eb5-53a7ff4b"]
+
+
+class RpmRunSubprocessMocked(unit_tests.MockFunction):
+    """Mock of the rpm commands.
+
+    'rpm -qa' lists the installed packages with their header digests, 'rpm -V' prints a modified config file line for
+    each of the verified packages and 'rpm -V --nofiles' a dependency problem of each of the verified packages.
+    """
+
+    def __init__(self, qa_ret_code=0, digests=None):
+        self.cmds = []
+        self.qa_ret_code = qa_ret_code
+        self.digests = digests or {}
+
+    def __call__(self, cmd, print_cmd=True, print_output=True, **kwargs):
+        self.cmds.append(cmd)
+        if cmd.startswith("rpm -qa"):
+            return "".join(["%s %s\n" % (nvra, self.digests.get(nvra, "digest")) for nvra in INSTALLED_NVRAS]), \
+                self.qa_ret_code
+        if cmd == "rpm -Va":
+            return "".join([self.file_line(nvra) for nvra in INSTALLED_NVRAS]), 1
+        nvras = [arg for arg in cmd.split()[2:] if not arg.startswith("--")]
+        if cmd.startswith("rpm -V --nofiles --noscripts"):
+            return "".join([self.deps_lines(nvra) for nvra in nvras]), 1
+        return "".join([self.file_line(nvra) for nvra in nvras]), 1
+
+    def file_line(self, nvra):
+        return "S.5....T.  c /etc/%s.conf\n" % nvra
+
+    @staticmethod
+    def deps_lines(nvra):
+        return "Unsatisfied dependencies for %s:\n\tlibfoo.so.1()(64bit) is needed by %s\n" % (nvra, nvra)
+
+
+def get_path_owners(ts, path, positions):
+    # The config file of each package from RpmRunSubprocessMocked, /etc/shared.conf owned by pkg1 and pkg0
+    if path == "/etc/shared.conf":
+        return sorted(["pkg1-1.0-1.el7.x86_64", "pkg0-1.0-1.el7.x86_64"], key=lambda owner: positions[owner])
+    owner = path[len("/etc/"):-len(".conf")]
+    return [owner] if owner in positions else []
+
+
+class GetFilesStateDigestsMocked(unit_tests.MockFunction):
+    """The files of all the packages are in the same state unless listed in changed."""
+
+    def __init__(self, changed=()):
+        self.changed = changed
+
+    def __call__(self, nvras):
+        return dict((nvra, "changed" if nvra in self.changed else "files") for nvra in nvras)
+
+
+class TestRpmVerify(unit_tests.ExtendedTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @unit_tests.mock(rpmverify, "MAX_PKGS_PER_SHARD", 4)
+    def test_split_into_shards(self):
+        self.assertEqual(rpmverify.split_into_shards(INSTALLED_NVRAS, 2),
+                         [INSTALLED_NVRAS[0:4], INSTALLED_NVRAS[4:8], INSTALLED_NVRAS[8:]])
+        self.assertEqual(rpmverify.split_into_shards(INSTALLED_NVRAS, 6),
+                         [INSTALLED_NVRAS[i:i + 2] for i in range(0, 11, 2)])
+        self.assertEqual(rpmverify.split_into_shards(INSTALLED_NVRAS[:1], 4), [INSTALLED_NVRAS[:1]])
+
+    @unit_tests.mock(rpmverify, "MAX_PKGS_PER_SHARD", 3)
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    @unit_tests.mock(rpmverify, "get_files_state_digests", GetFilesStateDigestsMocked())
+    @unit_tests.mock(utils, "run_subprocess", RpmRunSubprocessMocked())
+    def test_verify_all_pkgs_same_as_rpm_va(self):
+        serial_output, _ = utils.run_subprocess("rpm -Va")
+
+        # The outputs of the shards are merged in the rpm db order regardless of the order the shards finish in
+        for processes in range(1, 6):
+            result = rpmverify.verify_all_pkgs(processes=processes)
+            self.assertEqual(result.output, serial_output)
+            self.assertEqual(result.lines_per_pkg[INSTALLED_NVRAS[3]],
+                             ["S.5....T.  c /etc/%s.conf\n" % INSTALLED_NVRAS[3]])
+
+    @unit_tests.mock(utils, "run_subprocess", RpmRunSubprocessMocked(qa_ret_code=1))
+    def test_verify_all_pkgs_fallback_to_rpm_va(self):
+        result = rpmverify.verify_all_pkgs(processes=4)
+
+        self.assertEqual(utils.run_subprocess.cmds[-1], "rpm -Va")
+        self.assertEqual(result.lines_per_pkg, None)
+
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    def test_attribute_lines_to_pkgs(self):
+        nvras = INSTALLED_NVRAS[:3]
+        output = ("S.5....T.  c /etc/shared.conf\n"
+                  "Unsatisfied dependencies for pkg1-1:1.0-1.el7.x86_64:\n"
+                  "\tlibfoo.so.1()(64bit) is needed by (installed) pkg1-1:1.0-1.el7.x86_64\n"
+                  "S.5....T.  c /etc/shared.conf\n"
+                  "missing     /etc/pkg2-1.0-1.el7.x86_64.conf\n")
+
+        self.assertEqual(rpmverify.attribute_lines_to_pkgs(output, nvras), {
+            "pkg0-1.0-1.el7.x86_64": ["S.5....T.  c /etc/shared.conf\n"],
+            "pkg1-1.0-1.el7.x86_64": ["Unsatisfied dependencies for pkg1-1:1.0-1.el7.x86_64:\n",
+                                      "\tlibfoo.so.1()(64bit) is needed by (installed) pkg1-1:1.0-1.el7.x86_64\n",
+                                      "S.5....T.  c /etc/shared.conf\n"],
+            "pkg2-1.0-1.el7.x86_64": ["missing     /etc/pkg2-1.0-1.el7.x86_64.conf\n"]})
+
+        # More occurrences of a file than owners, a file not owned by the packages, an unknown line
+        for unattributable in ["S.5....T.  c /etc/shared.conf\n" * 3,
+                               "S.5....T.  c /etc/pkg5-1.0-1.el7.x86_64.conf\n", "error: unexpected output\n"]:
+            self.assertEqual(rpmverify.attribute_lines_to_pkgs(unattributable, nvras), None)
+
+    @staticmethod
+    def _get_verified_pkgs(cmds):
+        verified_pkgs = []
+        for cmd in cmds:
+            if cmd.startswith("rpm -V") and "--nofiles" not in cmd:
+                verified_pkgs.extend(cmd.split()[2:])
+        return verified_pkgs
+
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    @unit_tests.mock(rpmverify, "get_pkgs_sharing_files", lambda nvras, other_nvras: set([INSTALLED_NVRAS[5]]))
+    @unit_tests.mock(rpmverify, "get_files_state_digests", GetFilesStateDigestsMocked())
+    @unit_tests.mock(utils, "run_subprocess", RpmRunSubprocessMocked())
+    def test_verify_all_pkgs_only_changed(self):
+        previous = rpmverify.verify_all_pkgs(processes=2)
+
+        # The header of pkg2 has changed, the files of pkg7 have changed and pkg5 shares a file with a changed package
+        changed = [INSTALLED_NVRAS[2], INSTALLED_NVRAS[5], INSTALLED_NVRAS[7], INSTALLED_NVRAS[-1]]
+        rpmverify.get_files_state_digests = GetFilesStateDigestsMocked([INSTALLED_NVRAS[7]])
+        utils.run_subprocess = RpmRunSubprocessMocked(digests={INSTALLED_NVRAS[2]: "new",
+                                                               INSTALLED_NVRAS[-1]: "(none)"})
+        result = rpmverify.verify_all_pkgs(processes=2, previous=previous)
+
+        self.assertEqual(self._get_verified_pkgs(utils.run_subprocess.cmds), changed)
+        # The file lines of the unchanged packages come from the previous verification, the dependencies are fresh
+        expected_output = ""
+        for nvra in INSTALLED_NVRAS:
+            if nvra not in changed:
+                expected_output += RpmRunSubprocessMocked.deps_lines(nvra)
+            expected_output += "S.5....T.  c /etc/%s.conf\n" % nvra
+        self.assertEqual(result.output, expected_output)
+
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    @unit_tests.mock(rpmverify, "get_pkgs_sharing_files", lambda nvras, other_nvras: set())
+    @unit_tests.mock(rpmverify, "get_files_state_digests", GetFilesStateDigestsMocked())
+    @unit_tests.mock(utils, "run_subprocess", RpmRunSubprocessMocked(digests={INSTALLED_NVRAS[-1]: "(none)"}))
+    def test_verify_all_pkgs_cached(self):
+        cache = pkgcache.VerificationCache(os.path.join(self.tmp_dir, "rpm_va.sqlite"))
+        first = rpmverify.verify_all_pkgs(processes=2, cache=cache)
+
+        # The gpg-pubkey has no header digest and is not cached
+        self.assertEqual(sorted(cache.load(rpmverify.VerificationProfile())), sorted(INSTALLED_NVRAS[:-1]))
+        self.assertEqual(cache.load(rpmverify.VerificationProfile())[INSTALLED_NVRAS[0]],
+                         ("digest", "files", ["S.5....T.  c /etc/%s.conf\n" % INSTALLED_NVRAS[0]]))
+        # The results of a verification with a different profile are not used
+        self.assertEqual(cache.load(rpmverify.VerificationProfile("metadata-only")), {})
+
+        # Next time just the packages with changed files are verified, the output is the same
+        rpmverify.get_files_state_digests = GetFilesStateDigestsMocked([INSTALLED_NVRAS[3]])
+        utils.run_subprocess = RpmRunSubprocessMocked(digests={INSTALLED_NVRAS[-1]: "(none)"})
+        second = rpmverify.verify_all_pkgs(processes=2, cache=cache)
+
+        self.assertEqual(self._get_verified_pkgs(utils.run_subprocess.cmds), [INSTALLED_NVRAS[3], INSTALLED_NVRAS[-1]])
+        self.assertEqual([line for line in second.output.splitlines() if "/etc/" in line], first.output.splitlines())
+        self.assertEqual(cache.load(rpmverify.VerificationProfile())[INSTALLED_NVRAS[3]][1], "changed")
+
+    @unit_tests.mock(rpmverify, "MAX_PKGS_PER_SHARD", 3)
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    @unit_tests.mock(rpmverify, "get_files_state_digests", GetFilesStateDigestsMocked())
+    # pkg0 has all its files excluded
+    @unit_tests.mock(rpmverify, "get_fully_excluded_pkgs", lambda nvras, profile: set([INSTALLED_NVRAS[0]]))
+    @unit_tests.mock(utils, "run_subprocess", RpmRunSubprocessMocked())
+    def test_verify_all_pkgs_w_profile(self):
+        profile = rpmverify.VerificationProfile("metadata-only", ["/etc/pkg1-*"])
+
+        result = rpmverify.verify_all_pkgs(processes=2, profile=profile)
+
+        verify_cmds = [cmd for cmd in utils.run_subprocess.cmds if cmd.startswith("rpm -V")]
+        self.assertTrue(all(cmd.startswith("rpm -V --nofiledigest ") for cmd in verify_cmds))
+        self.assertFalse(INSTALLED_NVRAS[0] in " ".join(verify_cmds))
+        # The line of the excluded file of pkg1 is filtered out
+        self.assertEqual(result.output, "".join(["S.5....T.  c /etc/%s.conf\n" % nvra for nvra in INSTALLED_NVRAS[2:]]))
+        self.assertEqual(result.lines_per_pkg[INSTALLED_NVRAS[1]], [])
+        self.assertEqual(result.profile, profile)
+
+    def test_verification_profile(self):
+        self.assertEqual(str(rpmverify.VerificationProfile()), "full")
+        profile = rpmverify.VerificationProfile("config-files-only", ["/srv/*", "/var/lib/data/*"])
+        self.assertEqual(str(profile), "config-files-only, excluding /srv/*, /var/lib/data/*")
+        # 'rpm -V' can't verify just the config files, the lines of the other files are filtered out of the output
+        self.assertEqual(profile.rpm_options, "")
+        self.assertTrue(profile.is_excluded("/srv/www/index.html"))
+        self.assertFalse(profile.is_excluded("/etc/yum.conf"))
+        self.assertEqual(profile, rpmverify.VerificationProfile("config-files-only", ["/srv/*", "/var/lib/data/*"]))
+        self.assertNotEqual(profile, rpmverify.VerificationProfile("config-files-only"))
+        self.assertRaises(ValueError, rpmverify.VerificationProfile, "nonexistent")
+
+    def test_verification_profile_config_files_only(self):
+        profile = rpmverify.VerificationProfile("config-files-only", ["/etc/pkg2.conf"])
+        lines = ["S.5....T.  c /etc/pkg1.conf\n", "missing   c /etc/pkg1.d/local.conf\n",
+                 "S.5....T.    /usr/bin/pkg1\n", ".M.......  d /usr/share/doc/pkg1/README\n",
+                 "S.5....T.  c /etc/pkg2.conf\n", "Unsatisfied dependencies for pkg1-1.0-1.x86_64:\n",
+                 "\tpkg2 is needed by pkg1-1.0-1.x86_64\n"]
+
+        self.assertEqual(profile.filter_lines(lines), [lines[0], lines[1]] + lines[5:])
+
+    @unit_tests.mock(rpmverify, "MAX_PKGS_PER_SHARD", 3)
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    @unit_tests.mock(rpmverify, "get_files_state_digests", GetFilesStateDigestsMocked())
+    @unit_tests.mock(utils, "run_subprocess", RpmRunSubprocessMocked())
+    def test_background_verification(self):
+        serial_output, _ = utils.run_subprocess("rpm -Va")
+
+        verification = rpmverify.BackgroundVerification()
+        verification.start()
+        result = verification.wait()
+
+        self.assertEqual(result.output, serial_output)
+        self.assertEqual(verification.progress.total, len(INSTALLED_NVRAS))
+        self.assertEqual(verification.progress.verified, len(INSTALLED_NVRAS))
+
+    class VerifyAllPkgsMocked(unit_tests.MockFunction):
+        def __init__(self, error=None, log_msg=None):
+            self.error = error
+            self.log_msg = log_msg
+
+        def __call__(self, processes=None, previous=None, progress=None, cache=None, profile=None):
+            if self.error:
+                raise self.error
+            if self.log_msg:
+                logging.getLogger("convert2rhel.rpmverify").info(self.log_msg)
+            return rpmverify.VerificationResult("rpmva\n")
+
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked(error=OSError("rpm not found")))
+    @unit_tests.mock(rpmverify.logging, "getLogger", unit_tests.GetLoggerMocked())
+    def test_background_verification_error(self):
+        verification = rpmverify.BackgroundVerification()
+        verification.start()
+
+        # The verification is just informational, its failure doesn't stop the conversion
+        self.assertEqual(verification.wait(), None)
+        self.assertEqual(rpmverify.logging.getLogger.warning_msgs,
+                         ["The 'rpm -Va' command failed: OSError: rpm not found"])
+
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked(log_msg="Verifying in the child process."))
+    def test_background_verification_log_replay(self):
+        logger = logging.getLogger("convert2rhel.rpmverify")
+        handler = rpmverify._RecordingHandler()  # pylint: disable=protected-access
+        orig_level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            verification = rpmverify.BackgroundVerification()
+            verification.start()
+            # Nothing logged by the child process is written out before waiting for it
+            verification._process.join()  # pylint: disable=protected-access
+            self.assertFalse((logging.INFO, "Verifying in the child process.") in handler.records)
+
+            self.assertEqual(verification.wait().output, "rpmva\n")
+            self.assertIn((logging.INFO, "Verifying in the child process."), handler.records)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(orig_level)
+
+    @unit_tests.mock(rpmverify, "get_path_owners", get_path_owners)
+    @unit_tests.mock(rpmverify.rpm, "TransactionSet", lambda: None)
+    def test_compare_verified_files(self):
+        pkgs = [(nvra, "digest") for nvra in INSTALLED_NVRAS[:3]]
+        before_output = "S.5....T.  c /etc/%s.conf\nmissing     /etc/%s.conf\n" % (INSTALLED_NVRAS[0],
+                                                                                     INSTALLED_NVRAS[1])
+        after_output = ".M.......  c /etc/%s.conf\n.......T.    /etc/%s.conf\n" % (INSTALLED_NVRAS[0],
+                                                                                     INSTALLED_NVRAS[2])
+        before = rpmverify.VerificationResult(before_output, pkgs,
+                                              rpmverify.attribute_lines_to_pkgs(before_output, INSTALLED_NVRAS[:3]))
+        after = rpmverify.VerificationResult(after_output, pkgs,
+                                             rpmverify.attribute_lines_to_pkgs(after_output, INSTALLED_NVRAS[:3]))
+
+        before_files = rpmverify.get_verified_files(before)
+        self.assertEqual(before_files["/etc/%s.conf" % INSTALLED_NVRAS[1]], rpmverify.VerifiedFile(
+            INSTALLED_NVRAS[1], "missing", "", "/etc/%s.conf" % INSTALLED_NVRAS[1]))
+
+        changes = rpmverify.compare_verified_files(before_files, rpmverify.get_verified_files(after))
+        self.assertEqual(changes, [
+            rpmverify.FileChange(rpmverify.FILE_FLAGS_CHANGED, INSTALLED_NVRAS[0], "/etc/%s.conf" % INSTALLED_NVRAS[0],
+                                 "c", "S.5....T.", ".M......."),
+            rpmverify.FileChange(rpmverify.FILE_FIXED, INSTALLED_NVRAS[1], "/etc/%s.conf" % INSTALLED_NVRAS[1], "",
+                                 "missing", None),
+            rpmverify.FileChange(rpmverify.FILE_MODIFIED, INSTALLED_NVRAS[2], "/etc/%s.conf" % INSTALLED_NVRAS[2], "",
+                                 None, ".......T."),
+        ])
+
+        # Without the lines attributed to the packages
+        changes = rpmverify.compare_verified_files(
+            rpmverify.get_verified_files(rpmverify.VerificationResult(before_output)),
+            rpmverify.get_verified_files(rpmverify.VerificationResult(after_output)))
+        self.assertEqual([(change.change, change.pkg) for change in changes], [(rpmverify.FILE_FLAGS_CHANGED, None),
+                                                                               (rpmverify.FILE_FIXED, None),
+                                                                               (rpmverify.FILE_MODIFIED, None)])
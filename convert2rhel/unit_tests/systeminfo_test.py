@@ -18,19 +18,18 @@
 # Required imports:
 
 
+import json
 import logging
 import os
 import shutil
 import unittest
 
-import pytest
 from collections import namedtuple
 
 from convert2rhel import unit_tests  # Imports unit_tests/__init__.py
-from convert2rhel import logger, utils
+from convert2rhel import logger, rpmverify, systeminfo, utils
 from convert2rhel.systeminfo import system_info
 from convert2rhel.toolopts import tool_opts
-from convert2rhel.unit_tests import is_rpm_based_os
 
 
 class TestSysteminfo(unittest.TestCase):
@@ -116,36 +115,133 @@ class TestSysteminfo(unittest.TestCase):
     def test_modified_rpm_files_diff_with_no_rpm_va(self):
         self.assertEqual(system_info.modified_rpm_files_diff(), None)
 
+    class VerifyAllPkgsMocked(unit_tests.MockFunction):
+        def __init__(self, output="rpmva\n"):
+            self.previous = []
+            self.output = output
+
+        def __call__(self, processes=None, previous=None, progress=None, cache=None, profile=None):
+            self.previous.append(previous)
+            return rpmverify.VerificationResult(self.output, profile=profile)
+
+    class BackgroundVerificationMocked(object):
+        """Runs the verification when waited for, in the same process, so that the mocks used by it are visible."""
+
+        def __init__(self, previous=None, cache=None, profile=None):
+            self.previous = previous
+            self.cache = cache
+            self.profile = profile
+
+        def start(self):
+            pass
+
+        def wait(self):
+            return rpmverify.verify_all_pkgs(previous=self.previous, cache=self.cache, profile=self.profile)
+
+    @unit_tests.mock(tool_opts, "no_rpm_va", False)
     @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
-    @unit_tests.mock(utils, "get_file_content", GetFileContentMocked(data=[['rpm1', 'rpm2'],
-                                                                           ['rpm1', 'rpm2']]))
+    @unit_tests.mock(system_info, "logger", GetLoggerMocked())
+    @unit_tests.mock(system_info, "rpm_va_result", rpmverify.VerificationResult(
+        ".M.......  g /etc/pki/ca-trust/extracted/java/cacerts\n"))
+    @unit_tests.mock(rpmverify, "BackgroundVerification", BackgroundVerificationMocked)
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked(
+        ".M.......  g /etc/pki/ca-trust/extracted/java/cacerts\n"))
     def test_modified_rpm_files_diff_without_differences_after_conversion(self):
         self.assertEqual(system_info.modified_rpm_files_diff(), None)
+        self.assertFalse(any("Comparison of modified rpm files" in msg for msg in system_info.logger.info_msgs))
 
-    @unit_tests.mock(os.path, "exists", PathExistsMocked(True))
     @unit_tests.mock(tool_opts, "no_rpm_va", False)
     @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
     @unit_tests.mock(system_info, "logger", GetLoggerMocked())
-    @unit_tests.mock(utils, "get_file_content", GetFileContentMocked(
-        data=[['.M.......  g /etc/pki/ca-trust/extracted/java/cacerts'],
-              ['.M.......  g /etc/pki/ca-trust/extracted/java/cacerts',
-               'S.5....T.  c /etc/yum.conf']]))
-    @pytest.mark.skipif(not is_rpm_based_os(), reason="Current test runs only on rpm based systems.")
+    @unit_tests.mock(system_info, "rpm_va_result", rpmverify.VerificationResult(
+        ".M.......  g /etc/pki/ca-trust/extracted/java/cacerts\n"
+        "S.5....T.  c /etc/centos.conf\n"))
+    @unit_tests.mock(rpmverify, "BackgroundVerification", BackgroundVerificationMocked)
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked(
+        "..5....T.  g /etc/pki/ca-trust/extracted/java/cacerts\n"
+        "S.5....T.  c /etc/yum.conf\n"))
     def test_modified_rpm_files_diff_with_differences_after_conversion(self):
         system_info.modified_rpm_files_diff()
-        self.assertTrue(any('S.5....T.  c /etc/yum.conf' in elem for elem in system_info.logger.info_msgs))
+
+        self.assertTrue(any("modified      S.5....T. c /etc/yum.conf" in msg for msg in system_info.logger.info_msgs))
+        self.assertTrue(any("fixed         S.5....T. c /etc/centos.conf" in msg
+                            for msg in system_info.logger.info_msgs))
+        self.assertTrue(any(".M....... -> ..5....T. g /etc/pki/ca-trust/extracted/java/cacerts" in msg
+                            for msg in system_info.logger.info_msgs))
+        diff = json.loads(utils.get_file_content(os.path.join(unit_tests.TMP_DIR, systeminfo.RPM_VA_DIFF_FILENAME)))
+        self.assertEqual(diff["profile"], "full")
+        diff = diff["packages"]
+        self.assertEqual(len(diff), 1)
+        self.assertEqual(diff[0]["package"], None)
+        self.assertEqual([change["path"] for change in diff[0]["changes"]],
+                         ["/etc/centos.conf", "/etc/pki/ca-trust/extracted/java/cacerts", "/etc/yum.conf"])
+        self.assertEqual(diff[0]["changes"][2], {"change": "modified", "path": "/etc/yum.conf", "file_type": "c",
+                                                 "flags_before": None, "flags_after": "S.5....T."})
+
+    @unit_tests.mock(tool_opts, "no_rpm_va", False)
+    @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
+    @unit_tests.mock(system_info, "logger", GetLoggerMocked())
+    @unit_tests.mock(system_info, "rpm_va_result", rpmverify.VerificationResult(
+        "S.5....T.  c /etc/yum.conf\n", profile=rpmverify.VerificationProfile("metadata-only")))
+    @unit_tests.mock(rpmverify, "BackgroundVerification", BackgroundVerificationMocked)
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked())
+    def test_modified_rpm_files_diff_with_different_profiles(self):
+        system_info.modified_rpm_files_diff()
+
+        self.assertTrue(any("different verification profiles: 'metadata-only' and 'full'" in msg
+                            for msg in system_info.logger.warning_msgs))
+        self.assertFalse(os.path.exists(os.path.join(unit_tests.TMP_DIR, systeminfo.RPM_VA_DIFF_FILENAME)))
 
     @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
-    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked(("rpmva\n", 0)))
+    @unit_tests.mock(rpmverify, "BackgroundVerification", BackgroundVerificationMocked)
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked())
     def test_generate_rpm_va(self):
         # Check that rpm -Va is executed (default) and stored into the specific file.
         system_info.generate_rpm_va()
 
-        self.assertTrue(utils.run_subprocess.called > 0)
-        self.assertEqual(utils.run_subprocess.used_args[0][0], "rpm -Va")
+        self.assertEqual(rpmverify.verify_all_pkgs.previous, [None])
         self.assertTrue(os.path.isfile(self.rpmva_output_file))
         self.assertEqual(utils.get_file_content(self.rpmva_output_file), "rpmva\n")
 
+        # After the conversion, the result of the verification before the conversion is reused
+        pre_conversion_result = system_info.rpm_va_result
+        system_info.generate_rpm_va(log_filename=systeminfo.POST_RPM_VA_LOG_FILENAME)
+        self.assertEqual(rpmverify.verify_all_pkgs.previous, [None, pre_conversion_result])
+
+    @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
+    @unit_tests.mock(rpmverify, "BackgroundVerification", BackgroundVerificationMocked)
+    @unit_tests.mock(rpmverify, "verify_all_pkgs", VerifyAllPkgsMocked())
+    def test_generate_rpm_va_background(self):
+        # The output is stored only after waiting for the verification running in the background
+        system_info.generate_rpm_va(background=True)
+        system_info.wait_for_rpm_va()
+
+        self.assertEqual(utils.get_file_content(self.rpmva_output_file), "rpmva\n")
+        self.assertEqual(system_info.rpm_va_result.output, "rpmva\n")
+
+        # Nothing to wait for anymore
+        os.remove(self.rpmva_output_file)
+        system_info.wait_for_rpm_va()
+        self.assertFalse(os.path.exists(self.rpmva_output_file))
+
+    class BackgroundVerificationFailedMocked(BackgroundVerificationMocked):
+        def wait(self):
+            return None
+
+    @unit_tests.mock(tool_opts, "no_rpm_va", False)
+    @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
+    @unit_tests.mock(system_info, "logger", GetLoggerMocked())
+    @unit_tests.mock(rpmverify, "BackgroundVerification", BackgroundVerificationFailedMocked)
+    def test_generate_rpm_va_failed(self):
+        # A failed verification doesn't stop the conversion, just the comparison is skipped
+        system_info.generate_rpm_va(background=True)
+        system_info.wait_for_rpm_va()
+
+        self.assertEqual(system_info.rpm_va_result, None)
+        self.assertFalse(os.path.exists(self.rpmva_output_file))
+        system_info.modified_rpm_files_diff()
+        self.assertTrue(any("Skipping comparison" in msg for msg in system_info.logger.info_msgs))
+
     @unit_tests.mock(logger, "LOG_DIR", unit_tests.TMP_DIR)
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     def test_generate_rpm_va_skip(self):
@@ -65,6 +65,27 @@ class TestToolopts(unittest.TestCase):
         self.assertEqual(tool_opts.enablerepo, ["foo"])
         self.assertEqual(tool_opts.disablerepo, ["*"])
 
+    @unit_tests.mock(sys, "argv", _params(["--rpm-va-profile", "metadata-only", "--rpm-va-exclude", "/srv/*",
+                                           "--rpm-va-exclude", "/opt/data/*"]))
+    def test_cmdline_rpm_va_profile(self):
+        convert2rhel.toolopts.CLI()
+        self.assertEqual(tool_opts.rpm_va_profile, "metadata-only")
+        self.assertEqual(tool_opts.rpm_va_exclude, ["/srv/*", "/opt/data/*"])
+
+    @unit_tests.mock(sys, "argv", _params(["--offline-pkg-backup"]))
+    def test_cmdline_offline_pkg_backup(self):
+        convert2rhel.toolopts.CLI()
+        self.assertTrue(tool_opts.offline_pkg_backup)
+
+    @unit_tests.mock(sys, "argv", _params(["--pkg-store-seed", "/mnt/rpms"]))
+    def test_cmdline_pkg_store_seed(self):
+        convert2rhel.toolopts.CLI()
+        self.assertEqual(tool_opts.pkg_store_seed, "/mnt/rpms")
+
+    @unit_tests.mock(sys, "argv", _params(["--rpm-va-profile", "nonexistent"]))
+    def test_cmdline_exits_on_unknown_rpm_va_profile(self):
+        self.assertRaises(SystemExit, convert2rhel.toolopts.CLI)
+
     @unit_tests.mock(sys, "argv", _params(["--disable-submgr"]))
     def test_cmdline_exits_on_empty_enablerepo_with_disable_submgr(self):
         self.assertRaises(SystemExit, convert2rhel.toolopts.CLI)
@@ -17,12 +17,17 @@
 
 from collections import namedtuple
 import os
-import re
+import shutil
+import tempfile
 import unittest
 
 from convert2rhel import unit_tests  # Imports unit_tests/__init__.py
+from convert2rhel import logger
+from convert2rhel import pkgarchive
 from convert2rhel import utils
+from convert2rhel.pkghandler import DownloadResult
 from convert2rhel.systeminfo import system_info
+from convert2rhel.toolopts import tool_opts
 from convert2rhel.unit_tests import is_rpm_based_os
 
 
@@ -70,51 +75,63 @@ class TestUtils(unittest.TestCase):
             control.track_installed_pkg(pkg)
         self.assertEqual(control.installed_pkgs, pkgs)
 
-    @unit_tests.mock(utils.RestorablePackage, "backup", DummyFuncMocked())
-    def test_backup_and_track_removed_pkg(self):
-        control = utils.ChangedRPMPackagesController()
-        pkgs = ['pkg1', 'pkg2', 'pkg3']
-        for pkg in pkgs:
-            control.backup_and_track_removed_pkg(pkg)
-        self.assertEqual(utils.RestorablePackage.backup.called, len(pkgs))
-        self.assertEqual(len(control.removed_pkgs), len(pkgs))
-
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     def test_remove_pkgs_with_empty_list(self):
         utils.remove_pkgs([])
         self.assertEqual(utils.run_subprocess.called, 0)
 
     @unit_tests.mock(utils.ChangedRPMPackagesController,
-                     "backup_and_track_removed_pkg",
+                     "backup_and_track_removed_pkgs",
                      DummyFuncMocked())
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     def test_remove_pkgs_without_backup(self):
         pkgs = ['pkg1', 'pkg2', 'pkg3']
         utils.remove_pkgs(pkgs, False)
         self.assertEqual(
-            utils.ChangedRPMPackagesController.backup_and_track_removed_pkg.called, 0)
+            utils.ChangedRPMPackagesController.backup_and_track_removed_pkgs.called, 0)
 
-        self.assertEqual(utils.run_subprocess.called, len(pkgs))
-
-        rpm_remove_cmd = "rpm -e --nodeps"
-        self.assertTrue(re.search(r"^%s pkg" % rpm_remove_cmd,
-                                  utils.run_subprocess.cmds, re.MULTILINE))
+        # All the packages are removed in a single rpm transaction
+        self.assertEqual(utils.run_subprocess.called, 1)
+        self.assertEqual(utils.run_subprocess.cmd, "rpm -e --nodeps pkg1 pkg2 pkg3")
 
     @unit_tests.mock(utils.ChangedRPMPackagesController,
-                     "backup_and_track_removed_pkg",
+                     "backup_and_track_removed_pkgs",
                      DummyFuncMocked())
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     def test_remove_pkgs_with_backup(self):
         pkgs = ['pkg1', 'pkg2', 'pkg3']
         utils.remove_pkgs(pkgs)
+        # All the packages are backed up at once
         self.assertEqual(
-            utils.ChangedRPMPackagesController.backup_and_track_removed_pkg.called, len(pkgs))
+            utils.ChangedRPMPackagesController.backup_and_track_removed_pkgs.called, 1)
 
-        self.assertEqual(utils.run_subprocess.called, len(pkgs))
-
-        rpm_remove_cmd = "rpm -e --nodeps"
-        self.assertTrue(re.search(r"^%s pkg" % rpm_remove_cmd,
-                                  utils.run_subprocess.cmds, re.MULTILINE))
+        self.assertEqual(utils.run_subprocess.called, 1)
+        self.assertEqual(utils.run_subprocess.cmd, "rpm -e --nodeps pkg1 pkg2 pkg3")
+
+    @unit_tests.mock(utils, "run_subprocess", unit_tests.RunSubprocessSequenceMocked([
+        ("error: package pkg2 is not installed\n", 1),
+        ("pkg1-1.0-1.el7.x86_64\npackage pkg2 is not installed\npkg3-1.0-1.el7.x86_64\n", 1),
+        ("", 0),
+        ("error: package pkg2 is not installed\n", 1)]))
+    def test_remove_pkgs_batch_failure(self):
+        utils.remove_pkgs(["pkg1", "pkg2", "pkg3"], backup=False, critical=False)
+
+        # Just the failing package is removed separately
+        self.assertEqual(utils.run_subprocess.cmds, ["rpm -e --nodeps pkg1 pkg2 pkg3",
+                                                     "rpm -q pkg1 pkg3",
+                                                     "rpm -e --nodeps pkg1 pkg3",
+                                                     "rpm -e --nodeps pkg2"])
+
+    @unit_tests.mock(utils, "run_subprocess", unit_tests.RunSubprocessSequenceMocked([
+        ("error: %preun(pkg1-1.0-1.el7.x86_64) scriptlet failed, exit status 1\n", 1),
+        ("package pkg2-1.0-1.el7.x86_64 is not installed\n", 1)]))
+    def test_remove_pkgs_batch_scriptlet_failure(self):
+        utils.remove_pkgs(["pkg1-1.0-1.el7.x86_64", "pkg2-1.0-1.el7.x86_64"], backup=False, critical=False)
+
+        # The other package has been removed by the batch already
+        self.assertEqual(utils.run_subprocess.cmds, ["rpm -e --nodeps pkg1-1.0-1.el7.x86_64 pkg2-1.0-1.el7.x86_64",
+                                                     "rpm -q pkg2-1.0-1.el7.x86_64",
+                                                     "rpm -e --nodeps pkg1-1.0-1.el7.x86_64"])
 
     @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     def test_install_pkgs_with_empty_list(self):
@@ -158,6 +175,73 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(output, "")
         self.assertEqual(code, 56)
 
+    def test_run_subprocess_line_callback_and_max_output_size(self):
+        lines = []
+        orig_log_dir = logger.LOG_DIR
+        logger.LOG_DIR = tempfile.mkdtemp()
+        try:
+            output, code = utils.run_subprocess("seq 1 1000", line_callback=lines.append, max_output_size=100)
+            spilled_files = os.listdir(logger.LOG_DIR)
+        finally:
+            shutil.rmtree(logger.LOG_DIR)
+            logger.LOG_DIR = orig_log_dir
+
+        self.assertEqual(code, 0)
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[0], "1\n")
+        # Just the tail of the output is returned, the whole output is saved in a file in the log directory
+        self.assertTrue(len(output) <= 100)
+        self.assertTrue(output.endswith("999\n1000\n"))
+        self.assertEqual(len(spilled_files), 1)
+
+    def test_output_buffer(self):
+        log_dir = tempfile.mkdtemp()
+        try:
+            output = self._fill_output_buffer(log_dir)
+            self.assertEqual(output.getvalue(), "third\n")
+            self.assertEqual(output.spilled_lines, 2)
+            self.assertEqual(output.spill_path, os.path.join(log_dir, utils.OUTPUT_SPILL_FILENAME))
+            with open(output.spill_path) as spill_file:
+                self.assertEqual(spill_file.read(), "first\nsecond\nthird\n")
+
+            # The output of the next command overwrites the file instead of piling up the files
+            output = self._fill_output_buffer(log_dir, ["1\n", "2\n", "3\n", "4\n", "5\n", "6\n"])
+            self.assertEqual(os.listdir(log_dir), [utils.OUTPUT_SPILL_FILENAME])
+            with open(output.spill_path) as spill_file:
+                self.assertEqual(spill_file.read(), "1\n2\n3\n4\n5\n6\n")
+
+            # Just the tail of a line over the limit is kept in memory
+            output = self._fill_output_buffer(log_dir, ["first\n", "a very long line\n"])
+            self.assertEqual(output.getvalue(), "long line\n")
+            with open(output.spill_path) as spill_file:
+                self.assertEqual(spill_file.read(), "first\na very long line\n")
+
+            # The log directory can't be created
+            output = self._fill_output_buffer(os.path.join(output.spill_path, "log"))
+            self.assertEqual(output.getvalue(), "third\n")
+            self.assertEqual(output.spill_path, None)
+        finally:
+            shutil.rmtree(log_dir)
+
+        output = utils.OutputBuffer()
+        output.append("first\n")
+        output.close()
+        self.assertEqual(output.getvalue(), "first\n")
+        self.assertEqual(output.spill_path, None)
+
+    @staticmethod
+    def _fill_output_buffer(log_dir, lines=("first\n", "second\n", "third\n")):
+        orig_log_dir = logger.LOG_DIR
+        logger.LOG_DIR = log_dir
+        try:
+            output = utils.OutputBuffer(max_size=10)
+            for line in lines:
+                output.append(line)
+            output.close()
+        finally:
+            logger.LOG_DIR = orig_log_dir
+        return output
+
     DOWNLOADED_RPM_NVRA = "kernel-4.18.0-193.28.1.el8_2.x86_64"
     DOWNLOADED_RPM_NEVRA = "7:%s" % DOWNLOADED_RPM_NVRA
     DOWNLOADED_RPM_FILENAME = "%s.rpm" % DOWNLOADED_RPM_NVRA
@@ -170,62 +254,214 @@ class TestUtils(unittest.TestCase):
         "[SKIPPED] %s: Already downloaded" % DOWNLOADED_RPM_FILENAME
     ]
 
-    @unit_tests.mock(utils, "download_pkg",
-                     lambda pkg, dest, reposdir, enable_repos, disable_repos, set_releasever: "/filepath/")
+    class ReadRpmFilesNevrasMocked(unit_tests.MockFunction):
+        def __init__(self, nevras):
+            self.nevras = nevras
+
+        def __call__(self, directory):
+            return [(os.path.join(directory, filename), nevra) for filename, nevra in self.nevras]
+
+    @unit_tests.mock(utils, "read_rpm_files_nevras", ReadRpmFilesNevrasMocked([
+        ("vim-enhanced-8.0.1763-13.el8.x86_64.rpm", ("vim-enhanced", None, "8.0.1763", "13.el8", "x86_64")),
+        ("oraclelinux-release-8.2-1.0.8.el8.x86_64.rpm", ("oraclelinux-release", "8", "8.2", "1.0.8.el8", "x86_64")),
+        ("kernel-4.18.0-193.el8.x86_64.rpm", ("kernel", None, "4.18.0", "193.el8", "x86_64"))]))
+    @unit_tests.mock(os.path, "getmtime", lambda path: 0)
+    def test_get_rpm_paths_by_pkg(self):
+        paths = utils.get_rpm_paths_by_pkg(["vim-enhanced", "oraclelinux-release-8:8.2-1.0.8.el8.x86_64",
+                                            "7:oraclelinux-release-7.9-1.0.9.el7.x86_64", "kernel-4.18.0-193.el8",
+                                            "kernel-4.18.0-193.el8.x86_64", "bash"], "/backup")
+
+        self.assertEqual(paths, {
+            "vim-enhanced": "/backup/vim-enhanced-8.0.1763-13.el8.x86_64.rpm",
+            "oraclelinux-release-8:8.2-1.0.8.el8.x86_64": "/backup/oraclelinux-release-8.2-1.0.8.el8.x86_64.rpm",
+            "7:oraclelinux-release-7.9-1.0.9.el7.x86_64": None,
+            "kernel-4.18.0-193.el8": "/backup/kernel-4.18.0-193.el8.x86_64.rpm",
+            "kernel-4.18.0-193.el8.x86_64": "/backup/kernel-4.18.0-193.el8.x86_64.rpm",
+            "bash": None})
+
+    @unit_tests.mock(utils, "read_rpm_files_nevras", ReadRpmFilesNevrasMocked([
+        ("pkg1-1-1.noarch.rpm", ("pkg1", None, "1", "1", "noarch")),
+        ("pkg2-1-1.noarch.rpm", ("pkg2", None, "1", "1", "noarch")),
+        ("pkg3-1-1.noarch.rpm", ("pkg3", None, "1", "1", "noarch"))]))
+    def test_get_rpm_paths_by_pkg_ignores_old_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for filename in ("pkg1-1-1.noarch.rpm", "pkg2-1-1.noarch.rpm"):
+                utils.store_content_to_file(os.path.join(directory, filename), "")
+            old_files = utils.get_rpm_files_stats(directory)
+            # Downloaded again by the call
+            os.utime(os.path.join(directory, "pkg2-1-1.noarch.rpm"), (1600000000, 1600000000))
+            utils.store_content_to_file(os.path.join(directory, "pkg3-1-1.noarch.rpm"), "")
+
+            paths = utils.get_rpm_paths_by_pkg(["pkg1", "pkg2", "pkg3"], directory, old_files)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(paths, {"pkg1": None, "pkg2": os.path.join(directory, "pkg2-1-1.noarch.rpm"),
+                                 "pkg3": os.path.join(directory, "pkg3-1-1.noarch.rpm")})
+
+    @unit_tests.mock(utils, "read_rpm_files_nevras", ReadRpmFilesNevrasMocked([
+        ("pkg1-1-1.noarch.rpm", ("pkg1", None, "1", "1", "noarch")),
+        ("pkg2-1-1.noarch.rpm", ("pkg2", None, "1", "1", "noarch"))]))
+    def test_get_rpm_paths_by_pkg_reuses_old_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for filename in ("pkg1-1-1.noarch.rpm", "pkg2-1-1.noarch.rpm"):
+                utils.store_content_to_file(os.path.join(directory, filename), "")
+            old_files = utils.get_rpm_files_stats(directory)
+
+            # The unchanged pkg1 rpm has not been downloaded again because it's already there, pkg2 is just stale
+            paths = utils.get_rpm_paths_by_pkg(["pkg1", "pkg2"], directory, old_files,
+                                               "[SKIPPED] pkg1-1-1.noarch.rpm: Already downloaded\n")
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(paths, {"pkg1": os.path.join(directory, "pkg1-1-1.noarch.rpm"), "pkg2": None})
+
+    def test_is_rpm_file_in_output(self):
+        nevra = ("kernel", "7", "4.18.0", "193.28.1.el8_2", "x86_64")
+        path = os.path.join(utils.TMP_DIR, self.DOWNLOADED_RPM_FILENAME)
+        for output in self.YUMDOWNLOADER_OUTPUTS:
+            self.assertTrue(utils._is_rpm_file_in_output(path, nevra, output))
+
+        self.assertFalse(utils._is_rpm_file_in_output(path, nevra, ""))
+        self.assertFalse(utils._is_rpm_file_in_output(path, nevra, "No package kernel-5.0 available."))
+        # Another build of the package
+        self.assertFalse(utils._is_rpm_file_in_output(path, nevra, "[SKIPPED] %s.1.rpm: Already downloaded"
+                                                      % self.DOWNLOADED_RPM_NVRA))
+
+    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
+    @unit_tests.mock(system_info, "releasever", "7Server")
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked(ret_code=1))
+    @unit_tests.mock(utils, "get_rpm_paths_by_pkg",
+                     lambda pkgs, directory, old_files, output: {"pkg1": "/backup/pkg1-1-1.noarch.rpm", "pkg2": None})
+    @unit_tests.mock(utils, "_download_pkgs_in_process", lambda *args: None)
+    def test_download_pkgs_in_batch(self):
+        paths = utils.download_pkgs_in_batch(["pkg1", "pkg2"], dest="/backup", set_releasever=False)
+
+        # A single yumdownloader call for all the packages
+        self.assertEqual(utils.run_subprocess.called, 1)
+        self.assertEqual(utils.run_subprocess.cmd, 'yumdownloader -v --destdir="/backup" pkg1 pkg2')
+        self.assertEqual(paths, {"pkg1": "/backup/pkg1-1-1.noarch.rpm", "pkg2": None})
+
+    @unit_tests.mock(os.path, "isdir", lambda path: True)
+    @unit_tests.mock(utils, "download_pkgs_in_batch",
+                     lambda pkgs, dest, set_releasever: dict([(pkg, "/backup/%s.rpm" % pkg) for pkg in pkgs]))
+    def test_backup_and_track_removed_pkgs(self):
+        control = utils.ChangedRPMPackagesController()
+
+        control.backup_and_track_removed_pkgs(["pkg1", "pkg2"])
+
+        self.assertEqual([(pkg.name, pkg.path) for pkg in control.removed_pkgs],
+                         [("pkg1", "/backup/pkg1.rpm"), ("pkg2", "/backup/pkg2.rpm")])
+
+    @unit_tests.mock(os.path, "isdir", lambda path: True)
+    @unit_tests.mock(utils, "download_pkgs_in_batch",
+                     lambda pkgs, dest, set_releasever: {"pkg1": "/backup/pkg1.rpm", "pkg2": None})
+    @unit_tests.mock(pkgarchive, "archive_pkgs", lambda pkgs: dict([(pkg, "archived %s" % pkg) for pkg in pkgs]))
+    def test_backup_and_track_removed_pkgs_not_downloaded(self):
+        control = utils.ChangedRPMPackagesController()
+
+        control.backup_and_track_removed_pkgs(["pkg1", "pkg2"])
+
+        # The package failing to be downloaded is backed up from the installed files
+        self.assertEqual([(pkg.name, pkg.path, pkg.archive) for pkg in control.removed_pkgs],
+                         [("pkg1", "/backup/pkg1.rpm", None), ("pkg2", None, "archived pkg2")])
+
+    @unit_tests.mock(os.path, "isdir", lambda path: True)
+    @unit_tests.mock(tool_opts, "offline_pkg_backup", True)
+    @unit_tests.mock(utils, "download_pkgs_in_batch", DummyFuncMocked())
+    @unit_tests.mock(pkgarchive, "archive_pkgs", lambda pkgs: dict([(pkg, "archived %s" % pkg) for pkg in pkgs]))
+    def test_backup_and_track_removed_pkgs_offline(self):
+        control = utils.ChangedRPMPackagesController()
+
+        control.backup_and_track_removed_pkgs(["pkg1", "pkg2"])
+
+        self.assertEqual(utils.download_pkgs_in_batch.called, 0)
+        self.assertEqual([(pkg.name, pkg.path, pkg.archive) for pkg in control.removed_pkgs],
+                         [("pkg1", None, "archived pkg1"), ("pkg2", None, "archived pkg2")])
+
+    class ArchivedPackageMocked(object):
+        def __init__(self):
+            self.restored = False
+
+        def restore(self):
+            self.restored = True
+            return True
+
+    @unit_tests.mock(utils.logging, "getLogger", unit_tests.GetLoggerMocked())
+    @unit_tests.mock(utils, "install_pkgs", DummyFuncMocked())
+    def test_install_removed_pkgs_from_archive(self):
+        control = utils.ChangedRPMPackagesController()
+        restorable_pkg = utils.RestorablePackage("pkg1")
+        restorable_pkg.archive = self.ArchivedPackageMocked()
+        control.removed_pkgs = [restorable_pkg]
+
+        control._install_removed_pkgs()
+
+        self.assertTrue(restorable_pkg.archive.restored)
+        self.assertEqual(utils.logging.getLogger.warning_msgs, [])
+
+    class DownloadPkgsInProcessMocked(unit_tests.MockFunction):
+        def __init__(self):
+            self.args = []
+
+        def __call__(self, pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever):
+            self.args.append((pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever))
+            return dict([(pkg, DownloadResult(pkg, "/dest/%s.rpm" % pkg if pkg != "pkg2" else None, None))
+                         for pkg in pkgs])
+
+    @unit_tests.mock(utils, "_download_pkgs_in_process", DownloadPkgsInProcessMocked())
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
     def test_download_pkgs(self):
         paths = utils.download_pkgs(["pkg1", "pkg2"], "/dest/", "/reposdir/", ["repo1"], ["repo2"], False)
 
-        self.assertEqual(paths, ["/filepath/", "/filepath/"])
+        # All the packages are downloaded in-process at once, no yumdownloader is called
+        self.assertEqual(utils._download_pkgs_in_process.args,
+                         [(["pkg1", "pkg2"], "/dest/", "/reposdir/", ["repo1"], ["repo2"], False)])
+        self.assertEqual(utils.run_subprocess.called, 0)
+        self.assertEqual(paths, ["/dest/pkg1.rpm", None])
+
+    @unit_tests.mock(utils, "_download_pkgs_in_process", DownloadPkgsInProcessMocked())
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked())
+    def test_download_pkg_in_process(self):
+        path = utils.download_pkg("kernel", dest="/dest/")
+
+        self.assertEqual(path, "/dest/kernel.rpm")
+        self.assertEqual(utils.run_subprocess.called, 0)
 
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(8, 0))
     @unit_tests.mock(system_info, "releasever", "8")
-    @unit_tests.mock(utils, "run_cmd_in_pty", RunSubprocessMocked(ret_code=0))
-    @unit_tests.mock(utils, "get_rpm_path_from_yumdownloader_output", lambda x, y, z: "/path/test.rpm")
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked(ret_code=0))
+    @unit_tests.mock(utils, "get_rpm_paths_by_pkg",
+                     lambda pkgs, directory, old_files, output: {"kernel": "/path/test.rpm"})
+    @unit_tests.mock(utils, "_download_pkgs_in_process", lambda *args: None)
     def test_download_pkg_success_with_all_params(self):
         dest = "/test dir/"
         reposdir = "/my repofiles/"
         enable_repos = ["repo1", "repo2"]
         disable_repos = ["*"]
-        
+
         path = utils.download_pkg(
             "kernel", dest=dest, reposdir=reposdir, enable_repos=enable_repos,
             disable_repos=disable_repos, set_releasever=True)
 
+        # The same yumdownloader call as for downloading more packages at once
         self.assertEqual('yumdownloader -v --destdir="%s" --setopt=reposdir="%s" --disablerepo="*" --enablerepo="repo1"'
-                         ' --enablerepo="repo2" --releasever=8 --setopt=module_platform_id=platform:el8 kernel'
+                         ' --enablerepo="repo2" --releasever=8 --setopt=module_platform_id=platform:el8'
+                         ' --setopt=strict=0 kernel'
                          % (dest, reposdir),
-                         utils.run_cmd_in_pty.cmd)
-        self.assertTrue(path)  # path is not None (which is the case of unsuccessful download)
+                         utils.run_subprocess.cmd)
+        self.assertEqual(path, "/path/test.rpm")
 
     @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
-    @unit_tests.mock(utils, "run_cmd_in_pty", RunSubprocessMocked(ret_code=1))
+    @unit_tests.mock(utils, "run_subprocess", RunSubprocessMocked(ret_code=1))
+    @unit_tests.mock(utils, "get_rpm_paths_by_pkg", lambda pkgs, directory, old_files, output: {"kernel": None})
+    @unit_tests.mock(utils, "_download_pkgs_in_process", lambda *args: None)
     def test_download_pkg_failed_download(self):
         path = utils.download_pkg("kernel")
 
         self.assertEqual(path, None)
 
-    @unit_tests.mock(system_info, "version", namedtuple("Version", ["major", "minor"])(7, 0))
-    @unit_tests.mock(utils, "run_cmd_in_pty", RunSubprocessMocked(ret_code=0))
-    def test_download_pkg_incorrect_output(self):
-        utils.run_cmd_in_pty.output = "bogus"
-
-        path = utils.download_pkg("kernel")
-
-        self.assertEqual(path, None)
-
-        utils.run_cmd_in_pty.output = ""
-
-        path = utils.download_pkg("kernel")
-
-        self.assertEqual(path, None)
-
-    def test_get_rpm_path_from_yumdownloader_output(self):
-        for output in self.YUMDOWNLOADER_OUTPUTS:
-            utils.run_cmd_in_pty.output = output
-
-            path = utils.get_rpm_path_from_yumdownloader_output("cmd not important", output, utils.TMP_DIR)
-
-            self.assertEqual(path, os.path.join(utils.TMP_DIR, self.DOWNLOADED_RPM_FILENAME))
-
     def test_is_rpm_based_os(self):
         assert is_rpm_based_os() in (True, False)
@@ -15,14 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
 import datetime
 import errno
 import getpass
+import glob
 import inspect
+import io
 import logging
 import os
 import pexpect
 import re
+import rpm
 import shlex
 import shutil
 import subprocess
@@ -119,10 +123,93 @@ def restart_system():
                            " restart of the system is needed.")
 
 
-def run_subprocess(cmd="", print_cmd=True, print_output=True):
+# The file in the log directory holding the whole output of the last command with the output over the size limit, see
+# OutputBuffer
+OUTPUT_SPILL_FILENAME = "command_output.log"
+
+
+class OutputBuffer(object):
+    """Buffer for the output of a command, filled line by line.
+
+    The lines are joined into a string only once, when asking for the value, instead of concatenating the string for
+    every line. With max_size set, only the last lines of the output, up to max_size characters, are kept in memory.
+    Of a line longer than max_size, just its last max_size characters are kept. Once the output grows over the limit,
+    the whole output is written to the OUTPUT_SPILL_FILENAME file in the log directory (spill_path), overwriting the
+    output of a previous command. When the file can't be created, the output over the limit is dropped.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.spill_path = None
+        self.spilled_lines = 0
+        self._lines = collections.deque()
+        self._size = 0
+        self._spill_file = None
+        self._spill_failed = False
+
+    def append(self, line):
+        if self.max_size is not None and len(line) > self.max_size:
+            # The preceding lines go to the spill file first, then the head of the line
+            while self._lines:
+                self._spill(self._lines.popleft())
+            self._write_to_spill_file(line[:-self.max_size])
+            line = line[-self.max_size:]
+        self._lines.append(line)
+        self._size += len(line)
+        if self.max_size is None:
+            return
+        # Always keep at least the last line
+        while self._size > self.max_size and len(self._lines) > 1:
+            self._spill(self._lines.popleft())
+
+    def _spill(self, line):
+        self._write_to_spill_file(line)
+        self._size -= len(line)
+        self.spilled_lines += 1
+
+    def _write_to_spill_file(self, text):
+        if self._spill_file is None and not self._spill_failed:
+            self._open_spill_file()
+        if self._spill_file is not None:
+            self._spill_file.write(text)
+
+    def _open_spill_file(self):
+        # Importing here instead of on top of the file to avoid cyclic dependency
+        from convert2rhel import logger
+        loggerinst = logging.getLogger(__name__)
+        spill_path = os.path.join(logger.LOG_DIR, OUTPUT_SPILL_FILENAME)
+        try:
+            mkdir_p(logger.LOG_DIR)
+            self._spill_file = io.open(spill_path, "w", encoding="utf-8")
+        except (IOError, OSError) as err:
+            # Not trying again for each line
+            self._spill_failed = True
+            loggerinst.debug("Unable to save the whole output of the command: %s" % str(err))
+            return
+        self.spill_path = spill_path
+
+    def close(self):
+        """Complete the spill file, if any, with the lines kept in memory."""
+        if self._spill_file is not None:
+            for line in self._lines:
+                self._spill_file.write(line)
+            self._spill_file.close()
+            self._spill_file = None
+
+    def getvalue(self):
+        """Return the output, or its tail in case part of it has been spilled to the file."""
+        return "".join(self._lines)
+
+
+def run_subprocess(cmd="", print_cmd=True, print_output=True, line_callback=None, max_output_size=None):
     """Call the passed command and optionally log the called command (print_cmd=True) and its
     output (print_output=True). Switching off printing the command can be useful in case it contains
     a password in plain text.
+
+    The output is processed line by line as it comes. Each line, including the trailing newline, can be passed to
+    the line_callback function. To limit the memory taken by a very long output, pass the max_output_size in
+    characters - only the last lines fitting the size are then returned and the whole output is saved to a file in the
+    log directory, see OutputBuffer.
     """
     loggerinst = logging.getLogger(__name__)
     if print_cmd:
@@ -138,18 +225,25 @@ def run_subprocess(cmd="", print_cmd=True, print_output=True):
                                stderr=subprocess.STDOUT,
                                bufsize=1,
                                env={'LC_ALL': 'C'})
-    output = ''
+    output = OutputBuffer(max_output_size)
     for line in iter(process.stdout.readline, b''):
-        output += line.decode()
+        line = line.decode()
+        output.append(line)
         if print_output:
-            loggerinst.info(line.decode().rstrip('\n'))
+            loggerinst.info(line.rstrip('\n'))
+        if line_callback:
+            line_callback(line)
 
     # Call communicate() to wait for the process to terminate so that we can get the return code by poll().
     # It's just for py2.6, py2.7+/3 doesn't need this.
     process.communicate()
+    output.close()
+    if output.spill_path:
+        loggerinst.debug("The output of the command exceeded %d characters. The whole output has been saved to %s."
+                         % (max_output_size, output.spill_path))
 
     return_code = process.poll()
-    return output, return_code
+    return output.getvalue(), return_code
 
 
 def run_cmd_in_pty(cmd="", print_cmd=True, print_output=True, columns=120):
@@ -297,11 +391,11 @@ class ChangedRPMPackagesController(object):
         """Add a installed RPM pkg to the list of installed pkgs."""
         self.installed_pkgs.append(pkg)
 
-    def backup_and_track_removed_pkg(self, pkg):
-        """Add a removed RPM pkg to the list of removed pkgs."""
-        restorable_pkg = RestorablePackage(pkg)
-        restorable_pkg.backup()
-        self.removed_pkgs.append(restorable_pkg)
+    def backup_and_track_removed_pkgs(self, pkgs):
+        """Add removed RPM pkgs to the list of removed pkgs, backing them up all at once."""
+        restorable_pkgs = [RestorablePackage(pkg) for pkg in pkgs]
+        RestorablePackage.backup_all(restorable_pkgs)
+        self.removed_pkgs.extend(restorable_pkgs)
 
     def _remove_installed_pkgs(self):
         """For each package installed during conversion remove it."""
@@ -314,14 +408,20 @@ class ChangedRPMPackagesController(object):
         loggerinst = logging.getLogger(__name__)
         loggerinst.task("Rollback: Installing removed packages")
         pkgs_to_install = []
+        pkgs_to_restore_from_archive = []
         for restorable_pkg in self.removed_pkgs:
             if restorable_pkg.path is None:
+                if restorable_pkg.archive is not None:
+                    pkgs_to_restore_from_archive.append(restorable_pkg.archive)
+                    continue
                 loggerinst.warning("Couldn't find a backup for %s package."
                                    % restorable_pkg.name)
                 continue
             pkgs_to_install.append(restorable_pkg.path)
 
         install_pkgs(pkgs_to_install, replace=True, critical=False)
+        for archived_pkg in pkgs_to_restore_from_archive:
+            archived_pkg.restore()
 
     def restore_pkgs(self):
         """Restore system to the original state."""
@@ -354,21 +454,70 @@ def remove_pkgs(pkgs_to_remove, backup=True, critical=True):
         # Some packages, when removed, will also remove repo files, making it
         # impossible to access the repositories to download a backup. For this
         # reason we first backup all packages and only after that we remove
-        for nvra in pkgs_to_remove:
-            changed_pkgs_control.backup_and_track_removed_pkg(nvra)
+        changed_pkgs_control.backup_and_track_removed_pkgs(pkgs_to_remove)
 
     if not pkgs_to_remove:
         loggerinst.info("No package to remove")
         return
 
+    _wait_for_rpm_va()
     for nvra in pkgs_to_remove:
         loggerinst.info("Removing package: %s" % nvra)
+    # All the packages are removed in a single rpm transaction. Only the packages failing in the batch are then
+    # removed one by one.
+    failed = _remove_pkgs_in_batch(pkgs_to_remove)
+    for nvra in failed:
+        loggerinst.info("Removing package %s separately" % nvra)
         _, ret_code = run_subprocess("rpm -e --nodeps %s" % nvra)
         if ret_code != 0:
             if critical:
+                _invalidate_installed_pkgs_snapshot()
                 loggerinst.critical("Error: Couldn't remove %s." % nvra)
             else:
                 loggerinst.warning("Couldn't remove %s." % nvra)
+    _invalidate_installed_pkgs_snapshot()
+    for nvra in pkgs_to_remove:
+        if nvra not in failed:
+            loggerinst.info("Removed package: %s" % nvra)
+
+
+def _remove_pkgs_in_batch(nvras):
+    """Remove the packages in one rpm transaction. Return the packages that have failed to be removed in the batch.
+
+    When the batch fails, the packages rpm reports errors for are returned as failed. Out of the rest, those that are
+    still installed (rpm refuses the whole batch when, e.g., one of the packages is not installed) are removed in
+    another batch.
+    """
+    loggerinst = logging.getLogger(__name__)
+    output, ret_code = run_subprocess("rpm -e --nodeps %s" % " ".join(nvras))
+    if ret_code == 0:
+        return []
+
+    failed = _get_pkgs_in_rpm_errors(output, nvras)
+    if not failed:
+        # Unable to tell which of the packages has caused the failure
+        return list(nvras)
+    loggerinst.info("Unable to remove %s in the batch." % ", ".join(failed))
+
+    rest = [nvra for nvra in nvras if nvra not in failed]
+    if not rest:
+        return failed
+    output, _ = run_subprocess("rpm -q %s" % " ".join(rest), print_output=False)
+    not_installed = _get_pkgs_in_rpm_errors(output, rest, "is not installed")
+    rest = [nvra for nvra in rest if nvra not in not_installed]
+    if not rest:
+        return failed
+    _, ret_code = run_subprocess("rpm -e --nodeps %s" % " ".join(rest))
+    if ret_code != 0:
+        return failed + rest
+    return failed
+
+
+def _get_pkgs_in_rpm_errors(output, nvras, error_text="error"):
+    """Return those of the packages that are mentioned on the lines of the rpm output with the error text."""
+    error_lines = [line for line in output.splitlines() if error_text in line]
+    return [nvra for nvra in nvras
+            if any(re.search(r"(^|[\s(])%s($|[\s).:])" % re.escape(nvra), line) for line in error_lines)]
 
 
 def install_pkgs(pkgs_to_install, replace=False, critical=True):
@@ -390,7 +539,9 @@ def install_pkgs(pkgs_to_install, replace=False, critical=True):
     for pkg in pkgs_to_install:
         loggerinst.info("\t%s" % pkg)
 
+    _wait_for_rpm_va()
     output, ret_code = run_subprocess("%s %s" % (cmd, pkgs), print_output=False)
+    _invalidate_installed_pkgs_snapshot()
     if ret_code != 0:
         loggerinst.debug(output.strip())
         if critical:
@@ -407,9 +558,26 @@ def install_pkgs(pkgs_to_install, replace=False, critical=True):
     return True
 
 
+def _invalidate_installed_pkgs_snapshot():
+    """Make the package handler read the installed packages again after we've changed the rpm db."""
+    # Importing here instead of on top of the file to avoid cyclic dependency
+    from convert2rhel import pkghandler
+    pkghandler.installed_pkgs_snapshot.invalidate()
+
+
+def _wait_for_rpm_va():
+    """Make sure the verification of the packages running in the background doesn't see the changes we are about to
+    make.
+    """
+    # Importing here instead of on top of the file to avoid cyclic dependency
+    from convert2rhel.systeminfo import system_info
+    system_info.wait_for_rpm_va()
+
+
 def download_pkgs(pkgs, dest=TMP_DIR, reposdir=None, enable_repos=None, disable_repos=None, set_releasever=True):
-    """A wrapper for the download_pkg function allowing to download multiple packages."""
-    return [download_pkg(pkg, dest, reposdir, enable_repos, disable_repos, set_releasever) for pkg in pkgs]
+    """Download multiple packages. Return a list of the filepaths of the rpms, None for those not downloaded."""
+    paths = download_pkgs_in_batch(pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever)
+    return [paths[pkg] for pkg in pkgs]
     
 
 def download_pkg(pkg, dest=TMP_DIR, reposdir=None, enable_repos=None, disable_repos=None, set_releasever=True):
@@ -419,10 +587,161 @@ def download_pkg(pkg, dest=TMP_DIR, reposdir=None, enable_repos=None, disable_re
     --enablerepo and --disablerepo yumdownloader options, respectively.
 
     Pass just a single rpm name as a string to the pkg parameter.
+
+    The package is downloaded the same way as by download_pkgs_in_batch().
     """
-    from convert2rhel.systeminfo import system_info
+    return download_pkgs_in_batch([pkg], dest, reposdir, enable_repos, disable_repos, set_releasever)[pkg]
+
+
+def download_pkgs_in_batch(pkgs, dest=TMP_DIR, reposdir=None, enable_repos=None, disable_repos=None,
+                           set_releasever=True):
+    """Download the rpms using a single yumdownloader call. Return a dictionary with the filepaths of the rpms keyed
+    by the passed package specs, None for the packages that have not been downloaded.
+
+    Each yumdownloader call loads the repository metadata, so downloading all the packages at once is much faster than
+    calling download_pkg() for each of them. The downloaded rpms are matched to the packages by reading the headers of
+    the rpm files written to the destination directory by the call, not by parsing the yumdownloader output.
+
+    As with download_pkg(), the packages are downloaded through the yum/dnf API when possible.
+    """
+    if not pkgs:
+        return {}
+    results = _download_pkgs_in_process(pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever)
+    if results is not None:
+        return dict([(pkg, results[pkg].path) for pkg in pkgs])
+    return download_pkgs_w_yumdownloader(pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever)
+
+
+def download_pkgs_w_yumdownloader(pkgs, dest=TMP_DIR, reposdir=None, enable_repos=None, disable_repos=None,
+                                  set_releasever=True):
+    """Download the rpms using a single yumdownloader call, see download_pkgs_in_batch()."""
     loggerinst = logging.getLogger(__name__)
-    loggerinst.debug("Downloading the %s package." % pkg)
+    loggerinst.debug("Downloading the %s packages." % ", ".join(pkgs))
+
+    cmd = _get_yumdownloader_cmd(dest, reposdir, enable_repos, disable_repos, set_releasever)
+    cmd += " %s" % " ".join(pkgs)
+    # Rpms left in the directory by previous runs must not be taken for the downloaded ones
+    old_files = get_rpm_files_stats(dest)
+    output, ret_code = run_subprocess(cmd, print_output=False)
+
+    paths = get_rpm_paths_by_pkg(pkgs, dest, old_files, output)
+    not_downloaded = [pkg for pkg in pkgs if not paths[pkg]]
+    if not_downloaded:
+        loggerinst.warning("Couldn't download the %s package(s) using yumdownloader.\n"
+                           "Output from the yumdownloader call:\n%s" % (", ".join(not_downloaded), output))
+    elif ret_code != 0:
+        loggerinst.debug("yumdownloader returned %d, but all the packages have been downloaded." % ret_code)
+    for pkg in pkgs:
+        if paths[pkg]:
+            loggerinst.info("Successfully downloaded the %s package." % pkg)
+            loggerinst.debug("Path of the downloaded package: %s" % paths[pkg])
+    return paths
+
+
+def _download_pkgs_in_process(pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever):
+    # Importing here instead of on top of the file to avoid cyclic dependency
+    from convert2rhel import pkghandler
+    return pkghandler.download_pkgs_in_process(pkgs, dest, reposdir, enable_repos, disable_repos, set_releasever)
+
+
+def get_rpm_paths_by_pkg(pkgs, directory, old_files=None, output=""):
+    """Find the rpm files of the package specs in the directory, using the headers of the rpm files.
+
+    A package spec is matched the way yum matches the package arguments: a name, name-version, name-version-release,
+    name-version-release.arch or a full NEVRA. When more rpm files match a spec, the most recently modified one is
+    used. Return a dictionary with the filepaths keyed by the package specs, None for those not found.
+
+    The rpm files listed in old_files, as returned by get_rpm_files_stats(), are ignored unless they have changed
+    since or the output of the download command mentions them. The yumdownloader doesn't download a package again
+    when its rpm file is already in the directory, it just reports the file name or the NEVRA, see
+    _is_rpm_file_in_output().
+    """
+    old_files = old_files or {}
+    labels_to_path = {}
+    for path, nevra in sorted(read_rpm_files_nevras(directory), key=lambda item: os.path.getmtime(item[0])):
+        if (path in old_files and old_files[path] == _get_file_stat(path)
+                and not _is_rpm_file_in_output(path, nevra, output)):
+            continue
+        for label in get_pkg_labels(*nevra):
+            labels_to_path[label] = path
+    return dict([(pkg, labels_to_path.get(pkg)) for pkg in pkgs])
+
+
+def _is_rpm_file_in_output(path, nevra, output):
+    """Return True when the yumdownloader output mentions the rpm file as already downloaded.
+
+    The lines about an rpm file already present in the destination directory can look like:
+      RHEL 6: "/var/lib/convert2rhel/yum-plugin-ulninfo-0.2-13.el6.noarch.rpm already exists and appears to be complete"
+      RHEL 7: "using local copy of 7:oraclelinux-release-7.9-1.0.9.el7.x86_64"
+      RHEL 8: "[SKIPPED] oraclelinux-release-8.2-1.0.8.el8.x86_64.rpm: Already downloaded"
+    """
+    if not output:
+        return False
+    name, _, version, release, arch = nevra
+    nvra_re = r"(?:\d+:)?%s" % re.escape("%s-%s-%s.%s" % (name, version, release, arch))
+    return bool(re.search(r"(^|[\s/])%s(\s|:|$)" % re.escape(os.path.basename(path)), output, re.MULTILINE)
+                or re.search(r"^using local copy of %s\s*$" % nvra_re, output, re.MULTILINE))
+
+
+def get_rpm_files_stats(directory):
+    """Return a dictionary with the (size, modification time) of the rpm files in the directory keyed by their paths."""
+    stats = {}
+    for path in glob.glob(os.path.join(directory, "*.rpm")):
+        stat = _get_file_stat(path)
+        if stat:
+            stats[path] = stat
+    return stats
+
+
+def _get_file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def read_rpm_files_nevras(directory):
+    """Return a list of (filepath, (name, epoch, version, release, arch)) of the rpm files in the directory."""
+    loggerinst = logging.getLogger(__name__)
+    ts = rpm.TransactionSet()
+    # The files are just identified, their signatures are checked when they are installed
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)  # pylint: disable=protected-access
+    nevras = []
+    for path in glob.glob(os.path.join(directory, "*.rpm")):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                hdr = ts.hdrFromFdno(fd)
+            finally:
+                os.close(fd)
+        except (OSError, rpm.error) as err:
+            loggerinst.debug("Unable to read the header of %s: %s" % (path, str(err)))
+            continue
+        nevras.append((path, tuple([_to_str(hdr[tag]) for tag in (rpm.RPMTAG_NAME, rpm.RPMTAG_EPOCH,
+                                                                  rpm.RPMTAG_VERSION, rpm.RPMTAG_RELEASE,
+                                                                  rpm.RPMTAG_ARCH)])))
+    return nevras
+
+
+def _to_str(value):
+    if value is None:
+        return None
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def get_pkg_labels(name, epoch, version, release, arch):
+    vr = "%s-%s" % (version, release)
+    labels = [name, "%s-%s" % (name, version), "%s-%s" % (name, vr), "%s-%s.%s" % (name, vr, arch),
+              "%s.%s" % (name, arch)]
+    epoch = epoch or "0"
+    labels.extend(["%s:%s-%s.%s" % (epoch, name, vr, arch), "%s-%s:%s.%s" % (name, epoch, vr, arch),
+                   "%s-%s:%s" % (name, epoch, vr)])
+    return labels
+
+
+def _get_yumdownloader_cmd(dest, reposdir, enable_repos, disable_repos, set_releasever):
+    from convert2rhel.systeminfo import system_info
 
     # On RHEL 7, it's necessary to invoke yumdownloader with -v, otherwise there's no output to stdout.
     cmd = 'yumdownloader -v --destdir="%s"' % dest
@@ -442,52 +761,10 @@ def download_pkg(pkg, dest=TMP_DIR, reposdir=None, enable_repos=None, disable_re
 
     if system_info.version.major == 8:
         cmd += " --setopt=module_platform_id=platform:el8"
+        # Otherwise dnf download fails for all the packages when any of them is not available
+        cmd += " --setopt=strict=0"
 
-    cmd += " %s" % pkg
-
-    output, ret_code = run_cmd_in_pty(cmd, print_output=False)
-    if ret_code != 0:
-        loggerinst.warning("Couldn't download the %s package using yumdownloader.\n"
-                           "Output from the yumdownloader call:\n%s" % (pkg, output))
-        return None
-
-    path = get_rpm_path_from_yumdownloader_output(cmd, output, dest)
-    if path:
-        loggerinst.info("Successfully downloaded the %s package." % pkg)
-        loggerinst.debug("Path of the downloaded package: %s" % path)
-
-    return path
-
-
-def get_rpm_path_from_yumdownloader_output(cmd, output, dest):
-    """Parse the output of yumdownloader to get the filepath of the downloaded rpm.
-
-    The name of the downloaded rpm is on the last line of the output from yumdownloader. The line can look like:
-      RHEL 6 & 7 & 8: "vim-enhanced-8.0.1763-13.0.1.el8.x86_64.rpm     2.2 MB/s | 1.4 MB     00:00"
-      RHEL 6: "/var/lib/convert2rhel/yum-plugin-ulninfo-0.2-13.el6.noarch.rpm already exists and appears to be complete"
-      RHEL 7: "using local copy of 7:oraclelinux-release-7.9-1.0.9.el7.x86_64"
-      RHEL 8: "[SKIPPED] oraclelinux-release-8.2-1.0.8.el8.x86_64.rpm: Already downloaded"
-    """
-    loggerinst = logging.getLogger(__name__)
-    if output:
-        last_output_line = output.splitlines()[-1]
-    else:
-        loggerinst.warning("The output of running yumdownloader is unexpectedly empty. Command:\n%s" % cmd)
-        return None
-
-    rpm_name_match = re.search(r"\S*\.rpm", last_output_line)
-    pkg_nevra_match = re.search(r"^using local copy of (?:\d+:)?(.*)$", last_output_line)
-
-    if rpm_name_match:
-        path = os.path.join(dest, rpm_name_match.group(0))
-    elif pkg_nevra_match:
-        path = os.path.join(dest, pkg_nevra_match.group(1) + ".rpm")
-    else:
-        loggerinst.warning("Couldn't find the name of the downloaded rpm in the output of yumdownloader.\n"
-                           "Command:\n%s\nOutput:\n%s" % (cmd, output))
-        return None
-
-    return path
+    return cmd
 
 
 class RestorableFile(object):
@@ -547,17 +824,41 @@ class RestorablePackage(object):
     def __init__(self, pkgname):
         self.name = pkgname
         self.path = None
+        # The backup of the package made from the installed files, see pkgarchive, used when the package has not been
+        # downloaded
+        self.archive = None
+
+    @staticmethod
+    def backup_all(restorable_pkgs):
+        """Save the versions of the RPM packages, downloading them all with a single yumdownloader call.
+
+        The packages that can't be downloaded, or all of them when the offline package backup is requested, are
+        backed up from the installed files instead.
+        """
+        # Importing here instead of on top of the file to avoid cyclic dependency
+        from convert2rhel import pkgarchive
+        from convert2rhel.toolopts import tool_opts
 
-    def backup(self):
-        """ Save version of RPM package """
         loggerinst = logging.getLogger(__name__)
-        loggerinst.info("Backing up %s" % self.name)
-        if os.path.isdir(BACKUP_DIR):
+        if not restorable_pkgs:
+            return
+        loggerinst.info("Backing up %s" % ", ".join([restorable_pkg.name for restorable_pkg in restorable_pkgs]))
+        if not os.path.isdir(BACKUP_DIR):
+            loggerinst.warning("Can't access %s" % TMP_DIR)
+            return
+        if not tool_opts.offline_pkg_backup:
             # When backing up the packages, the original system repofiles are still available and for them we can't
             # use the releasever for RHEL repositories
-            self.path = download_pkg(self.name, dest=BACKUP_DIR, set_releasever=False)
-        else:
-            loggerinst.warning("Can't access %s" % TMP_DIR)
+            paths = download_pkgs_in_batch([restorable_pkg.name for restorable_pkg in restorable_pkgs],
+                                           dest=BACKUP_DIR, set_releasever=False)
+            for restorable_pkg in restorable_pkgs:
+                restorable_pkg.path = paths[restorable_pkg.name]
+
+        not_downloaded = [restorable_pkg for restorable_pkg in restorable_pkgs if restorable_pkg.path is None]
+        if not_downloaded:
+            archived = pkgarchive.archive_pkgs([restorable_pkg.name for restorable_pkg in not_downloaded])
+            for restorable_pkg in not_downloaded:
+                restorable_pkg.archive = archived[restorable_pkg.name]
 
 
 changed_pkgs_control = ChangedRPMPackagesController()  # pylint: disable=C0103
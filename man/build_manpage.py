@@ -114,6 +114,12 @@ class build_manpage(Command):
         ret.append(self._parser.format_option_help())
         return ''.join(ret)
 
+    def _write_notes(self):
+        epilog = self._parser.epilog
+        if not epilog:
+            return ''
+        return '.SH NOTES\n%s\n' % self._markup(epilog)
+
     def _write_footer(self):
         ret = []
         author = '%s <%s>' % (self.distribution.get_author(),
@@ -132,6 +138,7 @@ class build_manpage(Command):
         manpage = []
         manpage.append(self._write_header())
         manpage.append(self._write_options())
+        manpage.append(self._write_notes())
         manpage.append(self._write_footer())
         stream = open(self.output, 'w')
         stream.write(''.join(manpage))
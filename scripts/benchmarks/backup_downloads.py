@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of backing up packages: one download per package (utils.download_pkg, the original method) compared to
+downloading all of them at once (utils.download_pkgs_in_batch). Checks that both methods download the same rpms.
+
+Downloads the installed packages, from the repositories enabled on the system, into temporary directories. Requires
+the yum/dnf and rpm Python bindings. Run as root from the root of the repository:
+  python scripts/benchmarks/backup_downloads.py [number of packages]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from convert2rhel import utils  # noqa: E402 pylint: disable=C0413
+from convert2rhel.systeminfo import system_info  # noqa: E402 pylint: disable=C0413
+
+
+def get_installed_pkgs(count):
+    output, _ = utils.run_subprocess('rpm -qa --qf "%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n"', print_output=False)
+    nvras = sorted([line for line in output.splitlines() if line and not line.startswith("gpg-pubkey")])
+    return nvras[:count]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    major, _ = utils.run_subprocess("rpm -E %rhel", print_output=False)
+    system_info.version = namedtuple("Version", ["major", "minor"])(int(major.strip()), 0)
+    system_info.releasever = None
+    pkgs = get_installed_pkgs(count)
+    print("Packages: %d" % len(pkgs))
+
+    separate_dir = tempfile.mkdtemp()
+    batch_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        separate_paths = [utils.download_pkg(pkg, dest=separate_dir, set_releasever=False) for pkg in pkgs]
+        separate_time = time.time() - start
+
+        start = time.time()
+        batch_paths = utils.download_pkgs_in_batch(pkgs, dest=batch_dir, set_releasever=False)
+        batch_time = time.time() - start
+
+        separate_files = sorted([os.path.basename(path) for path in separate_paths if path])
+        batch_files = sorted([os.path.basename(path) for path in batch_paths.values() if path])
+        print("Downloaded:                 %d" % len(batch_files))
+        print("yumdownloader per package:  %7.1f s" % separate_time)
+        print("Single yumdownloader call:  %7.1f s (%.1fx)" % (batch_time, separate_time / batch_time))
+        if separate_files != batch_files:
+            print("The downloaded rpms differ between the methods!")
+            return 1
+    finally:
+        shutil.rmtree(separate_dir)
+        shutil.rmtree(batch_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
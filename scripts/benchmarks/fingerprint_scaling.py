@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of decoding the package signatures in 1 to N processes (pkghandler.decode_sigs).
+
+Requires the rpm Python bindings. Run from the root of the repository:
+  python scripts/benchmarks/fingerprint_scaling.py [number of signatures] [max number of processes]
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from convert2rhel import pkghandler  # noqa: E402 pylint: disable=C0413
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from signature_decoding import create_v4_sig  # noqa: E402 pylint: disable=C0413
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_processes = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    key_ids = ["199e2f91fd431d51", "5326810137017186", "24c6a8a7f4a80eb5", "05b555b38483c65d"]
+    sigs = [create_v4_sig(key_ids[i % len(key_ids)]) for i in range(count)]
+
+    # Measure the raw scaling, regardless of the threshold for using multiple processes
+    pkghandler.PARALLEL_DECODING_MIN_SIGS = 0
+    print("Signatures: %d" % count)
+    serial_time = None
+    for processes in range(1, max_processes + 1):
+        start = time.time()
+        pkghandler.decode_sigs(sigs, processes=processes)
+        elapsed = time.time() - start
+        serial_time = serial_time or elapsed
+        print("%3d process(es): %.3f s (%.2fx)" % (processes, elapsed, serial_time / elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark and check of downloading packages from a local repository: yumdownloader called for each package (the
+original method) compared to pkghandler.download_pkgs_in_process(). Checks that both methods download the same rpms.
+
+A repository is created with createrepo from the rpms in the given directory and served over HTTP by http.server on
+localhost. Requires Python 3, createrepo (or createrepo_c), yumdownloader and the yum/dnf and rpm Python bindings. Run
+as root from the root of the repository:
+  python scripts/benchmarks/local_repo_downloads.py <directory with rpms>
+"""
+
+import functools
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from convert2rhel import pkghandler  # noqa: E402 pylint: disable=C0413
+from convert2rhel import utils  # noqa: E402 pylint: disable=C0413
+from convert2rhel.systeminfo import system_info  # noqa: E402 pylint: disable=C0413
+
+REPO_ID = "convert2rhel-benchmark"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def create_repo(rpms_dir, repo_dir):
+    shutil.copytree(rpms_dir, repo_dir)
+    for createrepo in ("createrepo_c", "createrepo"):
+        _, ret_code = utils.run_subprocess("%s %s" % (createrepo, repo_dir), print_output=False)
+        if ret_code == 0:
+            return
+    raise RuntimeError("Unable to create the repository, is createrepo installed?")
+
+
+def serve(repo_dir):
+    server = HTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=repo_dir))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def digests(paths):
+    result = {}
+    for path in paths:
+        with open(path, "rb") as rpm_file:
+            result[os.path.basename(path)] = hashlib.sha256(rpm_file.read()).hexdigest()
+    return result
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        return 1
+    major, _ = utils.run_subprocess("rpm -E %rhel", print_output=False)
+    system_info.version = namedtuple("Version", ["major", "minor"])(int(major.strip()), 0)
+    system_info.releasever = None
+
+    tmp_dir = tempfile.mkdtemp()
+    server = None
+    try:
+        repo_dir = os.path.join(tmp_dir, "repo")
+        create_repo(sys.argv[1], repo_dir)
+        server = serve(repo_dir)
+        reposdir = os.path.join(tmp_dir, "yum.repos.d")
+        os.mkdir(reposdir)
+        utils.store_content_to_file(os.path.join(reposdir, "%s.repo" % REPO_ID),
+                                    "[%s]\nname=%s\nbaseurl=http://127.0.0.1:%d/\ngpgcheck=0\nenabled=1\n"
+                                    % (REPO_ID, REPO_ID, server.server_address[1]))
+        pkgs = ["%s-%s-%s.%s" % (name, version, release, arch)
+                for _, (name, _, version, release, arch) in utils.read_rpm_files_nevras(repo_dir)]
+        print("Packages: %d" % len(pkgs))
+
+        yumdownloader_dir = os.path.join(tmp_dir, "yumdownloader")
+        os.mkdir(yumdownloader_dir)
+        start = time.time()
+        for pkg in pkgs:
+            cmd = utils._get_yumdownloader_cmd(yumdownloader_dir, reposdir, None, None, False)  # pylint: disable=W0212
+            utils.run_cmd_in_pty("%s %s" % (cmd, pkg), print_output=False)
+        yumdownloader_time = time.time() - start
+
+        in_process_dir = os.path.join(tmp_dir, "in_process")
+        start = time.time()
+        results = pkghandler.download_pkgs_in_process(pkgs, in_process_dir, reposdir=reposdir, set_releasever=False)
+        in_process_time = time.time() - start
+
+        failed = [result for result in results.values() if not result.path]
+        print("yumdownloader per package:  %7.2f s" % yumdownloader_time)
+        print("In-process:                 %7.2f s (%.1fx)" % (in_process_time, yumdownloader_time / in_process_time))
+        for result in failed:
+            print("Not downloaded in-process: %s: %s" % (result.pkg, result.error))
+        yumdownloader_digests = digests([path for path, _ in utils.read_rpm_files_nevras(yumdownloader_dir)])
+        in_process_digests = digests([result.path for result in results.values() if result.path])
+        if failed or yumdownloader_digests != in_process_digests:
+            print("The downloaded rpms differ between the methods!")
+            return 1
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Memory benchmark of keeping a package inventory as pkghandler.PkgRecord objects compared to keeping the package
+objects of the package manager.
+
+With --installed, the package objects of the packages installed on this system are measured. Note that memory
+allocated outside of Python, e.g. the rpm headers held by the yum package objects, is not traced in that case.
+Otherwise a synthetic inventory is used, with package objects holding an rpm header of the given size.
+
+Requires Python 3 (tracemalloc) and the rpm Python bindings. Run from the root of the repository:
+  python scripts/benchmarks/pkg_record_memory.py [--count 20000] [--hdr-size 30000] [--installed]
+"""
+
+import gc
+import optparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from convert2rhel import pkghandler  # noqa: E402 pylint: disable=C0413
+
+
+class SyntheticYumPkg(object):
+    """Stand-in for yum.rpmsack.RPMInstalledPackage: the NEVRA and other attributes plus the whole rpm header."""
+
+    def __init__(self, i, hdr_size):
+        self.name = "package-%d" % i
+        self.epoch = "0"
+        self.version = "1.%d" % i
+        self.release = "1.el7"
+        self.arch = "x86_64"
+        self.vendor = "CentOS"
+        self.packager = "CentOS BuildSystem <http://bugs.centos.org>"
+        self.installtime = 1600000000 + i
+        self.summary = "Synthetic package number %d" % i
+        self.hdr = os.urandom(hdr_size)
+
+        class YumDbInfo(object):
+            from_repo = "base"
+        self.yumdb_info = YumDbInfo()
+
+
+def measure(create):
+    gc.collect()
+    tracemalloc.start()
+    objects = create()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return objects, current
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--count", type="int", default=20000, help="Number of synthetic packages.")
+    parser.add_option("--hdr-size", type="int", default=30000, help="Size of a synthetic rpm header in bytes.")
+    parser.add_option("--installed", action="store_true", help="Measure the packages installed on this system.")
+    opts, _ = parser.parse_args()
+
+    if opts.installed:
+        pkg_objs, pkg_objs_size = measure(pkghandler.get_installed_pkg_objects)
+    else:
+        pkghandler.pkgmanager.TYPE = "yum"
+        pkg_objs, pkg_objs_size = measure(lambda: [SyntheticYumPkg(i, opts.hdr_size) for i in range(opts.count)])
+
+    records, records_size = measure(lambda: [pkghandler.PkgRecord.from_pkg_obj(pkg_obj, "24c6a8a7f4a80eb5")
+                                             for pkg_obj in pkg_objs])
+
+    print("Packages:          %d" % len(pkg_objs))
+    print("Package objects:   %.1f MiB (%d B per package)"
+          % (pkg_objs_size / 1024.0 / 1024, pkg_objs_size // len(pkg_objs)))
+    print("PkgRecord objects: %.1f MiB (%d B per package)"
+          % (records_size / 1024.0 / 1024, records_size // len(records)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
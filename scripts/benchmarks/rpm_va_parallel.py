@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of verifying the installed packages with a serial 'rpm -Va' and with rpmverify.verify_all_pkgs() using
+1 to N concurrent 'rpm -V' processes. Checks that all the outputs are the same.
+
+Run it as root on a system with a large number of packages installed, ideally a few thousand, from the root of the
+repository:
+  python scripts/benchmarks/rpm_va_parallel.py [max number of processes]
+
+Drop the page cache before each measurement (echo 3 > /proc/sys/vm/drop_caches) to measure cold runs, otherwise all
+but the first measurement read the files from memory.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from convert2rhel import rpmverify  # noqa: E402 pylint: disable=C0413
+from convert2rhel import utils  # noqa: E402 pylint: disable=C0413
+
+
+def main():
+    max_processes = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    print("Installed packages: %d" % len(rpmverify.get_installed_nvras()))
+
+    start = time.time()
+    serial_output, _ = utils.run_subprocess("rpm -Va", print_output=False)
+    serial_time = time.time() - start
+    print("rpm -Va:           %7.1f s" % serial_time)
+
+    for processes in range(2, max_processes + 1):
+        start = time.time()
+        output = rpmverify.verify_all_pkgs(processes=processes).output
+        elapsed = time.time() - start
+        print("%2d processes:      %7.1f s (%.2fx)%s" % (processes, elapsed, serial_time / elapsed,
+                                                          "" if output == serial_output else " OUTPUT DIFFERS"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(C) 2021 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Microbenchmark of getting the signing key ID from rpm headers.
+
+Compares decoding the raw OpenPGP signature packets (pkghandler.get_hdr_fingerprint) with letting rpm format the
+signature and searching the key ID in the text (the original method, pkghandler._get_hdr_fingerprint_from_sprintf).
+
+Requires the rpm Python bindings. Run from the root of the repository:
+  python scripts/benchmarks/signature_decoding.py [number of headers]
+"""
+
+import os
+import random
+import sys
+import time
+
+import rpm
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from convert2rhel import pkghandler  # noqa: E402 pylint: disable=C0413
+
+
+def create_v4_sig(key_id):
+    """Create a V4 RSA signature packet with the issuer subpacket in the unhashed area, as rpmsign does."""
+    hashed = bytearray([5, 2, 0x56, 0xb7, 0x84, 0x4c])
+    unhashed = bytearray([9, 16]) + bytearray.fromhex(key_id)
+    body = bytearray([4, 0, 1, 8, 0, len(hashed)]) + hashed + bytearray([0, len(unhashed)]) + unhashed \
+        + bytearray([0xab, 0xcd, 0x08, 0x00]) + bytearray(os.urandom(256))
+    return bytes(bytearray([0x89, len(body) >> 8, len(body) & 0xff]) + body)
+
+
+def create_headers(count):
+    key_ids = ["199e2f91fd431d51", "5326810137017186", "24c6a8a7f4a80eb5", "05b555b38483c65d"]
+    headers = []
+    for i in range(count):
+        hdr = rpm.hdr()
+        hdr[rpm.RPMTAG_NAME] = "pkg%d" % i
+        hdr[rpm.RPMTAG_VERSION] = "1.0"
+        hdr[rpm.RPMTAG_RELEASE] = "1"
+        hdr[rpm.RPMTAG_RSAHEADER] = create_v4_sig(random.choice(key_ids))
+        headers.append(hdr)
+    return headers
+
+
+def measure(func, headers):
+    start = time.time()
+    results = [func(hdr) for hdr in headers]
+    return time.time() - start, results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    headers = create_headers(count)
+
+    sprintf_time, sprintf_results = measure(pkghandler._get_hdr_fingerprint_from_sprintf, headers)
+    decoder_time, decoder_results = measure(pkghandler.get_hdr_fingerprint, headers)
+
+    if sprintf_results != decoder_results:
+        print("The key IDs differ between the methods!")
+        return 1
+    print("Headers:          %d" % count)
+    print("sprintf + regex:  %.3f s" % sprintf_time)
+    print("Packet decoder:   %.3f s (%.1fx)" % (decoder_time, sprintf_time / decoder_time))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())